@@ -0,0 +1,316 @@
+import math
+import typing
+
+import numpy as np
+
+from models import CandleSeries, Contract, TIME_ENUM_CONVERSION
+
+# Backtests over a CandleSeries.
+#
+# Signals are arrays aligned with the candles and read at the candle's close: +1 long, -1 short, 0 flat (fractions
+# scale the position in Backtester.run). Whatever a signal asks for is executed at the next candle's open, so a
+# strategy never trades on a price it could not have seen.
+#
+#   run()         vectorized: position, fills, fees and equity are whole-array operations.
+#   run_orders()  path dependent: stop loss, take profit and limit entries are checked against each candle's
+#                 high and low. The loop is over trades, the candles of a trade are scanned by numpy.
+
+EXIT_SIGNAL = 0         # signal changed, closed at the next open
+EXIT_STOP = 1
+EXIT_TAKE_PROFIT = 2
+EXIT_END = 3            # still open at the last candle, closed at its close
+
+TRADE_DTYPE = np.dtype([("entry_bar", np.int64), ("exit_bar", np.int64), ("side", np.int8),
+                        ("quantity", np.float64), ("entry_price", np.float64), ("exit_price", np.float64),
+                        ("fees", np.float64), ("pnl", np.float64), ("exit_reason", np.int8)])
+
+
+class BacktestResult:
+    """Equity curve (one value per candle, marked at the close) and the trades of a backtest."""
+    def __init__(self, equity: np.ndarray, trades: np.ndarray, initial_balance: float, time_frame: str):
+        self.equity = equity
+        self.trades = trades
+        self.initial_balance = initial_balance
+        self.time_frame = time_frame
+
+    @property
+    def total_return(self) -> float:
+        return self.equity[-1] / self.initial_balance - 1 if len(self.equity) else 0.0
+
+    @property
+    def max_drawdown(self) -> float:
+        """Largest fall from a previous equity high, as a fraction of that high."""
+        if len(self.equity) == 0:
+            return 0.0
+        peak = np.maximum.accumulate(np.maximum(self.equity, self.initial_balance))
+        return float(np.max(1 - self.equity / peak))
+
+    @property
+    def sharpe(self) -> float:
+        """
+        Annualized Sharpe ratio of the per candle pnl (risk free rate 0). Positions have a fixed size, so pnl is
+        taken relative to the initial balance rather than to the running equity.
+        """
+        if len(self.equity) < 2:
+            return 0.0
+        returns = np.diff(self.equity) / self.initial_balance
+        std = returns.std()
+        if std == 0:
+            return 0.0
+        candles_per_year = 365 * 24 * 60 / TIME_ENUM_CONVERSION[self.time_frame]
+        return float(returns.mean() / std * math.sqrt(candles_per_year))
+
+    @property
+    def fees(self) -> float:
+        return float(self.trades["fees"].sum())
+
+    @property
+    def win_rate(self) -> float:
+        return float(np.mean(self.trades["pnl"] > 0)) if len(self.trades) else 0.0
+
+    def summary(self) -> dict:
+        return {"trades": len(self.trades), "total_return": self.total_return, "max_drawdown": self.max_drawdown,
+                "sharpe": self.sharpe, "win_rate": self.win_rate, "fees": self.fees,
+                "final_balance": float(self.equity[-1]) if len(self.equity) else self.initial_balance}
+
+    def __repr__(self):
+        s = self.summary()
+        return (f"BacktestResult({s['trades']} trades, return {s['total_return']:.2%}, "
+                f"max drawdown {s['max_drawdown']:.2%}, sharpe {s['sharpe']:.2f}, fees {s['fees']:.2f})")
+
+
+class Backtester:
+    """
+    Simulates a strategy on one symbol with the exchange's tick size, lot size and commissions.
+    Every position is sized to order_size quote asset at entry, rounded down to the lot size.
+    """
+    def __init__(self, series: CandleSeries, contract: typing.Optional[Contract] = None,
+                 maker_commission=0.02 / 100, taker_commission=0.04 / 100, initial_balance=1000.0,
+                 order_size: typing.Optional[float] = None, slippage_ticks=0):
+        """
+        :param series: candles to trade on.
+        :param contract: gives tick_size and lot_size; without it prices and quantities are not rounded.
+        :param maker_commission: fee rate of limit fills (limit entries, take profits).
+        :param taker_commission: fee rate of market fills (signal entries and exits, stops).
+        :param initial_balance: quote asset balance at the start.
+        :param order_size: quote asset per position, initial_balance if None.
+        :param slippage_ticks: ticks lost on every market fill.
+        """
+        self.series = series
+        self.contract = contract
+        self.maker_commission = maker_commission
+        self.taker_commission = taker_commission
+        self.initial_balance = initial_balance
+        self.order_size = order_size if order_size is not None else initial_balance
+        self.tick_size = contract.tick_size if contract is not None else 0.0
+        self.lot_size = contract.lot_size if contract is not None else 0.0
+        self.slippage = slippage_ticks * self.tick_size
+
+    @classmethod
+    def from_client(cls, client, series: CandleSeries, contract: Contract, **kwargs) -> "Backtester":
+        """Uses the commission rates of the client's account for contract."""
+        client.get_current_commissions(contract)
+        return cls(series, contract, client.maker_commission, client.taker_commission, **kwargs)
+
+    def _round_price(self, price):
+        if self.tick_size <= 0:
+            return price
+        return np.round(np.asarray(price) / self.tick_size) * self.tick_size
+
+    def _round_quantity(self, quantity):
+        if self.lot_size <= 0:
+            return quantity
+        # the small epsilon keeps 0.3 / 0.1 = 2.9999999999999996 from losing a lot
+        return np.floor(np.asarray(quantity) / self.lot_size + 1e-9) * self.lot_size
+
+    def run(self, signal: np.ndarray) -> BacktestResult:
+        """
+        Vectorized backtest with market orders at the open following each signal change.
+        :param signal: target position per candle in [-1, 1], as a fraction of order_size.
+        """
+        series = self.series
+        n = len(series.open)
+        if n == 0:
+            return BacktestResult(np.empty(0), np.empty(0, dtype=TRADE_DTYPE), self.initial_balance,
+                                  series.time_frame)
+        opens, last_close = series.open, series.close[-1]
+        target = np.zeros(n)
+        target[1:] = np.clip(np.asarray(signal, dtype=np.float64)[:-1], -1, 1)
+
+        # quantity is fixed when the target changes and kept until the next change
+        changed = np.empty(n, dtype=bool)
+        changed[0] = True
+        np.not_equal(target[1:], target[:-1], out=changed[1:])
+        sized_at = np.maximum.accumulate(np.where(changed, np.arange(n), 0))
+        holding = np.sign(target) * self._round_quantity(np.abs(target) * self.order_size / opens[sized_at])
+
+        # held from this open to the next one, the last candle to its close where everything is closed
+        next_price = np.append(opens[1:], last_close)
+        pnl = holding * (next_price - opens)
+        traded = np.diff(holding, prepend=0.0)
+        fills = opens + np.sign(traded) * self.slippage
+        costs = np.abs(traded) * (fills * self.taker_commission + self.slippage)
+        costs[-1] += abs(holding[-1]) * ((last_close - np.sign(holding[-1]) * self.slippage) * self.taker_commission
+                                         + self.slippage)
+        equity = self.initial_balance + np.cumsum(pnl - costs)
+        # pnl runs open to open, the curve is marked at each close
+        equity += holding * (series.close - next_price)
+
+        boundaries = np.append(np.flatnonzero(traded != 0), n)
+        starts = boundaries[:-1][holding[boundaries[:-1]] != 0]
+        ends = boundaries[np.searchsorted(boundaries, starts, side="right")]
+        trades = np.empty(len(starts), dtype=TRADE_DTYPE)
+        side = np.sign(holding[starts]).astype(np.int8)
+        quantity = np.abs(holding[starts])
+        exit_raw = np.where(ends < n, opens[np.minimum(ends, n - 1)], last_close)
+        entry_price = opens[starts] + side * self.slippage
+        exit_price = exit_raw - side * self.slippage
+        trades["entry_bar"], trades["exit_bar"], trades["side"], trades["quantity"] = starts, ends, side, quantity
+        trades["entry_price"], trades["exit_price"] = entry_price, exit_price
+        trades["fees"] = quantity * (entry_price + exit_price) * self.taker_commission
+        trades["pnl"] = side * quantity * (exit_price - entry_price) - trades["fees"]
+        trades["exit_reason"] = np.where(ends < n, EXIT_SIGNAL, EXIT_END)
+        return BacktestResult(equity, trades, self.initial_balance, series.time_frame)
+
+    def run_orders(self, signal: np.ndarray, stop_loss: typing.Optional[float] = None,
+                   take_profit: typing.Optional[float] = None, entry_offset: typing.Optional[float] = None,
+                   entry_valid_bars=1) -> BacktestResult:
+        """
+        Path dependent backtest. A trade is opened when the signal turns long or short and closed by the first of:
+        stop loss, take profit, or the signal changing again (market order at the next open). After a stop or a
+        take profit the next trade waits for the next signal change.
+        If the stop and the take profit are both touched in the same candle the stop is assumed to come first.
+        :param signal: +1, -1 or 0 per candle.
+        :param stop_loss: distance from the entry price as a fraction, i.e 0.01
+        :param take_profit: distance from the entry price as a fraction, filled as a maker limit order.
+        :param entry_offset: enter with a maker limit order that far below (long) or above (short) the signal
+            candle's close instead of a market order.
+        :param entry_valid_bars: candles a limit entry waits for a fill before it is cancelled.
+        """
+        series = self.series
+        opens, highs, lows, closes = series.open, series.high, series.low, series.close
+        n = len(opens)
+        sig = np.sign(np.asarray(signal, dtype=np.float64)).astype(np.int8)
+        changes = np.flatnonzero(np.diff(sig, prepend=np.int8(0)) != 0)
+
+        records = list()
+        holding = np.zeros(n)
+        entry_marks = np.zeros(n)
+        realized = np.zeros(n)
+        free_from = 0   # first candle a new trade may enter on
+        for position, k in enumerate(changes):
+            side = int(sig[k])
+            entry_bar = k + 1
+            if side == 0 or entry_bar >= n or entry_bar < free_from:
+                continue
+            # the signal's next change closes the trade at the open after it
+            signal_exit = changes[position + 1] + 1 if position + 1 < len(changes) else n
+
+            if entry_offset is None:
+                fill_bar, fee_rate = entry_bar, self.taker_commission
+                entry_price = opens[entry_bar] + side * self.slippage
+            else:
+                limit = float(self._round_price(closes[k] * (1 - side * entry_offset)))
+                window_end = min(entry_bar + entry_valid_bars, signal_exit, n)
+                touched = (lows[entry_bar:window_end] <= limit) if side > 0 else (highs[entry_bar:window_end] >= limit)
+                if not touched.any():
+                    continue
+                fill_bar, fee_rate = entry_bar + int(np.argmax(touched)), self.maker_commission
+                # an open through the limit fills at the open
+                entry_price = min(limit, opens[fill_bar]) if side > 0 else max(limit, opens[fill_bar])
+            quantity = float(self._round_quantity(self.order_size / entry_price))
+            if quantity <= 0:
+                continue
+            fees = quantity * entry_price * fee_rate
+
+            exit_bar, reason = signal_exit, EXIT_SIGNAL
+            if signal_exit >= n:
+                exit_bar, reason = n - 1, EXIT_END
+            stop = float(self._round_price(entry_price * (1 - side * stop_loss))) if stop_loss else None
+            take = float(self._round_price(entry_price * (1 + side * take_profit))) if take_profit else None
+            if stop is not None or take is not None:
+                scan_end = min(signal_exit, n)
+                low, high = lows[fill_bar:scan_end], highs[fill_bar:scan_end]
+                stop_hit = ((low <= stop) if side > 0 else (high >= stop)) if stop is not None else None
+                take_hit = ((high >= take) if side > 0 else (low <= take)) if take is not None else None
+                if stop_hit is not None and take_hit is not None:
+                    hit = stop_hit | take_hit
+                else:
+                    hit = stop_hit if stop_hit is not None else take_hit
+                if hit.any():
+                    exit_bar = fill_bar + int(np.argmax(hit))
+                    reason = EXIT_STOP if stop_hit is not None and stop_hit[exit_bar - fill_bar] else EXIT_TAKE_PROFIT
+
+            if reason == EXIT_STOP:
+                gapped = opens[exit_bar] <= stop if side > 0 else opens[exit_bar] >= stop
+                exit_price = (opens[exit_bar] if gapped and exit_bar > fill_bar else stop) - side * self.slippage
+                fees += quantity * exit_price * self.taker_commission
+            elif reason == EXIT_TAKE_PROFIT:
+                gapped = opens[exit_bar] >= take if side > 0 else opens[exit_bar] <= take
+                exit_price = opens[exit_bar] if gapped and exit_bar > fill_bar else take
+                fees += quantity * exit_price * self.maker_commission
+            else:
+                exit_price = (opens[exit_bar] if reason == EXIT_SIGNAL else closes[exit_bar]) - side * self.slippage
+                fees += quantity * exit_price * self.taker_commission
+            pnl = side * quantity * (exit_price - entry_price) - fees
+
+            records.append((entry_bar, exit_bar, side, quantity, entry_price, exit_price, fees, pnl, reason))
+            # open from the fill candle until the one it is closed in, which already holds the realized pnl
+            holding[fill_bar:exit_bar] = side * quantity
+            entry_marks[fill_bar:exit_bar] = entry_price
+            realized[exit_bar] += pnl
+            free_from = exit_bar if reason == EXIT_SIGNAL else exit_bar + 1
+
+        trades = np.array(records, dtype=TRADE_DTYPE)
+        equity = self.initial_balance + np.cumsum(realized) + holding * (closes - entry_marks)
+        return BacktestResult(equity, trades, self.initial_balance, series.time_frame)
+
+
+def crossover_signal(close: np.ndarray, fast: int, slow: int) -> np.ndarray:
+    """+1 while the fast EMA is above the slow one, -1 below, 0 until the slow EMA has seen `slow` candles."""
+    from indicators import ema
+    signal = np.sign(ema(close, fast) - ema(close, slow)).astype(np.int8)
+    signal[:slow] = 0
+    return signal
+
+
+if __name__ == '__main__':
+    # One year of synthetic 1m candles for one symbol, an EMA crossover traded both ways.
+    import time
+
+    rng = np.random.default_rng(7)
+    minutes = 365 * 24 * 60
+    tick = 0.1
+    close = np.round(20000 * np.exp(np.cumsum(rng.normal(0, 8e-4, minutes))) / tick) * tick
+    open_ = np.append(close[0], close[:-1])
+    spread = np.abs(rng.normal(0, 6e-4, minutes)) * close
+    open_time = 1640995200000 + 60000 * np.arange(minutes, dtype=np.int64)
+    series = CandleSeries({"open_time": open_time, "open": open_,
+                           "high": np.maximum(open_, close) + np.round(spread / tick) * tick,
+                           "low": np.minimum(open_, close) - np.round(spread / tick) * tick,
+                           "close": close, "volume_base": np.ones(minutes), "close_time": open_time + 59999,
+                           "volume_quote": close, "num_of_trades": np.ones(minutes, dtype=np.int64)}, "1m", "BTCUSDT")
+    contract = Contract("binance_futures", {"symbol": "BTCUSDT", "baseAsset": "BTC", "quoteAsset": "USDT",
+                                            "marginAsset": "USDT", "requiredMarginPercent": "5.0000",
+                                            "pricePrecision": 1, "quantityPrecision": 3,
+                                            "filters": [{"tickSize": "0.10"}, {"minQty": "0.001"}, {}, {},
+                                                        {"limit": 200}],
+                                            "orderTypes": [], "timeInForce": [], "leverage": 20})
+    backtester = Backtester(series, contract, initial_balance=10000, slippage_ticks=1)
+
+    ts = time.perf_counter()
+    signal = crossover_signal(series.close, 60, 240)
+    result = backtester.run(signal)
+    print(f"vectorized, {minutes} candles:         {time.perf_counter() - ts:.3f}s  {result}")
+
+    ts = time.perf_counter()
+    result = backtester.run_orders(signal, stop_loss=0.01, take_profit=0.02)
+    print(f"stops and take profits:              {time.perf_counter() - ts:.3f}s  {result}")
+
+    ts = time.perf_counter()
+    result = backtester.run_orders(signal, stop_loss=0.01, entry_offset=0.001, entry_valid_bars=30)
+    print(f"limit entries with stops:            {time.perf_counter() - ts:.3f}s  {result}")
+
+    # both engines agree when no order logic is involved
+    plain = backtester.run_orders(signal)
+    print(f"vectorized vs path final balance:    {backtester.run(signal).equity[-1]:.2f} / {plain.equity[-1]:.2f}")
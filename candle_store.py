@@ -0,0 +1,263 @@
+import io
+import json
+import logging
+import os
+import threading
+import time
+import typing
+
+import numpy as np
+
+import logkeeper
+from models import Contract, CandleSeries, KLINE_COLUMNS, TIME_ENUM_CONVERSION
+from connectors.kline_downloader import KlineDownloader
+
+logger = logging.getLogger("candle_store.py")
+logkeeper.log_keeper("connectors.log", "candle_store.py")
+
+STORE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "candle_store")
+
+
+def _npy_header(file: typing.BinaryIO, count: int) -> typing.Tuple[int, bytes, np.dtype]:
+    """
+    Reads the header of a 1-d .npy file.
+    :param count: row count of the header to build.
+    :return: (offset of the data, the header with the shape set to count, dtype). np.save leaves room in the
+        header for the shape to grow, so the new header has the same length unless the file came from elsewhere.
+    """
+    version = np.lib.format.read_magic(file)
+    if version == (1, 0):
+        read_header, write_header = np.lib.format.read_array_header_1_0, np.lib.format.write_array_header_1_0
+    else:
+        read_header, write_header = np.lib.format.read_array_header_2_0, np.lib.format.write_array_header_2_0
+    _, fortran_order, dtype = read_header(file)
+    header = io.BytesIO()
+    write_header(header, {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': fortran_order,
+                          'shape': (count,)})
+    return file.tell(), header.getvalue(), dtype
+
+
+class CandleStore:
+    """
+    Local OHLCV store keyed by (symbol, interval). Every column is kept in its own .npy file under
+    root/SYMBOL/interval/, so reads can be memory-mapped and only the touched pages are loaded.
+    get() serves the stored part of a range from disk and downloads only the missing head or tail.
+    Only closed candles are stored.
+    """
+    def __init__(self, client=None, root=STORE_DIR, max_workers=4):
+        """
+        :param client: BinanceFuturesClient used to fill gaps, None for an offline (read only) store.
+        :param root: folder of the store.
+        :param max_workers: concurrent windows while downloading missing ranges.
+        """
+        self.client = client
+        self.root = root
+        self.max_workers = max_workers
+        self._locks: typing.Dict[typing.Tuple[str, str], threading.Lock] = dict()
+        self._locks_lock = threading.Lock()
+
+    def _folder(self, symbol: str, interval: str) -> str:
+        return os.path.join(self.root, symbol.upper(), interval)
+
+    def _lock(self, symbol: str, interval: str) -> threading.Lock:
+        with self._locks_lock:
+            return self._locks.setdefault((symbol.upper(), interval), threading.Lock())
+
+    def _read_meta(self, symbol: str, interval: str) -> dict:
+        path = os.path.join(self._folder(symbol, interval), "meta.json")
+        if not os.path.exists(path):
+            return dict()
+        with open(path) as file:
+            return json.load(file)
+
+    def _write_meta(self, symbol: str, interval: str, meta: dict):
+        path = os.path.join(self._folder(symbol, interval), "meta.json")
+        with open(path + ".tmp", "w") as file:
+            json.dump(meta, file)
+        os.replace(path + ".tmp", path)
+
+    def load(self, symbol: str, interval: str, mmap=True) -> typing.Optional[CandleSeries]:
+        """
+        :param mmap: memory-map the column files instead of reading them into RAM.
+        :return: every stored candle of (symbol, interval), None if nothing is stored.
+        """
+        folder = self._folder(symbol, interval)
+        if not os.path.exists(os.path.join(folder, "open_time.npy")):
+            return None
+        mode = "r" if mmap else None
+        columns = {name: np.load(os.path.join(folder, f"{name}.npy"), mmap_mode=mode) for name, _, _ in KLINE_COLUMNS}
+        # open_time's header is the last one updated by an append, an interrupted one leaves the others longer
+        count = len(columns["open_time"])
+        columns = {name: column[:count] for name, column in columns.items()}
+        return CandleSeries(columns, interval, symbol.upper())
+
+    def coverage(self, symbol: str, interval: str) -> typing.Optional[typing.Tuple[int, int]]:
+        """:return: (first open time, last open time) of the stored series, None if empty."""
+        stored = self.load(symbol, interval)
+        if stored is None or len(stored) == 0:
+            return None
+        return int(stored.open_time[0]), int(stored.open_time[-1])
+
+    def write(self, symbol: str, interval: str, klines: typing.List[list]):
+        """Merges raw klines into the stored series. Candles that have not closed yet are skipped."""
+        now = int(time.time() * 1000)
+        klines = [kline for kline in klines if kline[6] < now]
+        if not klines:
+            return
+        self.write_series(symbol, interval, CandleSeries.from_klines(klines, interval, symbol))
+
+    def write_series(self, symbol: str, interval: str, series: CandleSeries):
+        """
+        Merges a CandleSeries into the stored series. Candles that have not closed yet are skipped.
+        Candles that all open after the stored ones are appended to the column files; only a backfill or an overlap
+        rewrites them.
+        """
+        closed = series.close_time < int(time.time() * 1000)
+        new = {name: column[closed] for name, column in series.columns.items()}
+        if len(new["open_time"]) == 0:
+            return
+        # sorted, and the first of duplicate open times wins like in the merge below
+        _, keep = np.unique(new["open_time"], return_index=True)
+        new = {name: column[keep] for name, column in new.items()}
+        tail = self.load(symbol, interval)
+        if tail is not None and (len(tail) == 0 or new["open_time"][0] > tail.open_time[-1]):
+            count = len(tail)
+            del tail    # the memory maps are closed before the files are written
+            if self._append(symbol, interval, count, new):
+                return
+        stored = self.load(symbol, interval, mmap=False)
+        if stored is not None:
+            stored = stored.columns
+            # unique keeps the first occurrence, so new rows go first to win over stored ones
+            open_time = np.concatenate([new["open_time"], stored["open_time"]])
+            _, keep = np.unique(open_time, return_index=True)
+            merged = {name: np.concatenate([new[name], stored[name]])[keep] for name, _, _ in KLINE_COLUMNS}
+        else:
+            merged = new
+
+        folder = self._folder(symbol, interval)
+        os.makedirs(folder, exist_ok=True)
+        for name, column in merged.items():
+            path = os.path.join(folder, f"{name}.npy")
+            with open(path + ".tmp", "wb") as file:
+                np.save(file, column)
+            os.replace(path + ".tmp", path)
+
+    def _append(self, symbol: str, interval: str, count: int, new: typing.Dict[str, np.ndarray]) -> bool:
+        """
+        Writes the new rows after the first count rows of every column file, then the headers with the new length,
+        open_time's last (load() trusts its length).
+        :return: False, without writing, if a header has no room for the new length.
+        """
+        folder = self._folder(symbol, interval)
+        names = [name for name, _, _ in KLINE_COLUMNS if name != "open_time"] + ["open_time"]
+        files = [open(os.path.join(folder, f"{name}.npy"), "r+b") for name in names]
+        try:
+            headers = list()
+            for name, file in zip(names, files):
+                offset, header, dtype = _npy_header(file, count + len(new[name]))
+                if len(header) != offset:
+                    return False
+                headers.append((header, offset + count * dtype.itemsize, dtype))
+            for name, file, (_, end, dtype) in zip(names, files, headers):
+                file.seek(end)
+                file.write(np.ascontiguousarray(new[name], dtype=dtype).tobytes())
+                file.truncate()
+                file.flush()
+            for file, (header, _, _) in zip(files, headers):
+                file.seek(0)
+                file.write(header)
+                file.flush()
+        finally:
+            for file in files:
+                file.close()
+        return True
+
+    def _download(self, contract: Contract, interval: str, start_time: int, end_time: int) -> bool:
+        downloader = KlineDownloader(self.client, max_workers=self.max_workers, checkpoint_dir=None)
+        klines = downloader.download(contract, interval, start_time, end_time)
+        if klines is None:
+            return False
+        self.write(contract.symbol, interval, klines)
+        return True
+
+    def get(self, contract: Contract, interval: str, start_time: int, end_time=None,
+            mmap=True) -> typing.Optional[CandleSeries]:
+        """
+        Candles of [start_time, end_time], downloading only what is not stored yet.
+        :param contract: Contract object of interested contract.
+        :param interval: key of TIME_ENUM_CONVERSION
+        :param start_time: timestamp in ms
+        :param end_time: timestamp in ms, None for up to now.
+        :param mmap: return memory-mapped slices instead of arrays in RAM.
+        :return: CandleSeries view of the range, None if nothing could be stored for it.
+        """
+        step = TIME_ENUM_CONVERSION[interval] * 60 * 1000
+        now = int(time.time() * 1000)
+        end_time = now if end_time is None else min(int(end_time), now)
+        start_time = int(start_time)
+
+        if self.client is not None:
+            with self._lock(contract.symbol, interval):
+                meta = self._read_meta(contract.symbol, interval)
+                span = self.coverage(contract.symbol, interval)
+                if span is None:
+                    if self._download(contract, interval, start_time, end_time):
+                        meta["checked_from"] = start_time
+                else:
+                    first_open, last_open = span
+                    # Before the listing date there is nothing to download, checked_from remembers that.
+                    if start_time < first_open and start_time < meta.get("checked_from", first_open):
+                        if self._download(contract, interval, start_time, first_open - 1):
+                            meta["checked_from"] = start_time
+                    # The next candle is only worth asking for once it has closed.
+                    next_open = last_open + step
+                    if next_open + step - 1 < end_time:
+                        self._download(contract, interval, next_open, end_time)
+                if self.coverage(contract.symbol, interval) is not None:
+                    self._write_meta(contract.symbol, interval, meta)
+
+        stored = self.load(contract.symbol, interval, mmap=mmap)
+        if stored is None:
+            return None
+        return stored.between(start_time, end_time)
+
+
+if __name__ == '__main__':
+    # Cold vs warm load of a month of 1m candles against the local exchange stand-in.
+    import tempfile
+    from connectors.local_exchange import LocalExchange
+    from connectors.http_transport import HttpTransport
+
+    def continuous_klines(method, params):
+        start, end = int(params['startTime']), int(params['endTime'])
+        klines = list()
+        for open_time in range(start - start % 60000, end + 1, 60000)[:int(params['limit'])]:
+            klines.append([open_time, "100.0", "101.0", "99.0", "100.5", "12.5", open_time + 59999, "1250.0", 42,
+                           "6.0", "600.0", "0"])
+        return 200, klines, dict()
+
+    class LocalClient:
+        def __init__(self, base_url):
+            self.transport = HttpTransport(base_url)
+            self.rest_calls = 0
+
+        def make_request(self, method, endpoint, params, priority=None):
+            self.rest_calls += 1
+            return self.transport.request(method, endpoint, params).json()
+
+    with LocalExchange() as exchange:
+        exchange.add_route("GET", "/fapi/v1/continuousKlines", continuous_klines)
+        client = LocalClient(exchange.base_url)
+        store = CandleStore(client, root=tempfile.mkdtemp())
+        btcusdt = Contract("", dict())
+        btcusdt.symbol = "BTCUSDT"
+        end = int(time.time() * 1000) // 60000 * 60000
+        begin = end - 30 * 24 * 60 * 60 * 1000
+
+        for label in ("cold", "warm"):
+            calls_before = client.rest_calls
+            ts = time.perf_counter()
+            series = store.get(btcusdt, "1m", begin, end)
+            print(f"{label}: {len(series)} candles in {(time.perf_counter() - ts) * 1000:.2f} ms,"
+                  f" {client.rest_calls - calls_before} REST calls")
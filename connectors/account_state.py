@@ -0,0 +1,338 @@
+import collections
+import logging
+import threading
+import time
+import typing
+
+import logkeeper
+from models import Order, Position, Wallet
+from connectors.stream_manager import StreamConnection
+
+logger = logging.getLogger("account_state.py")
+logkeeper.log_keeper("connectors.log", "account_state.py")
+
+OPEN_STATUSES = ("NEW", "PARTIALLY_FILLED")
+
+
+def order_from_event(o: dict) -> Order:
+    """Order from the 'o' object of an ORDER_TRADE_UPDATE event."""
+    return Order("binance_futures", {'avgPrice': o['ap'], 'orderId': o['i'], 'executedQty': o['z'],
+                                     'origQty': o['q'], 'origType': o['ot'], 'price': o['p'], 'side': o['S'],
+                                     'status': o['X'], 'stopPrice': o['sp'], 'symbol': o['s'],
+                                     'updateTime': o['T'], 'timeInForce': o['f']})
+
+
+class AccountState:
+    """
+    Orders, positions and balances kept in memory from the user data stream (ORDER_TRADE_UPDATE, ACCOUNT_UPDATE,
+    MARGIN_CALL). REST is only used to load the state when the stream (re)connects and for a periodic drift check,
+    so reading positions and open orders is a dict lookup instead of a weighted request.
+    """
+    def __init__(self, client, keepalive_interval=30 * 60, drift_check_interval=10 * 60, closed_orders_kept=1000,
+                 on_margin_call: typing.Optional[typing.Callable[[dict], None]] = None):
+        """
+        :param client: BinanceFuturesClient
+        :param keepalive_interval: seconds between listen key keepalives, the key expires after 60 minutes.
+        :param drift_check_interval: seconds between REST comparisons of the local state, 0 to disable.
+        :param closed_orders_kept: finished orders remembered in closed_orders.
+        :param on_margin_call: called with every MARGIN_CALL event.
+        """
+        self.client = client
+        self.keepalive_interval = keepalive_interval
+        self.drift_check_interval = drift_check_interval
+        self.on_margin_call = on_margin_call
+        self.open_orders: typing.Dict[int, Order] = dict()
+        self.closed_orders: typing.Dict[int, Order] = collections.OrderedDict()
+        self.closed_orders_kept = closed_orders_kept
+        self.positions: typing.Dict[typing.Tuple[str, str], Position] = dict()
+        self.wallet: typing.Optional[Wallet] = None
+        # symbol -> margin asset, from ACCOUNT_UPDATE positions (client.contracts otherwise)
+        self._margin_assets: typing.Dict[str, str] = dict()
+        self.margin_calls: typing.List[dict] = list()
+        self.is_synced = False
+        self.events_applied = 0
+        self.drift_corrections = 0
+        self.listen_key = ""
+        self._connection: typing.Optional[StreamConnection] = None
+        self._lock = threading.RLock()
+        self._running = False
+
+    def attach(self, dispatcher):
+        dispatcher.register("ORDER_TRADE_UPDATE", self.on_order_update)
+        dispatcher.register("ACCOUNT_UPDATE", self.on_account_update)
+        dispatcher.register("MARGIN_CALL", self.on_margin_call_event)
+        dispatcher.register("listenKeyExpired", lambda event: self.renew_listen_key())
+
+    def start(self, listen_key: str):
+        """Connects the user data stream. The state is loaded from REST once the socket is open."""
+        if not listen_key:
+            logger.error("Account State | No listen key, the user data stream is not started.")
+            return
+        self._running = True
+        self._connect(listen_key)
+        threading.Thread(target=self._maintenance_loop, daemon=True).start()
+
+    def stop(self):
+        self._running = False
+        if self._connection is not None:
+            self._connection.stop()
+
+    def _connect(self, listen_key: str):
+        if self._connection is not None:
+            self._connection.stop()
+        self.listen_key = listen_key
+        self.is_synced = False
+        self._connection = StreamConnection(0, self.client._wss_root, self.client.on_message, on_open=self._on_open,
+                                            on_error=self.client.on_error)
+        self._connection.add([listen_key])
+        self._connection.start()
+
+    def _on_open(self, ws):
+        # events missed while disconnected are only visible through REST
+        threading.Thread(target=self.reconcile, daemon=True).start()
+
+    def renew_listen_key(self):
+        key = self.client.get_listen_key()
+        if key:
+            logger.warning("Account State | Listen key renewed, reconnecting the user data stream.")
+            self.client.listen_key = key
+            self._connect(key)
+
+    def _maintenance_loop(self):
+        last_keepalive = last_drift_check = time.time()
+        while self._running:
+            time.sleep(1)
+            now = time.time()
+            if now - last_keepalive >= self.keepalive_interval:
+                last_keepalive = now
+                if not self.client.keep_alive_listen_key():
+                    self.renew_listen_key()
+            if self.drift_check_interval and now - last_drift_check >= self.drift_check_interval:
+                last_drift_check = now
+                self.reconcile()
+
+    def reconcile(self) -> int:
+        """
+        Replaces the local state with REST data, except entries the stream updated after the REST calls started.
+        :return: number of orders and positions that differed, -1 if REST failed.
+        """
+        started = int(time.time() * 1000)
+        orders = self.client.get_all_open_orders(use_cache=False)
+        positions = self.client.get_positions(use_cache=False)
+        wallet = self.client.get_balances(use_cache=False)
+        if orders is None or positions is None or wallet is None:
+            logger.error("Account State | Reconcile failed, REST data incomplete.")
+            return -1
+        with self._lock:
+            rest_orders = {order.order_id: order for order in orders}
+            rest_positions = {(position.symbol, position.side): position for position in positions}
+            differences = 0
+            for order_id, order in self.open_orders.items():
+                if order.order_time_ts > started:
+                    rest_orders[order_id] = order
+                elif order_id not in rest_orders:
+                    differences += 1
+            for order_id, order in list(rest_orders.items()):
+                if order_id in self.closed_orders and self.closed_orders[order_id].order_time_ts > started:
+                    del rest_orders[order_id]
+                elif order_id not in self.open_orders:
+                    differences += 1
+            for key, position in self.positions.items():
+                if position.update_time_ts > started:
+                    rest_positions[key] = position
+                elif key not in rest_positions or rest_positions[key].amount != position.amount:
+                    differences += 1
+            self.open_orders = rest_orders
+            self.positions = rest_positions
+            # like positions: balances the stream updated after the REST calls started are kept
+            carried = False
+            if self.wallet is not None:
+                for name, asset in self.wallet.asset_info.items():
+                    if asset.get('update_time', 0) > started:
+                        wallet.asset_info[name] = asset
+                        carried = True
+            for asset in wallet.asset_info.values():
+                asset.setdefault('update_time', started)
+            self.wallet = wallet
+            if carried:
+                self._sum_wallet_totals()
+            if self.is_synced and differences:
+                self.drift_corrections += differences
+                logger.warning("Account State | %s differences with REST corrected.", differences)
+            self.is_synced = True
+        logger.info("Account State | Synced: %s open orders, %s positions.", len(self.open_orders),
+                    len(self.positions))
+        return differences
+
+    def on_order_update(self, event: dict):
+        o = event['o']
+        order_id = o['i']
+        with self._lock:
+            known = self.open_orders.get(order_id) or self.closed_orders.get(order_id)
+            if known is not None and known.order_time_ts > o['T']:
+                return  # older than what we have, i.e. replayed by a reconnect
+            order = order_from_event(o)
+            if o['X'] in OPEN_STATUSES:
+                self.open_orders[order_id] = order
+            else:
+                self.open_orders.pop(order_id, None)
+                self.closed_orders[order_id] = order
+                if len(self.closed_orders) > self.closed_orders_kept:
+                    self.closed_orders.popitem(last=False)
+            self.events_applied += 1
+
+    def on_account_update(self, event: dict):
+        update = event['a']
+        event_time = event['E']
+        with self._lock:
+            for p in update['P']:
+                key = (p['s'], p['ps'])
+                if 'ma' in p:
+                    self._margin_assets[p['s']] = p['ma']
+                position = self.positions.get(key)
+                if position is None:
+                    position = Position("binance_futures", {'symbol': p['s'], 'entryPrice': p['ep'],
+                                                            'marginType': p['mt'], 'leverage': 0,
+                                                            'liquidationPrice': 0, 'markPrice': p['ep'],
+                                                            'positionAmt': p['pa'], 'positionSide': p['ps'],
+                                                            'unRealizedProfit': p['up'], 'updateTime': event_time})
+                    self.positions[key] = position
+                elif position.update_time_ts > event_time:
+                    continue
+                position.entry_price = float(p['ep'])
+                position.amount = float(p['pa'])
+                position.pnl = float(p['up'])
+                position.margin_type = p['mt']
+                position.is_open = position.amount != 0
+                position.update_time_ts = event_time
+            if self.wallet is not None:
+                self._apply_balances(update['B'], event_time)
+            self.events_applied += 1
+
+    def _apply_balances(self, balances: typing.List[dict], event_time: int):
+        """
+        Wallet balances of an ACCOUNT_UPDATE, skipped for assets already updated by a newer event or reconcile.
+        Available balances move with the wallet balance and unrealised PnL changes; that is an estimate (margin
+        held by new orders isn't in the event), the next reconcile makes it exact.
+        """
+        for balance in balances:
+            asset = self.wallet.asset_info.setdefault(balance['a'], {'available_balance': 0.0,
+                                                                     'wallet_balance': 0.0,
+                                                                     'unrealised_pnl': 0.0,
+                                                                     'required_margin': 0.0})
+            if asset.get('update_time', 0) > event_time:
+                continue
+            wallet_balance = float(balance['wb'])
+            asset['available_balance'] += wallet_balance - asset['wallet_balance']
+            asset['wallet_balance'] = wallet_balance
+            asset['cross_wallet_balance'] = float(balance['cw'])
+            asset['update_time'] = event_time
+        for name, pnl in self._unrealised_pnl().items():
+            asset = self.wallet.asset_info.get(name)
+            if asset is not None:
+                asset['available_balance'] += pnl - asset['unrealised_pnl']
+                asset['unrealised_pnl'] = pnl
+        self._sum_wallet_totals()
+
+    def _unrealised_pnl(self) -> typing.Dict[str, float]:
+        """Unrealised PnL of the known positions per margin asset."""
+        pnl = dict()
+        for (symbol, _), position in self.positions.items():
+            margin_asset = self._margin_assets.get(symbol)
+            if margin_asset is None:
+                contract = self.client.contracts.get(symbol)
+                if contract is None:
+                    continue
+                margin_asset = contract.margin_asset
+            pnl[margin_asset] = pnl.get(margin_asset, 0.0) + position.pnl
+        return pnl
+
+    def _sum_wallet_totals(self):
+        assets = self.wallet.asset_info.values()
+        self.wallet.total_balance = sum(asset['wallet_balance'] for asset in assets)
+        self.wallet.available_balance = sum(asset['available_balance'] for asset in assets)
+        self.wallet.total_unrealised_pnl = sum(asset['unrealised_pnl'] for asset in assets)
+        self.wallet.update_wallet_time()
+
+    def on_margin_call_event(self, event: dict):
+        logger.critical("Account State | Margin call, cross wallet balance %s, positions: %s", event.get('cw'),
+                        [(p['s'], p['pa'], p['mm']) for p in event['p']])
+        with self._lock:
+            self.margin_calls.append(event)
+            for p in event['p']:
+                position = self.positions.get((p['s'], p['ps']))
+                if position is not None:
+                    position.current_price = float(p['mp'])
+                    position.pnl = float(p['up'])
+        if self.on_margin_call is not None:
+            self.on_margin_call(event)
+
+    def get_open_orders(self, symbol: typing.Optional[str] = None) -> typing.List[Order]:
+        with self._lock:
+            return [order for order in self.open_orders.values() if symbol is None or order.symbol == symbol]
+
+    def get_positions(self, symbol: typing.Optional[str] = None) -> typing.List[Position]:
+        with self._lock:
+            return [position for (position_symbol, _), position in self.positions.items()
+                    if symbol is None or position_symbol == symbol]
+
+    def get_position(self, symbol: str, side="BOTH") -> typing.Optional[Position]:
+        return self.positions.get((symbol, side))
+
+
+if __name__ == '__main__':
+    # Reading positions/open orders: weighted REST call to a local stand-in vs the in-memory state,
+    # and how fast stream events are applied.
+    import json
+    import tempfile
+    from connectors.binance_futures import BinanceFuturesClient
+    from connectors.local_exchange import LocalExchange
+
+    position = {"symbol": "BTCUSDT", "entryPrice": "21000.0", "marginType": "cross", "leverage": "20",
+                "liquidationPrice": "0", "markPrice": "21010.0", "positionAmt": "0.010", "positionSide": "BOTH",
+                "unRealizedProfit": "0.1", "updateTime": 0}
+    open_order = {"avgPrice": "0", "orderId": 1, "executedQty": "0", "origQty": "0.010", "origType": "LIMIT",
+                  "price": "20000", "side": "BUY", "status": "NEW", "stopPrice": "0", "symbol": "BTCUSDT",
+                  "time": 0, "timeInForce": "GTC"}
+    account = {"assets": [], "availableBalance": "100.0", "totalWalletBalance": "100.0", "canDeposit": True,
+               "canTrade": True, "canWithdraw": True, "feeTier": 0, "totalPositionInitialMargin": "0",
+               "totalUnrealizedProfit": "0", "positions": []}
+
+    with LocalExchange() as exchange:
+        exchange.add_route("GET", "/fapi/v2/positionRisk", lambda method, params: (200, [position], {}))
+        exchange.add_route("GET", "/fapi/v1/openOrders", lambda method, params: (200, [open_order], {}))
+        exchange.add_route("GET", "/fapi/v2/account", lambda method, params: (200, account, {}))
+        exchange.add_route("GET", "/fapi/v1/exchangeInfo",
+                           lambda method, params: (200, {"assets": [], "rateLimits": [], "symbols": []}, {}))
+        exchange.add_route("GET", "/fapi/v1/leverageBracket", lambda method, params: (200, [], {}))
+        client = BinanceFuturesClient("key", "secret", testnet=True, base_url=exchange.base_url,
+                                      metadata_dir=tempfile.mkdtemp())
+        state = AccountState(client)
+        state.reconcile()
+
+        n = 20   # weight 45 per round (openOrders without symbol is 40), the rate limiter would pause beyond this
+        ts = time.perf_counter()
+        for _ in range(n):
+            client.get_positions(use_cache=False)
+            client.get_all_open_orders(use_cache=False)
+        rest = (time.perf_counter() - ts) / n
+
+    n = 100000
+    ts = time.perf_counter()
+    for _ in range(n):
+        state.get_position("BTCUSDT")
+        state.get_open_orders("BTCUSDT")
+    local = (time.perf_counter() - ts) / n
+
+    events = [json.loads(json.dumps({"e": "ORDER_TRADE_UPDATE", "E": i, "T": i, "o": {
+        "s": "BTCUSDT", "c": "x", "S": "BUY", "o": "LIMIT", "f": "GTC", "q": "0.010", "p": "20000", "ap": "0",
+        "sp": "0", "x": "NEW", "X": "NEW" if i % 2 else "CANCELED", "i": 10 + i // 2, "l": "0", "z": "0", "L": "0",
+        "T": i, "ot": "LIMIT", "ps": "BOTH"}})) for i in range(n)]
+    ts = time.perf_counter()
+    for event in events:
+        state.on_order_update(event)
+    applied = n / (time.perf_counter() - ts)
+
+    print(f"positions + open orders over REST: {rest * 1e6:10.1f} us (weight 45, local stand-in)")
+    print(f"positions + open orders in memory: {local * 1e6:10.2f} us")
+    print(f"ORDER_TRADE_UPDATE events applied: {applied:,.0f}/s")
@@ -0,0 +1,240 @@
+import json
+import logging
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+import logkeeper
+from models import Order
+from connectors.retry import new_client_order_id, error_code, is_unknown_outcome, DUPLICATE_CLIENT_ORDER_ID
+
+logger = logging.getLogger("batch_orders.py")
+logkeeper.log_keeper("connectors.log", "batch_orders.py")
+
+MAX_BATCH_PLACE = 5     # orders per POST /fapi/v1/batchOrders
+MAX_BATCH_CANCEL = 10   # order ids per DELETE /fapi/v1/batchOrders
+MAX_PLACE_ROUNDS = 2    # sends of a chunk, the second one only with the orders the exchange confirms it lacks
+
+
+class OrderResult:
+    """Outcome of one order inside a batch: the Order on success, the exchange's code and message otherwise."""
+    __slots__ = ("request", "order", "code", "msg")
+
+    def __init__(self, request: dict, order: typing.Optional[Order] = None, code: typing.Optional[int] = None,
+                 msg: str = ""):
+        self.request = request
+        self.order = order
+        self.code = code
+        self.msg = msg
+
+    @property
+    def ok(self) -> bool:
+        return self.order is not None
+
+    def __repr__(self):
+        if self.ok:
+            return f"OrderResult(ok, {self.order.symbol} id:{self.order.order_id} {self.order.status})"
+        return f"OrderResult(failed, {self.request.get('symbol')} code:{self.code} {self.msg})"
+
+
+def _param(value) -> str:
+    """Order parameters are sent as strings, booleans (reduceOnly, closePosition...) as true/false."""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value)
+
+
+def _results(requests: typing.List[dict], response: typing.Optional[list], code: typing.Optional[int] = None,
+             msg="batch request failed") -> typing.List[OrderResult]:
+    if response is None:
+        # the whole request was refused: every order gets the exchange's code and message
+        return [OrderResult(request, code=code, msg=msg) for request in requests]
+    results = list()
+    for request, item in zip(requests, response):
+        if 'code' in item and 'orderId' not in item:
+            results.append(OrderResult(request, code=item['code'], msg=item.get('msg', "")))
+        else:
+            results.append(OrderResult(request, Order("binance_futures", item)))
+    return results
+
+
+class BatchOrderExecutor:
+    """
+    Places and cancels many orders through /fapi/v1/batchOrders. Requests are split into chunks of the endpoint's
+    maximum size, chunks are sent concurrently and the results come back in the order they were requested.
+    """
+    def __init__(self, client, max_workers=4):
+        """
+        :param client: BinanceFuturesClient (make_request and the client order id lookups are used)
+        :param max_workers: chunks in flight at the same time.
+        """
+        self.client = client
+        self.max_workers = max_workers
+
+    def _send(self, method: str, params: dict) -> typing.Tuple[typing.Optional[list], typing.Optional[int], str, bool]:
+        """
+        :return: (per-order answers, None, "", False) on success, (None, code, msg, False) if the exchange refused
+        the whole batch, (None, None, reason, True) if it may or may not have executed it.
+        """
+        response, error = self.client._request(method, "/fapi/v1/batchOrders", params)
+        if response is None and error is None:
+            return None, None, "not sent, no room under the rate limit", False
+        if response is not None and self.client.is_request_good(response, method):
+            return response.json(), None, "", False
+        if is_unknown_outcome(response, error):
+            return None, None, "batch request failed", True
+        try:
+            body = response.json()
+        except ValueError:
+            body = dict()
+        msg = body.get('msg', response.reason) if isinstance(body, dict) else response.reason
+        return None, error_code(response), msg, False
+
+    def _run(self, fn, chunks: list) -> typing.List[OrderResult]:
+        if len(chunks) == 1:
+            return fn(chunks[0])
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(chunks))) as executor:
+            return [result for chunk_results in executor.map(fn, chunks) for result in chunk_results]
+
+    def _place_chunk(self, orders: typing.List[dict]) -> typing.List[OrderResult]:
+        # copies, so templates placed again get new client order ids
+        orders = [dict(order) for order in orders]
+        for order in orders:
+            order.setdefault('newClientOrderId', new_client_order_id())
+        results: typing.List[typing.Optional[OrderResult]] = [None] * len(orders)
+        pending = list(range(len(orders)))
+        for _ in range(MAX_PLACE_ROUNDS):
+            batch = [orders[i] for i in pending]
+            params = {'batchOrders': json.dumps([{key: _param(value) for key, value in order.items()}
+                                                 for order in batch])}
+            response, code, msg, unknown = self._send("POST", params)
+            if not unknown:
+                for i, result in zip(pending, _results(batch, response, code, msg)):
+                    results[i] = result
+                    if result.code == DUPLICATE_CLIENT_ORDER_ID:
+                        # open already, placed by an earlier round whose answer was lost
+                        found = self.client.get_order_by_client_id(result.request['symbol'],
+                                                                   result.request['newClientOrderId'])
+                        if found is not None:
+                            result.order, result.code, result.msg = Order("binance_futures", found), None, ""
+                break
+            # no answer: any of the orders may have been executed, only the ones the exchange doesn't have are
+            # sent again (a filled order's client id can be reused, a blind re-send would execute it twice)
+            missing = list()
+            for i in pending:
+                request = orders[i]
+                found, exists = self.client.lookup_client_order(request['symbol'], request['newClientOrderId'])
+                if exists:
+                    results[i] = OrderResult(request, Order("binance_futures", found))
+                elif exists is None:
+                    results[i] = OrderResult(request, msg="execution status unknown")
+                else:
+                    results[i] = OrderResult(request, msg="batch request failed")
+                    missing.append(i)
+            pending = missing
+            if not pending:
+                break
+        return results
+
+    def place(self, orders: typing.List[dict]) -> typing.List[OrderResult]:
+        """
+        :param orders: order parameters as /fapi/v1/order takes them, i.e. {'symbol', 'side', 'type', 'quantity', ...}
+        :return: one OrderResult per order, same order as requested.
+        """
+        if not orders:
+            return list()
+        chunks = [orders[i:i + MAX_BATCH_PLACE] for i in range(0, len(orders), MAX_BATCH_PLACE)]
+        results = self._run(self._place_chunk, chunks)
+        failed = sum(not result.ok for result in results)
+        if failed:
+            logger.error("Batch Orders | %s/%s orders rejected: %s", failed, len(results),
+                         {result.msg for result in results if not result.ok})
+        return results
+
+    def _cancel_chunk(self, chunk: typing.Tuple[str, typing.List[int]]) -> typing.List[OrderResult]:
+        symbol, order_ids = chunk
+        params = {'symbol': symbol, 'orderIdList': json.dumps(order_ids)}
+        response, code, msg, _ = self._send("DELETE", params)
+        return _results([{'symbol': symbol, 'orderId': order_id} for order_id in order_ids], response, code, msg)
+
+    def cancel(self, orders: typing.List[Order]) -> typing.List[OrderResult]:
+        """
+        Cancels orders of any symbols, grouped per symbol as the endpoint requires.
+        :return: one OrderResult per order, same order as requested.
+        """
+        by_symbol: typing.Dict[str, typing.List[int]] = dict()
+        for order in orders:
+            by_symbol.setdefault(order.symbol, list()).append(order.order_id)
+        chunks = [(symbol, ids[i:i + MAX_BATCH_CANCEL]) for symbol, ids in by_symbol.items()
+                  for i in range(0, len(ids), MAX_BATCH_CANCEL)]
+        if not chunks:
+            return list()
+        results = {(result.request['symbol'], result.request['orderId']): result
+                   for result in self._run(self._cancel_chunk, chunks)}
+        return [results[(order.symbol, order.order_id)] for order in orders]
+
+
+if __name__ == '__main__':
+    # 50 ladder orders with 20 ms of simulated round trip: one request per order vs concurrent batches of 5.
+    import itertools
+    import tempfile
+    import threading
+    import time
+    from connectors.binance_futures import BinanceFuturesClient
+    from connectors.local_exchange import LocalExchange
+
+    latency = 0.02
+    order_ids = itertools.count(1)
+    lock = threading.Lock()
+
+    def accept(order: dict) -> dict:
+        with lock:
+            order_id = next(order_ids)
+        if float(order['price']) <= 0:
+            return {"code": -4014, "msg": "Price not increased by tick size."}
+        return {"avgPrice": "0", "orderId": order_id, "executedQty": "0", "origQty": order['quantity'],
+                "origType": order['type'], "price": order['price'], "side": order['side'], "status": "NEW",
+                "stopPrice": "0", "symbol": order['symbol'], "updateTime": int(time.time() * 1000),
+                "timeInForce": order.get('timeInForce', "GTC")}
+
+    def single(method, params):
+        time.sleep(latency)
+        response = accept(params)
+        return (400, response, {}) if 'code' in response else (200, response, {})
+
+    def batch(method, params):
+        time.sleep(latency)
+        if method == "POST":
+            return 200, [accept(order) for order in json.loads(params['batchOrders'])], {}
+        return 200, [dict(accept({"symbol": params['symbol'], "price": "1", "quantity": "0", "type": "LIMIT",
+                                  "side": "BUY"}), orderId=order_id, status="CANCELED")
+                     for order_id in json.loads(params['orderIdList'])], {}
+
+    with LocalExchange() as exchange:
+        exchange.add_route("POST", "/fapi/v1/order", single)
+        exchange.add_route("*", "/fapi/v1/batchOrders", batch)
+        client = BinanceFuturesClient("key", "secret", testnet=True, base_url=exchange.base_url,
+                                      metadata_dir=tempfile.mkdtemp())
+        ladder = [{'symbol': "BTCUSDT", 'side': "BUY", 'type': "LIMIT", 'timeInForce': "GTC", 'quantity': 0.001,
+                   'price': 20000 - 10 * i} for i in range(50)]
+        ladder[7]['price'] = 0     # one rejected order
+
+        served = exchange.requests_served
+        ts = time.perf_counter()
+        singles = [client.make_request("POST", "/fapi/v1/order", dict(order)) for order in ladder]
+        single_time, single_requests = time.perf_counter() - ts, exchange.requests_served - served
+
+        served = exchange.requests_served
+        ts = time.perf_counter()
+        results = client.place_orders(ladder)
+        batch_time, batch_requests = time.perf_counter() - ts, exchange.requests_served - served
+
+        ts = time.perf_counter()
+        cancelled = client.cancel_orders([result.order for result in results if result.ok])
+        cancel_time = time.perf_counter() - ts
+
+    print(f"one by one: {single_time * 1000:7.1f} ms, {single_requests} requests,"
+          f" {sum(order is None for order in singles)} failed (reason only in the log)")
+    print(f"batched:    {batch_time * 1000:7.1f} ms, {batch_requests} requests,"
+          f" failed: {[result for result in results if not result.ok]}")
+    print(f"batch cancel of {len(cancelled)} orders: {cancel_time * 1000:.1f} ms,"
+          f" all canceled: {all(result.ok and result.order.status == 'CANCELED' for result in cancelled)}")
@@ -1,14 +1,29 @@
 import asyncio
-import json
-import pprint
+import os
 import time
-import requests
-import websocket
 import threading
+import requests
 from keys import *
 import logging
 import typing
-from models import Contract, Candle, Order, Wallet, Position
+from models import Contract, Candle, CandleSeries, Order, Wallet, Position
+from connectors.http_transport import HttpTransport
+from connectors.kline_downloader import KlineDownloader
+from connectors.metadata_cache import MetadataCache, METADATA_DIR
+from connectors.bootstrap import Bootstrap
+from connectors.account_state import AccountState
+from connectors.batch_orders import BatchOrderExecutor, OrderResult
+from connectors.retry import policy_for, is_retryable, is_unknown_outcome, error_code, new_client_order_id, \
+    DUPLICATE_CLIENT_ORDER_ID, ORDER_DOES_NOT_EXIST, ORDER_PLACEMENT
+from connectors.rate_limiter import RateLimiter, request_weight, order_count, default_priority, PRIORITY_ORDER
+from connectors.order_book import OrderBookManager, LocalOrderBook
+from connectors.candle_builder import CandleBuilder
+from connectors.stream_manager import StreamManager
+from connectors.ws_dispatch import MessageDispatcher, AggTrade, BookTicker
+from connectors.market_recorder import MarketRecorder, RECORD_DIR
+from connectors.depth_archive import DepthArchivePipeline, DEPTH_DIR
+from connectors.book_history import BookHistory
+from indicators import StreamingIndicator
 import hmac
 import hashlib
 from urllib.parse import urlencode
@@ -24,18 +39,35 @@ logkeeper.log_keeper("connectors.log", "binance_futures.py")
 
 
 class BinanceFuturesClient:
-    def __init__(self, public_key: str, secret_key: str, testnet: bool):
+    def __init__(self, public_key: str, secret_key: str, testnet: bool, pool_size=10, timeout=(3.05, 10.0),
+                 prewarm=False, wait_ready=True, base_url: typing.Optional[str] = None, metadata_dir=METADATA_DIR):
+        """
+        :param public_key: API key
+        :param secret_key: API secret
+        :param testnet: True for testnet urls
+        :param pool_size: number of kept-alive REST connections.
+        :param timeout: (connect, read) timeouts in seconds for every REST call.
+        :param prewarm: open the whole connection pool before the first requests are sent.
+        :param wait_ready: False returns before wallet, contracts and listen key are loaded, see self.bootstrap.
+        True waits for them and logs a critical error naming whatever failed to load (bootstrap.is_ready(name)).
+        :param base_url: overrides the REST url, i.e. a local stand-in.
+        :param metadata_dir: folder of the exchange metadata cache, None to keep it in memory only.
+        """
         if testnet:
             self._base_url = "https://testnet.binancefuture.com"
             self._wss_url = "wss://testnet.binancefuture.com/ws/"
+            self._wss_root = "wss://stream.binancefuture.com"
             self.connection_type = "Testnet"
         else:
             self._base_url = "https://fapi.binance.com"
             # self._base_url = "https://api.binance.com/sapi/v1"    # for depth level data only
             self._wss_url = "wss://fstream.binance.com/ws/"
+            self._wss_root = "wss://fstream.binance.com"
             self.connection_type = "Real Account"
+        if base_url is not None:
+            self._base_url = base_url
 
-        # TODO: Add paper trading option
+        # Paper trading: connectors/paper_trading.py has the same order/position/balance methods, matched locally.
 
         # API Request variables
         self.platform = "binance_futures"
@@ -43,6 +75,11 @@ class BinanceFuturesClient:
         self._secret_key = secret_key
         self._header = {"X-MBX-APIKEY": self._public_key}
         self.connection_trials = 0
+        self.transport = HttpTransport(self._base_url, self._header, pool_size=pool_size,
+                                       connect_timeout=timeout[0], read_timeout=timeout[1])
+        if prewarm:
+            self.transport.prewarm()
+        self.rate_limiter = RateLimiter()
 
         # Models variables
         self.candles = dict()
@@ -51,135 +88,187 @@ class BinanceFuturesClient:
         self.failed_orders = dict()
 
         #  Websocket variables
-        self.ws: websocket.WebSocketApp
         self.ws_id = 1
         self.is_ws_working = False
         self.subscriptions = dict()
+        # market streams are spread over several connections, see connectors/stream_manager.py
+        self.streams = StreamManager(self._wss_root, on_message=self.on_message, on_open=self.on_open,
+                                     on_error=self.on_error, on_close=self.on_close)
+
+        # Streaming indicators fed by kline events: {(symbol, interval): {name: StreamingIndicator}}
+        self.streaming_indicators = dict()
+        self.indicator_values = dict()
+        self.order_books = OrderBookManager(self.get_order_book_snapshot)
+        self.candle_builders: typing.Dict[str, CandleBuilder] = dict()
+        self.last_trades: typing.Dict[str, AggTrade] = dict()
+        self.book_tickers: typing.Dict[str, BookTicker] = dict()
+
+        # Decoding happens on the websocket thread, handlers run on the dispatcher's workers
+        self.dispatcher = MessageDispatcher()
+        self.dispatcher.register("aggTrade", self.on_agg_trade)
+        self.dispatcher.register("aggTrade", self.last_trades_update, AggTrade)
+        self.dispatcher.register("bookTicker", self.book_tickers_update, BookTicker)
+        self.dispatcher.register("depthUpdate", self.order_books.on_depth_event)
+        self.dispatcher.register("kline", lambda data: self.update_streaming_indicators(data['k']))
+        self.dispatcher.response_handler = self.on_response
+        # positions, orders and balances from the user data stream once the listen key is there
+        self.account = AccountState(self)
+        self.account.attach(self.dispatcher)
+        self.batch_orders = BatchOrderExecutor(self)
+        self.recorder: typing.Optional[MarketRecorder] = None
+        self.dispatcher.start()
 
         self.maker_commission = 0.02 / 100
         self.taker_commission = 0.04 / 100
+        # exchangeInfo/leverageBracket from disk when possible, refreshed in the background once stale
+        self.metadata = MetadataCache(self, f"binance_futures_{'testnet' if testnet else 'real'}", metadata_dir,
+                                      on_refresh=self._on_metadata_refresh)
+        self.contracts: typing.Dict[str, Contract] = dict()
+        self.wallet_info: typing.Optional[Wallet] = None
+        self.listen_key = ""
+
+        # Market streams need nothing from the account, so they open before the bootstrap calls return.
+        # bootstrap.wait("contracts") / bootstrap.on_ready("wallet", callback) for the rest.
+        self.start_ws()
+        self.bootstrap = Bootstrap()
+        self.bootstrap.add("wallet", self._load_wallet)
+        self.bootstrap.add("contracts", self._load_contracts)
+        self.bootstrap.add("user_stream", self._load_listen_key)
+        if wait_ready and not self.bootstrap.wait():
+            failed = [name for name in self.bootstrap.resources if not self.bootstrap.is_ready(name)]
+            logger.critical(f"Binance Futures Client | {self.connection_type} start-up incomplete, failed to load:"
+                            f" {', '.join(failed)}.")
+
+    # Loaders raise when nothing came back, so bootstrap.wait() and is_ready() report the failure.
+
+    def _load_wallet(self) -> Wallet:
         self.wallet_info = self.get_balances()
-        self.contracts = self.get_current_contracts()
-
-        try:
-            self.listen_key = self.get_listen_key()
-        except AttributeError:
-            self.listen_key = ""
-
-        t = threading.Thread(target=self.start_ws)
-        t.start()
+        if self.wallet_info is None:
+            raise ConnectionError("no account information")
+        return self.wallet_info
+
+    def _load_contracts(self) -> typing.Dict[str, Contract]:
+        contracts = self.get_current_contracts()
+        if not contracts:
+            raise ConnectionError("no exchange information")
+        self.contracts.update(contracts)
+        return self.contracts
+
+    def _load_listen_key(self) -> str:
+        self.listen_key = self.get_listen_key() or ""
+        self.account.start(self.listen_key)
+        if not self.listen_key:
+            raise ConnectionError("no listen key")
+        return self.listen_key
 
     def get_listen_key(self):
         response = self.make_request("POST", "/fapi/v1/listenKey", dict())
         if response is not None:
             key = response['listenKey']
             if key == self.listen_key:
-                response = self.make_request("PUT", "/fapi/v1/listenKey", dict())
-            logger.info(f"Binance Futures Client | Current listen key: {response['listenKey']}")
+                self.keep_alive_listen_key()
+            logger.info(f"Binance Futures Client | Current listen key: {key}")
             return key
         else:
             logger.error("Binance Futures Client | Unable to create a listenKey for user data stream. ")
             return response
 
+    def keep_alive_listen_key(self) -> bool:
+        """Extends the listen key's validity by 60 minutes. False if the key is gone and must be recreated."""
+        response = self.make_request("PUT", "/fapi/v1/listenKey", dict())
+        if response is None:
+            logger.error("Binance Futures Client | Listen key keepalive failed.")
+            return False
+        return True
+
     def start_ws(self):
-        while not self.is_ws_working:
-            self.ws = websocket.WebSocketApp(self._wss_url,
-                                             on_open=self.on_open,
-                                             on_message=self.on_message,
-                                             on_error=self.on_error,
-                                             on_close=self.on_close)
-            try:
-                self.ws.run_forever()
-            except Exception as e:
-                print(e)
-                time.sleep(1)
-                self.start_ws()
-        return None
+        """Opens the stream connections. Each one reconnects on its own with its subscriptions restored."""
+        self.streams.start()
+        self.is_ws_working = True
 
     def suscribe_channel(self, channel: str, symbols: typing.List[typing.Union[str, Contract]]):
         """
         Subscribe to desired websocket channels for desired symbol(s)
-        :param channel:
+        :param channel: i.e. aggTrade, bookTicker, depth@100ms, kline_1m
         :param symbols:
-        :return:
+        :return: id to unsubscribe with
         """
-        data = dict()
-        data['method'] = "SUBSCRIBE"
-        data['params'] = []
+        params = []
         for symbol in symbols:
             if isinstance(symbol, Contract):
                 symbol = symbol.symbol
             symbol = symbol.lower().strip()
-            data['params'].append(f"{symbol}@{channel}")
-        data['id'] = self.ws_id
-        try:
-            self.ws.send(json.dumps(data))
-            logger.info("Binance Futures Client | Websocket subbed to %s for %s channel", symbols, channel)
-        except Exception as e:
-            logger.error("Binance Futures Client | Websocket error while subscribing to %s %s updates: %s",
-                         len(symbols), channel, e)
-
-        self.subscriptions[self.ws_id] = data['params']
+            params.append(f"{symbol}@{channel}")
+        self.streams.subscribe(params)
+        logger.info("Binance Futures Client | Websocket subbed to %s symbols for %s channel", len(params), channel)
+
+        self.subscriptions[self.ws_id] = params
         self.ws_id += 1
         return self.ws_id-1
 
+    def suscribe_all_contracts(self, channel: str):
+        """Subscribes channel for every contract in self.contracts."""
+        return self.suscribe_channel(channel, list(self.contracts.values()))
+
     def unsub_channel(self, channel_id: int):
-        data = dict()
-        data['method'] = "UNSUBSCRIBE"
-        data['params'] = self.subscriptions[channel_id]
-        data["id"] = channel_id
-        try:
-            self.ws.send(json.dumps(data))
-            del self.subscriptions[channel_id]
-        except Exception as e:
-            logger.error("Binance Futures Client | Websocket error while unsubscribing to %s updates: %s",
-                         channel_id, e)
+        params = self.subscriptions.pop(channel_id, None)
+        if params is None:
+            logger.error("Binance Futures Client | No websocket subscription with id %s.", channel_id)
+            return
+        # streams still wanted by another subscription stay open
+        still_used = {stream for key, streams in self.subscriptions.items() if isinstance(key, int)
+                      for stream in streams}
+        self.streams.unsubscribe([stream for stream in params if stream not in still_used])
 
     def update_subscriptions(self):
-        data = dict()
-        data["method"] = "LIST_SUBSCRIPTIONS"
-        data["id"] = self.ws_id
-        self.ws_id += 1
-        try:
-            self.ws.send(json.dumps(data))
-        except Exception as e:
-            logger.error("Binance Futures Client | Websocket error while Sub List update: %s", e)
+        self.streams.broadcast("LIST_SUBSCRIPTIONS")
 
     def on_message(self, ws, msg):
-        data = json.loads(msg)
-        print("new message!")
-
-        if 'e' in data.keys():
-            if data['e'] == "aggTrade":
-                symbol = data['s']
-                time_in_ts = int(data['E'])
-                dtime = dt.datetime.fromtimestamp(int(time_in_ts / 1000)).strftime('%Y/%m/%d %H:%M:%S')
-                price = float(data['p'])
-                quantity = float(data['q'])
-                is_buyer_maker = bool(data['m'])
-                cost = price * quantity
-                print(f"{symbol} update {dtime}:: price:{price:,} quantity:{quantity:,} "
-                      f"{'filled' if is_buyer_maker else 'sold'} | COST: {cost:,.2f} $")
-
-            elif data['e'] == "bookTicker":
-                # TODO: fill for <symbol>@bookTicker
-                symbol = data['s']
-                time_in_ts = int(data['E'])
-                dtime = dt.datetime.fromtimestamp(int(time_in_ts / 1000)).strftime('%Y/%m/%d %H:%M:%S')
-                bid_price = data['b']
-                bid_quantity = data['B']
-                ask_price = data['a']
-                ask_quantity = data['A']
-                print(f"{symbol} update {dtime} :: bid:{bid_quantity} @ {bid_price} -- {ask_price} @ {ask_quantity}")
-
-            else:
-                pprint.pprint(data)
-
-        elif 'result' in data.keys():
-            if data['result'] is not None:
-                self.subscriptions["last_update"] = data['result']
-            else:
-                pprint.pprint(data)
+        self.dispatcher.dispatch(msg)
+
+    def on_response(self, data: dict):
+        if data.get('result') is not None:
+            self.subscriptions["last_update"] = data['result']
+        else:
+            logger.debug("Binance Futures Client | Websocket response: %s", data)
+
+    def on_agg_trade(self, data: dict):
+        builder = self.candle_builders.get(data['s'])
+        if builder is not None:
+            builder.on_agg_trade(data)
+
+    def last_trades_update(self, trade: AggTrade):
+        self.last_trades[trade.symbol] = trade
+
+    def book_tickers_update(self, ticker: BookTicker):
+        self.book_tickers[ticker.symbol] = ticker
+
+    def add_streaming_indicator(self, contract: Contract, interval: str, name: str, indicator: StreamingIndicator,
+                                history: typing.Optional[CandleSeries] = None):
+        """
+        Registers an incremental indicator updated from the <symbol>@kline_<interval> stream.
+        Subscribe to that channel separately, i.e. suscribe_channel(f"kline_{interval}", [contract]).
+        :param name: key of the value in self.indicator_values[(symbol, interval)]
+        :param indicator: one of the Streaming* classes of the indicators module.
+        :param history: closed candles to warm the indicator up with before live updates arrive.
+        """
+        if history is not None:
+            indicator.warm_up(history)
+        key = (contract.symbol, interval)
+        self.streaming_indicators.setdefault(key, dict())[name] = indicator
+        self.indicator_values.setdefault(key, dict())[name] = indicator.value
+
+    def update_streaming_indicators(self, kline: dict):
+        """Feeds a kline event to the registered indicators. Closed candles are committed, others only previewed."""
+        key = (kline['s'], kline['i'])
+        indicators = self.streaming_indicators.get(key)
+        if not indicators:
+            return
+        candle = Candle("binance_futures", [kline['t'], kline['o'], kline['h'], kline['l'], kline['c'], kline['v'],
+                                            kline['T'], kline['q'], kline['n']], kline['i'])
+        values = self.indicator_values[key]
+        for name, indicator in indicators.items():
+            values[name] = indicator.update(candle, closed=kline['x'])
 
     def on_error(self, ws, error):
         logger.info("Binance Futures Client | Websocket Error occurred: %s.", error)
@@ -191,6 +280,41 @@ class BinanceFuturesClient:
     def on_open(self, ws):
         logger.info("Binance Futures Client | Websocket Activated.")
         print("Opened connection")
+        if self.candle_builders:
+            # candles missed while disconnected come from REST, off the websocket thread
+            threading.Thread(target=self.reconcile_candle_builders, daemon=True).start()
+
+    def build_candles(self, contract: Contract, intervals: typing.Optional[typing.List[str]] = None,
+                      on_close: typing.Optional[typing.Callable[[str, str, Candle], None]] = None) -> CandleBuilder:
+        """
+        Builds candles of every timeframe from the aggTrade stream instead of polling klines over REST.
+        :param intervals: keys of TIME_ENUM_CONVERSION, defaults to all.
+        :param on_close: called with (symbol, interval, Candle) as soon as a candle closes.
+        """
+        builder = CandleBuilder(contract.symbol, intervals, on_close)
+        self.candle_builders[contract.symbol] = builder
+        builder.reconcile(self)
+        builder.start_timer()
+        self.suscribe_channel("aggTrade", [contract])
+        return builder
+
+    def record_market_data(self, contracts: typing.List[Contract], root=RECORD_DIR,
+                           channels=("aggTrade", "bookTicker", "depth@100ms")) -> MarketRecorder:
+        """
+        Writes the aggTrade, bookTicker and depth events of contracts to binary day segments under root,
+        see connectors/market_recorder.py. Replay them with MarketReplay(root).
+        """
+        if self.recorder is None:
+            self.recorder = MarketRecorder(root)
+            self.recorder.attach(self.dispatcher)
+            self.recorder.start()
+        for channel in channels:
+            self.suscribe_channel(channel, contracts)
+        return self.recorder
+
+    def reconcile_candle_builders(self):
+        for builder in list(self.candle_builders.values()):
+            builder.reconcile(self)
 
     def _get_signature(self, data: dict):
         """ HMAC SHA 256 signature provider"""
@@ -199,46 +323,129 @@ class BinanceFuturesClient:
         return hmac.new(key, payload, hashlib.sha256).hexdigest()
 
     def connection_check(self):
-        server_time = requests.get(self._base_url+"/fapi/v1/time")
+        server_time = self.transport.request("GET", "/fapi/v1/time")
         return server_time.json()
 
-    def make_request(self, method: str, endpoint: str, params: dict) -> typing.Union[dict, None]:
+    def make_request(self, method: str, endpoint: str, params: dict,
+                     priority: typing.Optional[int] = None) -> typing.Union[dict, None]:
         """
+        Transient failures (connection errors, timeouts, 5xx, 429, -1001/-1021) are retried with the endpoint's
+        RetryPolicy: exponential backoff with jitter, re-signed with a fresh timestamp, never past the deadline.
+        New orders get a newClientOrderId. After a failure that may have been executed (see is_unknown_outcome) an
+        order is looked up by that id and only sent again if the exchange answers that it doesn't exist; a batch is
+        not sent again here, BatchOrderExecutor checks its orders one by one.
         :param method: get/post/put/delete depending on documentation
         :param endpoint: depending on request type, will be copied from documentation.
         :param params: will be sent as a query string, pass dict() if not required.
+        :param priority: rate limiter priority (connectors.rate_limiter.PRIORITY_*), orders go first by default.
         :return:
         """
         method = method.strip().upper()
-        params['recvWindow'] = 5000
-        params['timestamp'] = int(time.time() * 1000)
-        params['signature'] = self._get_signature(params)
-        complete_url = self._base_url + endpoint
-        if method == "GET":
-            response = requests.get(complete_url, params, headers=self._header)
-        elif method == "POST":
-            response = requests.post(complete_url, params, headers=self._header)
-        elif method == "PUT":
-            response = requests.put(complete_url, params, headers=self._header)
-        else:   # DELETE
-            response = requests.delete(url=complete_url, params=params, headers=self._header)
-        code = response.status_code
-
-        if code // 100 == 5:
-            while self.connection_trials < 5:
-                logger.error(f"Binance Futures Client | Internal error... sending new request."
-                             f" {self.connection_trials}/5")
-                self.make_request(method, endpoint, params)
-                self.connection_trials += 1
-            logger.error(f"Binance Futures Client | 5 requests in a row returned {code} error code."
-                         f" Check server integrity.")
-
+        if method == "POST" and endpoint == "/fapi/v1/order" and 'newClientOrderId' not in params:
+            params['newClientOrderId'] = new_client_order_id()
+        response, error = self._request(method, endpoint, params, priority)
+        if response is not None and method == "POST" and endpoint == "/fapi/v1/order" and \
+                error_code(response) == DUPLICATE_CLIENT_ORDER_ID:
+            # the order is open already, placed by an attempt whose answer was lost
+            return self.get_order_by_client_id(params['symbol'], params['newClientOrderId'])
+        if response is None:
+            return None
         if self.is_request_good(response, method):
-            self.connection_trials = 0
             return response.json()
         else:
             return None
 
+    def _request(self, method: str, endpoint: str, params: dict, priority: typing.Optional[int] = None) \
+            -> typing.Tuple[typing.Optional[requests.Response], typing.Optional[Exception]]:
+        """The retry loop of make_request. :return: the last response (None if none came) and exception."""
+        if priority is None:
+            priority = default_priority(method, endpoint)
+        placing = (method, endpoint) in ORDER_PLACEMENT
+        policy = policy_for(method, endpoint)
+        deadline = time.monotonic() + policy.deadline
+        weight = request_weight(method, endpoint, params)
+        orders = order_count(method, endpoint, params)
+        attempt = 0
+        response, error = None, None
+        while True:
+            attempt += 1
+            # waits here, before signing, so a long wait can't push the timestamp out of recvWindow.
+            # Orders must go out before their deadline; other calls may wait for room as long as it takes.
+            queue_timeout = deadline - time.monotonic() if priority == PRIORITY_ORDER else None
+            if self.rate_limiter.acquire(weight, orders, priority, timeout=queue_timeout) is None:
+                logger.error(f"Binance Futures Client | {method} {endpoint} dropped, rate limit leaves no room before"
+                             f" the {policy.deadline}s deadline.")
+                break
+            if attempt == 1 and priority != PRIORITY_ORDER:
+                deadline = time.monotonic() + policy.deadline
+            signed = dict(params)
+            signed['recvWindow'] = 5000
+            signed['timestamp'] = int(time.time() * 1000)
+            signed['signature'] = self._get_signature(signed)
+            remaining = max(deadline - time.monotonic(), 0.1)
+            timeout = (min(self.transport.timeout[0], remaining), min(self.transport.timeout[1], remaining))
+            response, error = None, None
+            sent_at = time.time()
+            try:
+                response = self.transport.request(method, endpoint, signed, timeout=timeout)
+                self.rate_limiter.update(response.headers, response.status_code, sent_at)
+            except requests.RequestException as e:
+                error = e
+            if not is_retryable(response, error):
+                break
+            if placing and is_unknown_outcome(response, error):
+                if endpoint == "/fapi/v1/batchOrders":
+                    break
+                found, exists = self._find_client_order(params['symbol'], params['newClientOrderId'])
+                if exists:
+                    logger.info(f"Binance Futures Client | Order {params['newClientOrderId']} was placed although"
+                                f" attempt {attempt} failed.")
+                    return found, None
+                if exists is None:
+                    logger.error(f"Binance Futures Client | Order {params['newClientOrderId']} execution status"
+                                 f" unknown, not sent again: {error if error is not None else response.status_code}")
+                    break
+                # the exchange doesn't have it (-2013): sending it again can't execute it twice
+            delay = max(policy.delay(attempt), self.rate_limiter.banned_until - time.time())
+            if attempt >= policy.max_attempts or time.monotonic() + delay >= deadline:
+                logger.error(f"Binance Futures Client | {method} {endpoint} still failing after {attempt} attempts:"
+                             f" {error if error is not None else response.status_code}")
+                break
+            logger.warning(f"Binance Futures Client | {method} {endpoint} attempt {attempt} failed"
+                           f" ({error if error is not None else response.status_code}), retrying in {delay:.2f}s.")
+            time.sleep(delay)
+        return response, error
+
+    def _find_client_order(self, symbol: str, client_order_id: str) \
+            -> typing.Tuple[typing.Optional[requests.Response], typing.Optional[bool]]:
+        """
+        :return: (the GET /fapi/v1/order response, True) if the exchange has the order, (None, False) if it answers
+        that the order doesn't exist, (None, None) if that can't be told.
+        """
+        response, _ = self._request("GET", "/fapi/v1/order", {'symbol': symbol, 'origClientOrderId': client_order_id},
+                                    PRIORITY_ORDER)
+        if response is not None and response.status_code == 200:
+            return response, True
+        if response is not None and error_code(response) == ORDER_DOES_NOT_EXIST:
+            return None, False
+        return None, None
+
+    def lookup_client_order(self, symbol: str, client_order_id: str) -> typing.Tuple[typing.Optional[dict],
+                                                                                     typing.Optional[bool]]:
+        """
+        Whether an order sent with newClientOrderId reached the exchange.
+        :return: (order, True) if it did, (None, False) if the exchange says it doesn't exist, (None, None) if unknown.
+        """
+        response, exists = self._find_client_order(symbol, client_order_id)
+        return (response.json() if exists else None), exists
+
+    def get_order_by_client_id(self, symbol: str, client_order_id: str) -> typing.Optional[dict]:
+        """Looks up an order by the newClientOrderId it was sent with, None if the exchange doesn't know it."""
+        order = self.make_request("GET", "/fapi/v1/order", {'symbol': symbol, 'origClientOrderId': client_order_id})
+        if order is not None:
+            logger.info(f"Binance Futures Client | Order {client_order_id} found after retries: {order['status']}")
+        return order
+
     def is_request_good(self, response, method) -> bool:
         """
         Helper function for make_xx_request() functions. determines reason should there be an error.
@@ -278,7 +485,10 @@ class BinanceFuturesClient:
             print("Binance Futures Client | API Connection Failure. ")
             logger.error("Binance Futures Client | API Connection Failure. ")
 
-    def get_balances(self):
+    def get_balances(self, use_cache=True):
+        """:param use_cache: return the wallet kept by the user data stream when it is synced."""
+        if use_cache and self.account.is_synced:
+            return self.account.wallet
         endpoint = "/fapi/v2/account"
         method = "GET"
         balance = self.make_request(method, endpoint, dict())
@@ -286,35 +496,39 @@ class BinanceFuturesClient:
             return Wallet("binance_futures", balance)
 
     def get_current_commissions(self, contract: Contract):
-        endpoint = "/fapi/v1/commissionRate"
-        method = "GET"
-        params = dict()
-        params['symbol'] = contract.symbol
-        commissions = self.make_request(method, endpoint, params)
+        """Sets maker/taker commissions for contract, from the metadata cache if they were fetched before."""
+        commissions = self.metadata.commission(contract.symbol)
         if commissions is not None:
-            self.maker_commission = float(commissions["makerCommissionRate"])
-            self.taker_commission = float(commissions["takerCommissionRate"])
+            self.maker_commission, self.taker_commission = commissions
+            return commissions
 
     def get_base_assets(self) -> list:
-        exchange_info = self.make_request("GET", "/fapi/v1/exchangeInfo", dict())
-        assets = [asset['asset'] for asset in exchange_info['assets']]
-        return assets
+        self.metadata.ensure()
+        return self.metadata.assets
 
     def get_current_contracts(self) -> typing.Dict[str, Contract]:
-        exchange_info = self.make_request("GET", "/fapi/v1/exchangeInfo", dict())
-        leverage_finder = self.make_request("GET", "/fapi/v1/leverageBracket", dict())
-        assets = self.get_base_assets()
-        contract_dict = dict()
-        for contract in exchange_info['symbols']:
-            if contract['contractType'] == "PERPETUAL" and contract['status'] == "TRADING" \
-                    and contract['quoteAsset'] in assets:
-                symbol = contract['symbol']
-                for each in leverage_finder:
-                    if each['symbol'] == symbol:
-                        contract['leverage'] = each["brackets"][0]['initialLeverage']
-                contract_dict[symbol] = Contract("binance_futures", contract)
-        if contract_dict is not None:
-            return contract_dict
+        if not self.metadata.ensure():
+            return dict()
+        return self.metadata.contracts()
+
+    def _on_metadata_refresh(self, metadata: MetadataCache):
+        """
+        Runs on the refresh thread while strategies read self.contracts. The dict is never emptied and a known
+        symbol keeps its Contract object, updated field by field, so references held elsewhere see the new
+        filters; delisted symbols are dropped after the new ones are in.
+        """
+        contracts = metadata.contracts()
+        if not contracts:
+            return
+        for symbol, contract in contracts.items():
+            current = self.contracts.get(symbol)
+            if current is None:
+                self.contracts[symbol] = contract
+                continue
+            for attribute in Contract.__slots__:
+                setattr(current, attribute, getattr(contract, attribute))
+        for symbol in [symbol for symbol in list(self.contracts) if symbol not in contracts]:
+            self.contracts.pop(symbol, None)
 
     def get_candle_update(self, contract: Contract, timeframe="1d", limit=1):
         endpoint = "/fapi/v1/continuousKlines"
@@ -324,6 +538,25 @@ class BinanceFuturesClient:
             for each in interval_info:
                 return Candle("binance_futures", each, timeframe)
 
+    def get_order_book_snapshot(self, symbol: str, limit=1000) -> typing.Optional[dict]:
+        """
+        REST depth snapshot used to sync local order books.
+        :param limit: 5, 10, 20, 50, 100, 500 or 1000 levels per side.
+        """
+        snapshot = self.make_request("GET", "/fapi/v1/depth", {'symbol': symbol, 'limit': limit})
+        if snapshot is None:
+            logger.error(f"Binance Futures Client | Order book snapshot failed for {symbol}.")
+        return snapshot
+
+    def watch_order_book(self, contract: Contract, speed="100ms") -> LocalOrderBook:
+        """
+        Starts a local order book for the contract from the diff-depth stream. The returned book syncs itself in the
+        background, check book.is_synced before reading it.
+        """
+        book = self.order_books.add(contract.symbol)
+        self.suscribe_channel(f"depth@{speed}", [contract])
+        return book
+
     def get_price_update(self, contract: Contract, count=1) -> dict:
         endpoint = "/fapi/v1/trades"
         params = {'symbol': contract.symbol, 'limit': count}
@@ -488,7 +721,10 @@ class BinanceFuturesClient:
         if open_order:
             return Order("binance_futures", open_order)
 
-    def get_all_open_orders(self, contract=None) -> typing.Union[None, typing.List[Order]]:
+    def get_all_open_orders(self, contract=None, use_cache=True) -> typing.Union[None, typing.List[Order]]:
+        """:param use_cache: answer from the user data stream state when it is synced, no request is sent."""
+        if use_cache and self.account.is_synced:
+            return self.account.get_open_orders(contract.symbol if contract is not None else None)
         endpoint = "/fapi/v1/openOrders"
         method = "GET"
         params = dict()
@@ -506,7 +742,10 @@ class BinanceFuturesClient:
         else:
             return None
 
-    def get_positions(self, contract=None) -> typing.Optional[typing.List[Position]]:
+    def get_positions(self, contract=None, use_cache=True) -> typing.Optional[typing.List[Position]]:
+        """:param use_cache: answer from the user data stream state when it is synced, no request is sent."""
+        if use_cache and self.account.is_synced:
+            return self.account.get_positions(contract.symbol if contract is not None else None)
         endpoint = "/fapi/v2/positionRisk"
         method = "GET"
         params = dict()
@@ -548,10 +787,37 @@ class BinanceFuturesClient:
         else:
             logger.error(f"Binance Futures Client | {order.symbol} order id:{order.order_id} cancel FAILED.")
 
+    def place_orders(self, orders: typing.List[dict]) -> typing.List[OrderResult]:
+        """
+        Places many orders with /fapi/v1/batchOrders, 5 per request and the requests concurrently.
+        :param orders: /fapi/v1/order parameters, i.e. {'symbol': "BTCUSDT", 'side': "BUY", 'type': "LIMIT", ...}
+        :return: OrderResult per order in the same order; failed ones carry the exchange's code and msg.
+        """
+        return self.batch_orders.place(orders)
+
+    def place_limit_orders(self, orders: typing.List[typing.Tuple[Contract, float, str, float]],
+                           tif="GTC") -> typing.List[OrderResult]:
+        """
+        Batch version of place_limit_order, i.e. for grids and ladders.
+        :param orders: list of (contract, amount, side, price)
+        """
+        params = list()
+        for contract, amount, side, price in orders:
+            while amount * price < 10:
+                amount += contract.lot_size
+            params.append({'symbol': contract.symbol, 'side': side.strip().upper(), 'type': "LIMIT",
+                           'timeInForce': tif, 'quantity': round(amount, contract.quantity_precision),
+                           'price': round(price, contract.price_precision)})
+        return self.place_orders(params)
+
+    def cancel_orders(self, orders: typing.List[Order]) -> typing.List[OrderResult]:
+        """Cancels many orders with the batch endpoint, up to 10 ids of one symbol per request."""
+        return self.batch_orders.cancel(orders)
+
     def get_historical_data(self, contract: Contract, interval: str, limit=500, start_time=None, end_time=None,
-                            is_timestamp=True) -> typing.Union[None, typing.Dict[str, typing.List[Candle]]]:
+                            is_timestamp=True) -> typing.Union[None, typing.Dict[str, CandleSeries]]:
         """
-        Get historical candles as Candle object list.
+        Get historical candles as a CandleSeries.
         :param contract: Contract object of interested contract.
         :param interval: m -> minutes; h -> hours; d -> days; w -> weeks; M -> months
                         1m, 3m, 5m, 15m, 30m, 1h, 2h, 4h, 6h, 8h, 12h, 1d, 3d, 1w, 1M
@@ -559,8 +825,8 @@ class BinanceFuturesClient:
         :param start_time: in timestamp format OR '%Y/%m/%d %H:%M:%S' string format.
         :param end_time: im timestamp format '%Y/%m/%d %H:%M:%S' string format.
         :param is_timestamp: True if start_time and end_time are in timestamp format, false if string format.
-        :return: Dictionary with a key of start time - end time - interval and value of a list of candles as Candle
-                 objects.
+        :return: Dictionary with a key of start time - end time - interval and value of a CandleSeries. Iterating the
+                 series yields Candle objects.
         """
         if not is_timestamp:
             if start_time is not None:
@@ -583,18 +849,16 @@ class BinanceFuturesClient:
             params['endTime'] = int(end_time)
         params['limit'] = limit
         klines = self.make_request(method, endpoint, params)
-        if klines is not None:
-
-            first_candle_ts = Candle("binance_futures", klines[0], "15m").start_timestamp
-            last_candle_ts = Candle("binance_futures", klines[-1], "15m").end_timestamp
+        if klines:
+            series = CandleSeries.from_klines(klines, interval, contract.symbol)
+            first_candle_ts = int(series.open_time[0])
+            last_candle_ts = int(series.close_time[-1])
 
             start_in_dt = dt.datetime.fromtimestamp(int(first_candle_ts / 1000)).strftime('%Y/%m/%d %H:%M:%S')
             end_in_dt = dt.datetime.fromtimestamp(int(last_candle_ts / 1000)).strftime('%Y/%m/%d %H:%M:%S')
 
             date_label = f"{start_in_dt}**{end_in_dt}**{interval}"
-            candle_dict[date_label] = list()
-            for candle in klines:
-                candle_dict[date_label].append(Candle("binance_futures", candle, interval))
+            candle_dict[date_label] = series
             logger.info(f"Binance Futures Client | {date_label} historical data retrieved.")
             return candle_dict
         else:
@@ -602,83 +866,68 @@ class BinanceFuturesClient:
                          f" {contract.symbol}-{interval}.")
             return None
 
-    def request_lvl2_id(self, symbol: str, start_time, end_time, is_timestamp=False, data_type="T_DEPTH"):
-        desired_symbols = ["BTCUSDT", "ADAUSDT", "LINKUSDT", "MANAUSDT", "ETHUSDT", "LTCUSDT", "1000SHIBUSDT",
-                           "SOLUSDT", "AVAXUSDT", "DYDXUSDT", "BCHUSDT", "XRPUSDT", "EOSUSDT", "TRXUSDT", "ETCUSDT",
-                           "BNBUSDT", "DOGEUSDT", "MKRUSDT", "BATUSDT", "ANKRUSDT"]
+    def download_historical_data(self, contract: Contract, interval: str, start_time, end_time, is_timestamp=True,
+                                 max_workers=4) -> typing.Optional[typing.List[list]]:
+        """
+        Bulk version of get_historical_data without the 1500 candle limit. Windows are fetched concurrently and the
+        download resumes from its checkpoint if interrupted.
+        :return: raw kline lists sorted by open time, None on failure.
+        """
+        downloader = KlineDownloader(self, max_workers=max_workers)
+        return downloader.download(contract, interval, start_time, end_time, is_timestamp)
+
+    def depth_archive(self, root=DEPTH_DIR, data_type="T_DEPTH", **kwargs) -> DepthArchivePipeline:
+        """Historical order book archives of root, see connectors/depth_archive.py."""
+        return DepthArchivePipeline(self, root, data_type, **kwargs)
 
-        initial_time = "2020/07/01 00:00:01"
+    def download_depth_history(self, symbols: typing.List[str], start_time, end_time, months=1, data_type="T_DEPTH",
+                               root=DEPTH_DIR, timeout=None) -> typing.Dict[str, str]:
+        """
+        Requests, downloads and decodes the historical order book of symbols into root/store, resuming earlier runs,
+        then writes the book checkpoints of the new days. Read the result with MarketReplay(root/store) or query
+        books at any moment with BookHistory(root/store).
+        :param start_time: ms timestamps.
+        :param months: months per archive, the exchange recommends 1-3 for tick level data.
+        :return: job key -> status
+        """
+        statuses = self.depth_archive(root, data_type).run(symbols, start_time, end_time, months, timeout)
+        if any(status == "decoded" for status in statuses.values()):
+            BookHistory(os.path.join(root, "store")).build(symbols)
+        return statuses
+
+    def request_lvl2_id(self, symbol: str, start_time, end_time, is_timestamp=False,
+                        data_type="T_DEPTH") -> typing.Optional[dict]:
         """
         It is recommended that you request within 1-3 months length each time,
          especially for tick-level order book data.
-        :param contract:
-        :param start_time:
-        :param end_time:
-        :param data_type:
-        :param is_timestamp:
-        :return:
+        :param start_time: '%Y/%m/%d %H:%M:%S' or a ms timestamp if is_timestamp.
+        :param data_type: T_DEPTH or S_DEPTH
+        :return: {'id': download id}
         """
-
         if not is_timestamp:
-            if start_time is not None:
-                start_time = time.mktime(dt.datetime.strptime(start_time, '%Y/%m/%d %H:%M:%S').timetuple()) * 1000
-            if end_time is not None:
-                end_time = time.mktime(dt.datetime.strptime(end_time, '%Y/%m/%d %H:%M:%S').timetuple()) * 1000
-
-        endpoint = "/futuresHistDataId"
-        method = "POST"
-        params = dict()
-        params['symbol'] = symbol.upper().strip()
-        params['startTime'] = int(start_time)
-        params['endTime'] = int(end_time)
-        params["dataType"] = data_type
-
-        id_info = self.make_request(method, endpoint, params)
-        if id_info is not None:
-            print(id_info)
-            print("*"*20)
-            download_id = id_info['id']
-            print(download_id)
-            print(f"download id: {download_id},"
-                  f" start time={dt.datetime.fromtimestamp(start_time/1000).strftime('%Y/%m/%d %H:%M:%S')},"
-                  f"end time: = {dt.datetime.fromtimestamp(end_time/1000).strftime('%Y/%m/%d %H:%M:%S')}")
-            return id_info
-        else:
-            return "ID Request gone wrong"
-
-    def id_to_link(self, download_id):
-        params = dict()
-        params['downloadId'] = download_id
-        params['timestamp'] = int(time.time() * 1000)
-        params['signature'] = self._get_signature(params)
-        endpoint = "/downloadLink"
-        full_url = self._base_url + endpoint
-        link = requests.get(full_url, params, headers=self._header)
-        print(link.status_code)
-        print(link.json())
-        if link is not None:
-            with open(f"../depth_datas/LINKUSDT_link_list.json", "a") as file:
-                json.dump(link.json(), file)
-                file.write('\n')
-            return link.json()
-        else:
-            return "LINK Request gone wrong"
-
-    def get_lv2_id(self, symbol: str, first_start_time: str, daily_interval=7, repetition=1):
-        #  I wrote this to get download id's in a bulk but its half-done.
-        start_time = dt.datetime.strptime(first_start_time, '%Y/%m/%d %H:%M:%S')
-        for i in range(repetition):
-            end_time = start_time + relativedelta(days=daily_interval)
-            start_in_str = dt.datetime.strftime(start_time, '%Y/%m/%d %H:%M:%S')
-            end_in_str = dt.datetime.strftime(end_time, '%Y/%m/%d %H:%M:%S')
-            btc_lv2 = self.request_lvl2_id(symbol, start_time=start_in_str, end_time=end_in_str)
-
-            with open(f"../depth_datas/{symbol}_id_list.txt", "a") as file:
-                file.write("*" * 50)
-                file.write("\n")
-                file.write(f"start_time: {start_in_str} end_time: {end_in_str} id: {btc_lv2}")
-                file.write('\n')
-            start_time = end_time
+            start_time = time.mktime(dt.datetime.strptime(start_time, '%Y/%m/%d %H:%M:%S').timetuple()) * 1000
+            end_time = time.mktime(dt.datetime.strptime(end_time, '%Y/%m/%d %H:%M:%S').timetuple()) * 1000
+        id_info = self.depth_archive(data_type=data_type).request_id(symbol, start_time, end_time)
+        if id_info is None:
+            logger.error(f"Binance Futures Client | Depth archive id request failed for {symbol}.")
+        return id_info
+
+    def id_to_link(self, download_id) -> typing.Optional[dict]:
+        """:return: {'link': url or "Link is preparing...", 'expirationTime': seconds}"""
+        return self.depth_archive().link(download_id)
+
+    def get_lv2_id(self, symbol: str, first_start_time: str, daily_interval=7, repetition=1) -> typing.List[str]:
+        """
+        Requests the download ids of repetition consecutive windows of daily_interval days. The ids are kept in the
+        depth archive's jobs.json, download_depth_history picks them up from there.
+        :return: the job keys.
+        """
+        start_time = time.mktime(dt.datetime.strptime(first_start_time, '%Y/%m/%d %H:%M:%S').timetuple()) * 1000
+        end_time = start_time + dt.timedelta(days=daily_interval * repetition).total_seconds() * 1000 - 1
+        archive = self.depth_archive()
+        keys = archive.plan([symbol], start_time, end_time, step=relativedelta(days=daily_interval))
+        archive.request_ids(keys)
+        return keys
 
 
 if __name__ == '__main__':
@@ -0,0 +1,518 @@
+import asyncio
+import concurrent.futures
+import functools
+import hashlib
+import hmac
+import json
+import logging
+import time
+import typing
+from urllib.parse import urlencode
+
+import aiohttp
+
+import logkeeper
+from connectors.rate_limiter import RateLimiter, request_weight, order_count, default_priority, PRIORITY_ORDER
+from connectors.retry import policy_for, is_retryable_status, is_unknown_status, new_client_order_id, \
+    DUPLICATE_CLIENT_ORDER_ID, ORDER_DOES_NOT_EXIST, ORDER_PLACEMENT
+from models import Contract, Candle, Order, Wallet, Position
+
+logger = logging.getLogger("binance_futures_async.py")
+logkeeper.log_keeper("connectors.log", "binance_futures_async.py")
+
+
+def _error_code(body) -> typing.Optional[int]:
+    return body.get('code') if isinstance(body, dict) else None
+
+
+def _is_unknown_outcome(status: typing.Optional[int], body, error: typing.Optional[Exception]) -> bool:
+    """connectors.retry.is_unknown_outcome for aiohttp: only a failed connect means the request was never sent."""
+    if error is not None:
+        return not isinstance(error, aiohttp.ClientConnectorError)
+    return is_unknown_status(status, _error_code(body))
+
+
+class AsyncBinanceFuturesClient:
+    """
+    asyncio counterpart of BinanceFuturesClient. REST calls and the websocket run on the same event loop, so many
+    requests can be in flight at once instead of blocking one after another.
+
+    Usage:
+        async with AsyncBinanceFuturesClient(public, secret, testnet=True) as client:
+            portfolio = await client.refresh_portfolio(list(client.contracts.values())[:20])
+    """
+    def __init__(self, public_key: str, secret_key: str, testnet: bool, pool_size=50, timeout=10.0,
+                 max_concurrency=20, rate_limiter: typing.Optional[RateLimiter] = None):
+        """
+        :param pool_size: maximum number of kept-alive REST connections.
+        :param timeout: total timeout in seconds for a single REST call.
+        :param max_concurrency: maximum number of requests a fan-out helper keeps in flight.
+        :param rate_limiter: pass the sync client's rate_limiter when both run on the same IP.
+        """
+        if testnet:
+            self._base_url = "https://testnet.binancefuture.com"
+            self._wss_url = "wss://testnet.binancefuture.com/ws/"
+            self.connection_type = "Testnet"
+        else:
+            self._base_url = "https://fapi.binance.com"
+            self._wss_url = "wss://fstream.binance.com/ws/"
+            self.connection_type = "Real Account"
+
+        # API Request variables
+        self.platform = "binance_futures"
+        self._public_key = public_key
+        self._secret_key = secret_key
+        self._header = {"X-MBX-APIKEY": self._public_key}
+        self._pool_size = pool_size
+        self._timeout = timeout
+        self._session: typing.Optional[aiohttp.ClientSession] = None
+        self._fan_out_limit = asyncio.Semaphore(max_concurrency)
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        # RateLimiter.acquire blocks, requests that have to wait for room do it here instead of on the event loop
+        self._limiter_pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency,
+                                                                   thread_name_prefix="async-rate-limiter")
+
+        # Models variables
+        self.contracts: typing.Dict[str, Contract] = dict()
+        self.wallet_info: typing.Optional[Wallet] = None
+
+        # Websocket variables
+        self.ws: typing.Optional[aiohttp.ClientWebSocketResponse] = None
+        self.ws_id = 1
+        self.is_ws_working = False
+        self.subscriptions = dict()
+        self.message_callbacks: typing.List[typing.Callable[[dict], None]] = list()
+        self._ws_task: typing.Optional[asyncio.Task] = None
+
+        self.maker_commission = 0.02 / 100
+        self.taker_commission = 0.04 / 100
+
+    async def start(self, load_account=True):
+        """
+        Opens the REST session, loads contracts (and wallet) concurrently and starts the websocket task.
+        Must be awaited from inside the event loop that will run the client.
+        """
+        connector = aiohttp.TCPConnector(limit=self._pool_size)
+        self._session = aiohttp.ClientSession(headers=self._header, connector=connector,
+                                              timeout=aiohttp.ClientTimeout(total=self._timeout))
+        self._ws_task = asyncio.create_task(self.start_ws())
+        if load_account:
+            self.wallet_info, self.contracts = await asyncio.gather(self.get_balances(),
+                                                                    self.get_current_contracts())
+        else:
+            self.contracts = await self.get_current_contracts()
+        return self
+
+    async def close(self):
+        self.is_ws_working = False
+        if self._ws_task is not None:
+            self._ws_task.cancel()
+            try:
+                await self._ws_task
+            except asyncio.CancelledError:
+                pass
+        if self._session is not None:
+            await self._session.close()
+        self._limiter_pool.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    # ----------------------------------------------------------------------------------------------------------------
+    # Websocket
+    # ----------------------------------------------------------------------------------------------------------------
+
+    async def start_ws(self):
+        """Keeps the websocket open on the client's event loop, reconnecting and resubscribing after failures."""
+        self.is_ws_working = True
+        while self.is_ws_working:
+            try:
+                async with self._session.ws_connect(self._wss_url, heartbeat=180) as ws:
+                    self.ws = ws
+                    logger.info("Async Binance Futures Client | Websocket Activated.")
+                    for channel_id, params in self.subscriptions.items():
+                        await ws.send_str(json.dumps({"method": "SUBSCRIBE", "params": params, "id": channel_id}))
+                    async for msg in ws:
+                        if msg.type == aiohttp.WSMsgType.TEXT:
+                            self.on_message(msg.data)
+                        elif msg.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                            break
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Async Binance Futures Client | Websocket Error occurred: %s.", e)
+            self.ws = None
+            if self.is_ws_working:
+                await asyncio.sleep(1)
+
+    def on_message(self, msg: str):
+        data = json.loads(msg)
+        if 'e' in data:
+            for callback in self.message_callbacks:
+                callback(data)
+
+    async def suscribe_channel(self, channel: str, symbols: typing.List[typing.Union[str, Contract]]) -> int:
+        params = list()
+        for symbol in symbols:
+            if isinstance(symbol, Contract):
+                symbol = symbol.symbol
+            params.append(f"{symbol.lower().strip()}@{channel}")
+        channel_id = self.ws_id
+        self.ws_id += 1
+        # Stored first so that a reconnect restores the subscription even if sending now fails.
+        self.subscriptions[channel_id] = params
+        if self.ws is not None:
+            try:
+                await self.ws.send_str(json.dumps({"method": "SUBSCRIBE", "params": params, "id": channel_id}))
+                logger.info("Async Binance Futures Client | Websocket subbed to %s for %s channel", symbols, channel)
+            except Exception as e:
+                logger.error("Async Binance Futures Client | Websocket error while subscribing to %s %s updates: %s",
+                             len(symbols), channel, e)
+        return channel_id
+
+    async def unsub_channel(self, channel_id: int):
+        params = self.subscriptions.pop(channel_id, None)
+        if params is None or self.ws is None:
+            return
+        try:
+            await self.ws.send_str(json.dumps({"method": "UNSUBSCRIBE", "params": params, "id": channel_id}))
+        except Exception as e:
+            logger.error("Async Binance Futures Client | Websocket error while unsubscribing to %s updates: %s",
+                         channel_id, e)
+
+    # ----------------------------------------------------------------------------------------------------------------
+    # REST
+    # ----------------------------------------------------------------------------------------------------------------
+
+    def _get_signature(self, data: dict):
+        """ HMAC SHA 256 signature provider"""
+        key = self._secret_key.encode()
+        payload = urlencode(data).encode()
+        return hmac.new(key, payload, hashlib.sha256).hexdigest()
+
+    async def make_request(self, method: str, endpoint: str, params: dict,
+                           priority: typing.Optional[int] = None) -> typing.Union[dict, list, None]:
+        """
+        Same rate limiting and retries as BinanceFuturesClient.make_request: every attempt waits for room in the
+        RateLimiter, transient failures are retried with the endpoint's RetryPolicy, and an order whose outcome is
+        unknown is looked up by its newClientOrderId and only sent again if the exchange doesn't have it.
+        :param method: get/post/put/delete depending on documentation
+        :param endpoint: depending on request type, will be copied from documentation.
+        :param params: will be signed and sent as a query string (GET/DELETE) or form body (POST/PUT).
+        :param priority: rate limiter priority (connectors.rate_limiter.PRIORITY_*), orders go first by default.
+        :return: decoded json, None on failure.
+        """
+        method = method.strip().upper()
+        if method == "POST" and endpoint == "/fapi/v1/order" and 'newClientOrderId' not in params:
+            params['newClientOrderId'] = new_client_order_id()
+        code, body, error = await self._request(method, endpoint, params, priority)
+        if method == "POST" and endpoint == "/fapi/v1/order" and _error_code(body) == DUPLICATE_CLIENT_ORDER_ID:
+            # the order is open already, placed by an attempt whose answer was lost
+            return await self.get_order_by_client_id(params['symbol'], params['newClientOrderId'])
+
+        if code is None:
+            return None
+        elif code == 200:
+            return body
+        elif code == 429:
+            logger.critical("Async Binance Futures Client | Request limit has broken. ")
+        elif code == 418:
+            logger.error("Async Binance Futures Client | IP has been auto-banned for continuing to send requests"
+                         " after receiving 429 codes. ")
+        else:
+            message = body.get('msg', body.get('message')) if isinstance(body, dict) else body
+            logger.error(f"Async Binance Futures Client | {code} code error on {method} {endpoint}. {message}")
+        return None
+
+    async def _acquire(self, weight: int, orders: int, priority: int,
+                       timeout: typing.Optional[float]) -> typing.Optional[float]:
+        """RateLimiter.acquire without blocking the event loop: taken at once if there's room, else waited for."""
+        waited = self.rate_limiter.acquire(weight, orders, priority, timeout=0)
+        if waited is not None or (timeout is not None and timeout <= 0):
+            return waited
+        return await asyncio.get_running_loop().run_in_executor(
+            self._limiter_pool, functools.partial(self.rate_limiter.acquire, weight, orders, priority, timeout))
+
+    async def _request(self, method: str, endpoint: str, params: dict, priority: typing.Optional[int] = None) \
+            -> typing.Tuple[typing.Optional[int], typing.Union[dict, list, None], typing.Optional[Exception]]:
+        """The retry loop of make_request. :return: status and decoded body of the last response, and exception."""
+        if priority is None:
+            priority = default_priority(method, endpoint)
+        placing = (method, endpoint) in ORDER_PLACEMENT
+        policy = policy_for(method, endpoint)
+        deadline = time.monotonic() + policy.deadline
+        weight = request_weight(method, endpoint, params)
+        orders = order_count(method, endpoint, params)
+        url = self._base_url + endpoint
+        attempt = 0
+        code, body, error = None, None, None
+        while True:
+            attempt += 1
+            queue_timeout = deadline - time.monotonic() if priority == PRIORITY_ORDER else None
+            if await self._acquire(weight, orders, priority, queue_timeout) is None:
+                logger.error(f"Async Binance Futures Client | {method} {endpoint} dropped, rate limit leaves no room"
+                             f" before the {policy.deadline}s deadline.")
+                break
+            if attempt == 1 and priority != PRIORITY_ORDER:
+                deadline = time.monotonic() + policy.deadline
+            signed = dict(params)
+            signed['recvWindow'] = 5000
+            signed['timestamp'] = int(time.time() * 1000)
+            signed['signature'] = self._get_signature(signed)
+            # Encoded by hand so the payload is byte-for-byte the one that was signed.
+            payload = urlencode(signed)
+            timeout = aiohttp.ClientTimeout(total=min(self._timeout, max(deadline - time.monotonic(), 0.1)))
+            code, body, error = None, None, None
+            sent_at = time.time()
+            try:
+                if method in ("GET", "DELETE"):
+                    request = self._session.request(method, f"{url}?{payload}", timeout=timeout)
+                else:
+                    request = self._session.request(method, url, data=payload, timeout=timeout,
+                                                    headers={"Content-Type": "application/x-www-form-urlencoded"})
+                async with request as response:
+                    code = response.status
+                    self.rate_limiter.update(response.headers, code, sent_at)
+                    body = await response.json(content_type=None)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+            except ValueError:
+                body = None
+            if error is None and not is_retryable_status(code, _error_code(body)):
+                break
+            if placing and _is_unknown_outcome(code, body, error):
+                if endpoint == "/fapi/v1/batchOrders":
+                    break
+                found, exists = await self._find_client_order(params['symbol'], params['newClientOrderId'])
+                if exists:
+                    logger.info(f"Async Binance Futures Client | Order {params['newClientOrderId']} was placed"
+                                f" although attempt {attempt} failed.")
+                    return 200, found, None
+                if exists is None:
+                    logger.error(f"Async Binance Futures Client | Order {params['newClientOrderId']} execution status"
+                                 f" unknown, not sent again: {error if error is not None else code}")
+                    break
+                # the exchange doesn't have it (-2013): sending it again can't execute it twice
+            delay = max(policy.delay(attempt), self.rate_limiter.banned_until - time.time())
+            if attempt >= policy.max_attempts or time.monotonic() + delay >= deadline:
+                logger.error(f"Async Binance Futures Client | {method} {endpoint} still failing after {attempt}"
+                             f" attempts: {error if error is not None else code}")
+                break
+            logger.warning(f"Async Binance Futures Client | {method} {endpoint} attempt {attempt} failed"
+                           f" ({error if error is not None else code}), retrying in {delay:.2f}s.")
+            await asyncio.sleep(delay)
+        return code, body, error
+
+    async def _find_client_order(self, symbol: str, client_order_id: str) \
+            -> typing.Tuple[typing.Optional[dict], typing.Optional[bool]]:
+        """
+        :return: (order, True) if the exchange has the order, (None, False) if it answers that the order doesn't
+        exist, (None, None) if that can't be told.
+        """
+        code, body, _ = await self._request("GET", "/fapi/v1/order",
+                                            {'symbol': symbol, 'origClientOrderId': client_order_id}, PRIORITY_ORDER)
+        if code == 200:
+            return body, True
+        if _error_code(body) == ORDER_DOES_NOT_EXIST:
+            return None, False
+        return None, None
+
+    async def get_order_by_client_id(self, symbol: str, client_order_id: str) -> typing.Optional[dict]:
+        """Looks up an order by the newClientOrderId it was sent with, None if the exchange doesn't know it."""
+        order = await self.make_request("GET", "/fapi/v1/order",
+                                        {'symbol': symbol, 'origClientOrderId': client_order_id})
+        if order is not None:
+            logger.info(f"Async Binance Futures Client | Order {client_order_id} found after retries:"
+                        f" {order['status']}")
+        return order
+
+    async def get_balances(self) -> typing.Optional[Wallet]:
+        balance = await self.make_request("GET", "/fapi/v2/account", dict())
+        if balance is not None:
+            return Wallet("binance_futures", balance)
+
+    async def get_current_commissions(self, contract: Contract):
+        commissions = await self.make_request("GET", "/fapi/v1/commissionRate", {'symbol': contract.symbol})
+        if commissions is not None:
+            self.maker_commission = float(commissions["makerCommissionRate"])
+            self.taker_commission = float(commissions["takerCommissionRate"])
+
+    async def get_current_contracts(self) -> typing.Dict[str, Contract]:
+        exchange_info, leverage_finder = await asyncio.gather(
+            self.make_request("GET", "/fapi/v1/exchangeInfo", dict()),
+            self.make_request("GET", "/fapi/v1/leverageBracket", dict()))
+        contract_dict = dict()
+        if exchange_info is None:
+            return contract_dict
+        assets = {asset['asset'] for asset in exchange_info['assets']}
+        leverages = {each['symbol']: each["brackets"][0]['initialLeverage'] for each in leverage_finder or []}
+        for contract in exchange_info['symbols']:
+            if contract['contractType'] == "PERPETUAL" and contract['status'] == "TRADING" \
+                    and contract['quoteAsset'] in assets:
+                contract['leverage'] = leverages.get(contract['symbol'], int())
+                contract_dict[contract['symbol']] = Contract("binance_futures", contract)
+        return contract_dict
+
+    async def get_candle_update(self, contract: Contract, timeframe="1d", limit=1) -> typing.Optional[Candle]:
+        params = {"pair": contract.symbol, "contractType": "PERPETUAL", "interval": timeframe, "limit": limit}
+        interval_info = await self.make_request("GET", "/fapi/v1/continuousKlines", params)
+        if interval_info:
+            return Candle("binance_futures", interval_info[-1], timeframe)
+
+    async def get_historical_data(self, contract: Contract, interval: str, limit=500, start_time=None,
+                                  end_time=None) -> typing.Optional[typing.List[Candle]]:
+        """
+        :param start_time: timestamp in ms.
+        :param end_time: timestamp in ms.
+        :return: list of Candle objects, None on failure.
+        """
+        params = {'pair': contract.symbol, 'contractType': "PERPETUAL", 'interval': interval}
+        if start_time is not None:
+            params['startTime'] = int(start_time)
+        if end_time is not None:
+            params['endTime'] = int(end_time)
+        params['limit'] = min(limit, 1500)
+        klines = await self.make_request("GET", "/fapi/v1/continuousKlines", params)
+        if klines is None:
+            logger.error(f"Async Binance Futures Client | Historical data retrieving failure for"
+                         f" {contract.symbol}-{interval}.")
+            return None
+        return [Candle("binance_futures", kline, interval) for kline in klines]
+
+    async def get_positions(self, contract=None) -> typing.Optional[typing.List[Position]]:
+        params = dict()
+        if contract is not None:
+            params['symbol'] = contract.symbol
+        positions = await self.make_request("GET", "/fapi/v2/positionRisk", params)
+        if positions is None:
+            logger.info("Async Binance Futures Client | Failed to get open positions")
+            return None
+        return [Position("binance_futures", position) for position in positions]
+
+    async def get_all_open_orders(self, contract=None) -> typing.Optional[typing.List[Order]]:
+        params = dict()
+        if contract is not None:
+            params['symbol'] = contract.symbol
+        open_orders = await self.make_request("GET", "/fapi/v1/openOrders", params)
+        if open_orders is None:
+            return None
+        return [Order("binance_futures", order) for order in open_orders]
+
+    async def place_market_order(self, contract: Contract, quantity: float, side: str) -> typing.Optional[Order]:
+        params = {'type': "MARKET", 'symbol': contract.symbol, 'side': side.strip().upper(), 'quantity': quantity}
+        response = await self.make_request("POST", "/fapi/v1/order", params)
+        if response is not None:
+            logger.info(f"Async Binance Futures Client | Market order placed: {contract.symbol} / {side} / q:{quantity}")
+            return Order("binance_futures", response)
+        logger.error(f"Async Binance Futures Client | Market order failed: {contract.symbol} / {side} / q:{quantity}")
+        return None
+
+    async def place_limit_order(self, contract: Contract, amount: float, side: str, price: float,
+                                tif="GTC") -> typing.Optional[Order]:
+        while amount * price < 10:
+            amount += contract.lot_size
+        amount = round(amount, contract.quantity_precision)
+        params = {'symbol': contract.symbol, 'side': side.strip().upper(), 'type': "LIMIT", 'timeInForce': tif,
+                  'quantity': amount, 'price': price}
+        response = await self.make_request("POST", "/fapi/v1/order", params)
+        if response is not None:
+            logger.info(f"Async Binance Futures Client | Limit order placed: {contract.symbol} / {side} / q:{amount}"
+                        f" / price: {price}")
+            return Order("binance_futures", response)
+        logger.error(f"Async Binance Futures Client | Limit order failed: {contract.symbol} / {side} / q:{amount}")
+        return None
+
+    async def place_stop_order(self, contract: Contract, quantity: float, side: str, price: float, stop_price: float,
+                               tif="GTC") -> typing.Optional[Order]:
+        while quantity * price < 10:
+            quantity += contract.lot_size
+        params = {'symbol': contract.symbol, 'side': side.strip().upper(), 'type': "STOP", 'timeInForce': tif,
+                  'quantity': round(quantity, contract.quantity_precision),
+                  'price': round(price, contract.price_precision),
+                  'stopPrice': round(stop_price, contract.price_precision)}
+        response = await self.make_request("POST", "/fapi/v1/order", params)
+        if response is not None:
+            logger.info(f"Async Binance Futures Client | Stop order placed: {contract.symbol} / {side}"
+                        f" / q:{params['quantity']} / price: {params['price']} / stop @{params['stopPrice']}")
+            return Order("binance_futures", response)
+        logger.error(f"Async Binance Futures Client | Stop order failed: {contract.symbol} / {side} / q:{quantity}")
+        return None
+
+    async def cancel_order(self, order: Order):
+        params = {'symbol': order.symbol, 'orderId': order.order_id}
+        cancel_req = await self.make_request("DELETE", "/fapi/v1/order", params)
+        if cancel_req is not None:
+            logger.info(f"Async Binance Futures Client | {order.symbol} order id:{order.order_id} canceled.")
+            return cancel_req
+        logger.error(f"Async Binance Futures Client | {order.symbol} order id:{order.order_id} cancel FAILED.")
+
+    # ----------------------------------------------------------------------------------------------------------------
+    # Fan-out helpers
+    # ----------------------------------------------------------------------------------------------------------------
+
+    async def _limited(self, coroutine):
+        async with self._fan_out_limit:
+            return await coroutine
+
+    async def fan_out(self, coroutines: typing.Iterable[typing.Awaitable]) -> list:
+        """Runs the coroutines concurrently (bounded by max_concurrency) and returns results in the same order."""
+        return await asyncio.gather(*(self._limited(coroutine) for coroutine in coroutines))
+
+    async def refresh_portfolio(self, contracts: typing.List[Contract], timeframe="1m") -> typing.Dict[str, dict]:
+        """
+        Fetches the positions and open orders of the whole account (one call each) and the last candle of every
+        contract at once: N + 2 requests in about one round trip, weight 45 + N instead of 7N.
+        Positions are keyed by positionSide, one-way mode gives "BOTH", hedge mode "LONG" and "SHORT".
+        :return: {symbol: {"positions": {positionSide: Position}/None, "open_orders": [Order]/None,
+                  "last_candle": Candle/None}}, None where that call failed.
+        """
+        calls = [self.get_positions(), self.get_all_open_orders()]
+        calls.extend(self.get_candle_update(contract, timeframe) for contract in contracts)
+        positions, open_orders, *candles = await self.fan_out(calls)
+
+        portfolio = dict()
+        for contract, candle in zip(contracts, candles):
+            portfolio[contract.symbol] = {"positions": dict() if positions is not None else None,
+                                          "open_orders": list() if open_orders is not None else None,
+                                          "last_candle": candle}
+        for position in positions or list():
+            if position.symbol in portfolio:
+                portfolio[position.symbol]["positions"][position.side] = position
+        for order in open_orders or list():
+            if order.symbol in portfolio:
+                portfolio[order.symbol]["open_orders"].append(order)
+        return portfolio
+
+    async def get_last_candles(self, contracts: typing.List[Contract], timeframe="1m") -> typing.Dict[str, Candle]:
+        candles = await self.fan_out(self.get_candle_update(contract, timeframe) for contract in contracts)
+        return {contract.symbol: candle for contract, candle in zip(contracts, candles)}
+
+    async def place_limit_orders(self, orders: typing.List[typing.Tuple[Contract, float, str, float]],
+                                 tif="GTC") -> typing.List[typing.Optional[Order]]:
+        """
+        :param orders: list of (contract, amount, side, price)
+        :return: Order objects (None for failures) in the same order as requested.
+        """
+        return await self.fan_out(self.place_limit_order(contract, amount, side, price, tif)
+                                  for contract, amount, side, price in orders)
+
+    async def cancel_orders(self, orders: typing.List[Order]) -> list:
+        return await self.fan_out(self.cancel_order(order) for order in orders)
+
+
+if __name__ == '__main__':
+    from keys import *
+
+    async def main():
+        async with AsyncBinanceFuturesClient(BINANCE_TESTNET_API_PUBLIC, BINANCE_TESTNET_API_SECRET,
+                                             testnet=True) as client:
+            contracts = list(client.contracts.values())[:20]
+            ts = time.perf_counter()
+            portfolio = await client.refresh_portfolio(contracts)
+            logger.info(f"Async Binance Futures Client | Refreshed {len(portfolio)} contracts in"
+                        f" {time.perf_counter() - ts:.3f}s")
+
+    asyncio.run(main())
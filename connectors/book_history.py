@@ -0,0 +1,433 @@
+import json
+import logging
+import os
+import time
+import typing
+
+import numpy as np
+
+import logkeeper
+from connectors.depth_archive import DEPTH_DIR
+from connectors.market_recorder import MarketReplay, RECORD_DTYPES, _day, _day_name
+from connectors.order_book import LocalOrderBook
+
+logger = logging.getLogger("book_history.py")
+logkeeper.log_keeper("connectors.log", "book_history.py")
+
+HISTORY_DIR = os.path.join(DEPTH_DIR, "store")
+CHECKPOINT_VERSION = 1
+OPEN_DAYS = 32     # (symbol, day) files kept memory-mapped by a BookHistory
+
+# Full books of a checkpoint, sorted by side then price (bids and asks ascending).
+LEVEL_DTYPE = np.dtype([("is_ask", "u1"), ("price", "<f8"), ("quantity", "<f8")])
+# One row per checkpoint: the book as of `time` is levels[first:first + levels] with the depthUpdate records
+# before update_row applied; records from update_row on are the diff tail of a later moment.
+CHECKPOINT_DTYPE = np.dtype([("time", "<i8"), ("update_row", "<i8"), ("first", "<i8"), ("levels", "<i8"),
+                             ("last_update_id", "<i8"), ("is_snapshot", "u1")])
+
+
+def _merge(levels: np.ndarray, updates: np.ndarray) -> np.ndarray:
+    """
+    Applies depthUpdate records (in order) to a book: the last quantity of every (side, price) wins and zero
+    quantities remove the level. Vectorized, the cost is a sort of book + updates.
+    """
+    if len(updates) == 0:
+        return levels
+    both = np.empty(len(levels) + len(updates), dtype=LEVEL_DTYPE)
+    for field in LEVEL_DTYPE.names:
+        both[field][:len(levels)] = levels[field]
+        both[field][len(levels):] = updates[field]
+    # position breaks ties so the latest write of a level sorts last
+    both = both[np.lexsort((np.arange(len(both)), both['price'], both['is_ask']))]
+    last = np.ones(len(both), dtype=bool)
+    last[:-1] = (both['is_ask'][1:] != both['is_ask'][:-1]) | (both['price'][1:] != both['price'][:-1])
+    both = both[last]
+    return both[both['quantity'] > 0]
+
+
+class BookState:
+    """Order book of a symbol at one moment, rebuilt from stored depth history."""
+    __slots__ = ("symbol", "time", "last_update_id", "levels")
+
+    def __init__(self, symbol: str, time_: int, last_update_id: int, levels: np.ndarray):
+        self.symbol = symbol
+        self.time = time_
+        self.last_update_id = last_update_id
+        self.levels = levels
+
+    @property
+    def bids(self) -> np.ndarray:
+        """Bid levels, best first."""
+        return self.levels[self.levels['is_ask'] == 0][::-1]
+
+    @property
+    def asks(self) -> np.ndarray:
+        """Ask levels, best first."""
+        return self.levels[self.levels['is_ask'] == 1]
+
+    def best_bid(self) -> typing.Optional[typing.Tuple[float, float]]:
+        bids = self.levels[self.levels['is_ask'] == 0]
+        return (float(bids['price'][-1]), float(bids['quantity'][-1])) if len(bids) else None
+
+    def best_ask(self) -> typing.Optional[typing.Tuple[float, float]]:
+        asks = self.levels[self.levels['is_ask'] == 1]
+        return (float(asks['price'][0]), float(asks['quantity'][0])) if len(asks) else None
+
+    def mid_price(self) -> typing.Optional[float]:
+        bid, ask = self.best_bid(), self.best_ask()
+        if bid is None or ask is None:
+            return None
+        return (bid[0] + ask[0]) / 2
+
+    def top(self, n=10) -> typing.Dict[str, typing.List[typing.Tuple[float, float]]]:
+        return {"bids": [(float(p), float(q)) for p, q in zip(self.bids['price'][:n], self.bids['quantity'][:n])],
+                "asks": [(float(p), float(q)) for p, q in zip(self.asks['price'][:n], self.asks['quantity'][:n])]}
+
+    def snapshot(self) -> dict:
+        """Same keys as a /fapi/v1/depth response."""
+        bids, asks = self.bids, self.asks
+        return {"lastUpdateId": self.last_update_id, "E": self.time,
+                "bids": np.column_stack((bids['price'], bids['quantity'])).tolist(),
+                "asks": np.column_stack((asks['price'], asks['quantity'])).tolist()}
+
+    def to_order_book(self) -> LocalOrderBook:
+        """A LocalOrderBook loaded with this state, for its depth helpers or to continue with live/replayed diffs."""
+        book = LocalOrderBook(self.symbol)
+        book.apply_snapshot(self.snapshot())
+        book.event_time = self.time
+        return book
+
+
+class BookHistory:
+    """
+    Point in time order books over a depth recording (MarketRecorder layout, i.e. the store of a
+    DepthArchivePipeline). build() writes periodic full-book checkpoints next to every day's depthUpdate segment:
+        root/SYMBOL/YYYY-MM-DD/depthCheckpoint.bin   books (LEVEL_DTYPE)
+        root/SYMBOL/YYYY-MM-DD/depthCheckpoint.idx   one CHECKPOINT_DTYPE row per checkpoint
+    and root/checkpoints.json with the source record counts they were built from, so changed days are rebuilt.
+    book_at(T) then loads the last checkpoint at or before T and applies the short diff tail up to T.
+    """
+    def __init__(self, root=HISTORY_DIR, checkpoint_interval=60000):
+        """
+        :param root: folder of the recording.
+        :param checkpoint_interval: ms between checkpoints, bounds the diff tail of a query. Snapshots of the
+        recording are checkpoints as well.
+        """
+        self.root = root
+        self.checkpoint_interval = checkpoint_interval
+        self.state_path = os.path.join(root, "checkpoints.json")
+        self.days: typing.Dict[str, dict] = dict()
+        self.replay = MarketReplay(root)
+        self._open: typing.Dict[typing.Tuple[str, str], tuple] = dict()
+        self._load_state()
+
+    def _load_state(self):
+        if not os.path.exists(self.state_path):
+            return
+        with open(self.state_path) as file:
+            data = json.load(file)
+        if data.get('version') == CHECKPOINT_VERSION:
+            self.days = data['days']
+
+    def _save_state(self):
+        with open(self.state_path + ".tmp", "w") as file:
+            json.dump({'version': CHECKPOINT_VERSION, 'days': self.days}, file)
+        os.replace(self.state_path + ".tmp", self.state_path)
+
+    def _path(self, symbol: str, day: str, extension: str) -> str:
+        return os.path.join(self.root, symbol, day, f"depthCheckpoint.{extension}")
+
+    def _source(self, symbol: str, day: str) -> dict:
+        index = self.replay.index
+        return {'updates': index.get(f"{symbol}/{day}/depthUpdate", {}).get('records', 0),
+                'snapshots': index.get(f"{symbol}/{day}/depthSnapshot", {}).get('records', 0),
+                'interval': self.checkpoint_interval}
+
+    # ----- build -----
+
+    def build(self, symbols: typing.Optional[typing.Iterable[str]] = None, rebuild=False) -> int:
+        """
+        Writes the checkpoints of every day whose depth records changed since the last build (and of the days
+        after it, whose first book is carried over from it).
+        :return: number of days built.
+        """
+        self.replay = MarketReplay(self.root)
+        self._open.clear()
+        days_by_symbol: typing.Dict[str, typing.List[str]] = dict()
+        for symbol, day, _ in self.replay.segments(symbols, ["depthUpdate", "depthSnapshot"]):
+            days = days_by_symbol.setdefault(symbol, list())
+            if not days or days[-1] != day:
+                days.append(day)
+        built = 0
+        for symbol, days in days_by_symbol.items():
+            carried, previous, changed = None, None, rebuild
+            for day in days:
+                name = f"{symbol}/{day}"
+                source = self._source(symbol, day)
+                contiguous = previous is not None and _day_name(_day_number(previous) + 1) == day
+                changed = changed or self.days.get(name, {}).get('source') != source
+                if not changed:
+                    carried, previous = None, day
+                    continue
+                if carried is None and contiguous:
+                    carried = self._end_state(symbol, previous)
+                ts = time.perf_counter()
+                carried = self._build_day(symbol, day, carried if contiguous else None)
+                self.days[name] = {'source': source}
+                self._save_state()
+                built += 1
+                previous = day
+                logger.info("Book History | %s %s: checkpoints built in %.2fs.", symbol, day, time.perf_counter() - ts)
+        self._open.clear()
+        return built
+
+    def _build_day(self, symbol: str, day: str, carried: typing.Optional[BookState]) -> BookState:
+        day_start = _day_number(day) * 86400000
+        updates = self._load(symbol, day, "depthUpdate")
+        # contiguous copies, searchsorted would otherwise copy the strided column on every call
+        times = np.ascontiguousarray(updates['event_time'])
+        ids = np.ascontiguousarray(updates['final_update_id'])
+        snapshots = self._load(symbol, day, "depthSnapshot")
+        if carried is None and (len(snapshots) == 0 or (len(times) and snapshots['event_time'][0] > times[0])):
+            logger.warning("Book History | %s %s does not start from a known book, levels set before it are "
+                           "missing until the first snapshot.", symbol, day)
+
+        # (time, kind, payload): snapshots first when they share a time with an interval checkpoint
+        moments = [(t, 1, None) for t in range(day_start + self.checkpoint_interval, day_start + 86400000,
+                                               self.checkpoint_interval)]
+        if len(snapshots):
+            keys = np.asarray(snapshots['final_update_id'])
+            bounds = np.concatenate([[0], np.flatnonzero(keys[1:] != keys[:-1]) + 1, [len(snapshots)]])
+            moments += [(int(snapshots['event_time'][a]), 0, (a, b)) for a, b in zip(bounds[:-1], bounds[1:])]
+        moments.sort(key=lambda moment: (moment[0], moment[1]))
+
+        checkpoints = list()
+        books = list()
+        offset = 0
+        levels = carried.levels if carried is not None else np.empty(0, dtype=LEVEL_DTYPE)
+        last_update_id = carried.last_update_id if carried is not None else 0
+        position = 0
+
+        def add(moment: int, is_snapshot: bool):
+            nonlocal offset
+            checkpoints.append((moment, position, offset, len(levels), last_update_id, is_snapshot))
+            books.append(levels)
+            offset += len(levels)
+
+        if carried is not None:
+            add(day_start, False)
+        for moment, kind, payload in moments:
+            if kind == 0:
+                first, last = payload
+                book = snapshots[first:last]
+                levels = _merge(np.empty(0, dtype=LEVEL_DTYPE), book)
+                last_update_id = int(book['final_update_id'][0])
+                # diffs already contained in the snapshot are skipped
+                position = max(position, int(np.searchsorted(ids, last_update_id, side="right")))
+                add(moment, True)
+            else:
+                end = max(position, int(np.searchsorted(times, moment, side="right")))
+                if end == position and checkpoints:
+                    continue
+                levels = _merge(levels, updates[position:end])
+                if end > position:
+                    last_update_id = int(ids[end - 1])
+                position = end
+                add(moment, False)
+
+        table = np.array(checkpoints, dtype=CHECKPOINT_DTYPE)
+        with open(self._path(symbol, day, "bin") + ".tmp", "wb") as file:
+            for book in books:
+                file.write(book.tobytes())
+        table.tofile(self._path(symbol, day, "idx") + ".tmp")
+        os.replace(self._path(symbol, day, "bin") + ".tmp", self._path(symbol, day, "bin"))
+        os.replace(self._path(symbol, day, "idx") + ".tmp", self._path(symbol, day, "idx"))
+
+        levels = _merge(levels, updates[position:])
+        if len(updates) > position:
+            last_update_id = int(ids[-1])
+        return BookState(symbol, day_start + 86400000 - 1, last_update_id, levels)
+
+    def _end_state(self, symbol: str, day: str) -> typing.Optional[BookState]:
+        return self.book_at(symbol, _day_number(day) * 86400000 + 86400000 - 1)
+
+    def _load(self, symbol: str, day: str, event_type: str) -> np.ndarray:
+        if f"{symbol}/{day}/{event_type}" not in self.replay.index:
+            return np.empty(0, dtype=RECORD_DTYPES[event_type])
+        return self.replay.load(symbol, day, event_type)
+
+    # ----- queries -----
+
+    def _cached(self, symbol: str, day: str) -> typing.Optional[typing.Tuple[np.ndarray, ...]]:
+        """
+        (checkpoint table, checkpoint books, depthUpdate records, their event times) of a day. Records are
+        memory-mapped, only the event times are read into memory.
+        """
+        key = (symbol, day)
+        if key in self._open:
+            return self._open[key]
+        if f"{symbol}/{day}" not in self.days or not os.path.exists(self._path(symbol, day, "idx")):
+            return None
+        table = np.fromfile(self._path(symbol, day, "idx"), dtype=CHECKPOINT_DTYPE)
+        books = np.memmap(self._path(symbol, day, "bin"), dtype=LEVEL_DTYPE, mode="r") \
+            if os.path.getsize(self._path(symbol, day, "bin")) else np.empty(0, dtype=LEVEL_DTYPE)
+        if len(self._open) >= OPEN_DAYS:
+            del self._open[next(iter(self._open))]
+        updates = self._load(symbol, day, "depthUpdate")
+        self._open[key] = (table, books, updates, np.ascontiguousarray(updates['event_time']))
+        return self._open[key]
+
+    def book_at(self, symbol: str, ts: int) -> typing.Optional[BookState]:
+        """
+        The book after every diff with event time <= ts.
+        :return: None if there are no checkpoints for that day or ts is before the day's first known book.
+        """
+        cached = self._cached(symbol, _day(ts))
+        if cached is None:
+            return None
+        table, books, updates, times = cached
+        i = int(np.searchsorted(table['time'], ts, side="right")) - 1
+        if i < 0:
+            return None
+        checkpoint = table[i]
+        position = int(checkpoint['update_row'])
+        end = max(position, int(np.searchsorted(times, ts, side="right")))
+        first = int(checkpoint['first'])
+        levels = _merge(np.asarray(books[first:first + int(checkpoint['levels'])]), updates[position:end])
+        last_update_id = int(updates['final_update_id'][end - 1]) if end > position \
+            else int(checkpoint['last_update_id'])
+        return BookState(symbol, ts, last_update_id, levels)
+
+    def evolution(self, symbol: str, start_time: int, end_time: int, step=1000) -> typing.Iterator[BookState]:
+        """
+        The book every step ms over [start_time, end_time]. Within a day each state is the previous one plus the
+        diffs in between, a checkpoint is only used again after a snapshot or on a new day.
+        """
+        state, day, position, checkpoint = None, None, 0, -1
+        for ts in range(int(start_time), int(end_time) + 1, step):
+            cached = self._cached(symbol, _day(ts))
+            if cached is None:
+                state, day = None, None
+                continue
+            table, _, updates, times = cached
+            i = int(np.searchsorted(table['time'], ts, side="right")) - 1
+            snapshot_between = i > checkpoint and bool(table['is_snapshot'][checkpoint + 1:i + 1].any())
+            if state is None or _day(ts) != day or snapshot_between:
+                state = self.book_at(symbol, ts)
+                if state is None:
+                    continue
+                day, checkpoint = _day(ts), i
+                position = max(int(np.searchsorted(times, ts, side="right")), int(table['update_row'][i]))
+            else:
+                end = max(position, int(np.searchsorted(times, ts, side="right")))
+                last_update_id = int(updates['final_update_id'][end - 1]) if end > position \
+                    else state.last_update_id
+                state = BookState(symbol, ts, last_update_id, _merge(state.levels, updates[position:end]))
+                position, checkpoint = end, i
+            yield state
+
+
+def _day_number(day: str) -> int:
+    return int(np.datetime64(day, "D").astype(np.int64))
+
+
+if __name__ == '__main__':
+    # Two days of synthetic tick depth (a snapshot at midnight and one at noon of the second day), checkpoint
+    # build time, then point in time queries against a scan from the day's first snapshot.
+    import tempfile
+    from connectors.market_recorder import MarketRecorder
+
+    rng = np.random.default_rng(3)
+    root = tempfile.mkdtemp()
+    recorder = MarketRecorder(root)
+    dtype = RECORD_DTYPES["depthUpdate"]
+    day_ms, rows_per_day, rows_per_event, mid = 86400000, 2000000, 10, 20000.0
+    start = 1656633600000   # 2022-07-01 UTC
+    update_id = 1
+
+    def book_records(ts: int, last_id: int) -> np.ndarray:
+        records = np.zeros(2000, dtype=dtype)
+        records['event_time'], records['transaction_time'] = ts, ts
+        records['first_update_id'], records['final_update_id'], records['previous_update_id'] = last_id, last_id, -1
+        records['is_ask'][1000:] = 1
+        records['price'][:1000] = mid - 0.1 * np.arange(1, 1001)
+        records['price'][1000:] = mid + 0.1 * np.arange(1, 1001)
+        records['quantity'] = np.round(rng.uniform(0.1, 5, 2000), 3)
+        return records
+
+    for day in range(2):
+        day_start = start + day * day_ms
+        events = rows_per_day // rows_per_event
+        event_times = day_start + np.sort(rng.integers(0, day_ms, events))
+        records = np.zeros(rows_per_day, dtype=dtype)
+        records['event_time'] = np.repeat(event_times, rows_per_event)
+        records['transaction_time'] = records['event_time']
+        event_ids = update_id + np.arange(events) * 3
+        records['first_update_id'] = np.repeat(event_ids, rows_per_event)
+        records['final_update_id'] = records['first_update_id'] + 2
+        records['previous_update_id'] = records['first_update_id'] - 1
+        records['is_ask'] = rng.integers(0, 2, rows_per_day)
+        offsets = 0.1 * rng.integers(1, 1200, rows_per_day)
+        records['price'] = np.round(np.where(records['is_ask'] == 1, mid + offsets, mid - offsets), 1)
+        records['quantity'] = np.where(rng.random(rows_per_day) < 0.3, 0, np.round(rng.uniform(0.1, 5, rows_per_day), 3))
+        snapshots = [book_records(day_start, update_id - 1)]
+        if day == 1:
+            noon = int(np.searchsorted(records['event_time'], day_start + day_ms // 2))
+            snapshots.append(book_records(int(records['event_time'][noon]), int(records['final_update_id'][noon - 1])))
+        update_id = int(records['final_update_id'][-1]) + 1
+        recorder.append("BTCUSDT", "depthSnapshot", np.concatenate(snapshots))
+        recorder.append("BTCUSDT", "depthUpdate", records)
+    recorder.close()
+
+    history = BookHistory(root)
+    ts = time.perf_counter()
+    built = history.build()
+    print(f"checkpoints of {built} days ({rows_per_day:,} diff rows each) built in {time.perf_counter() - ts:.2f}s,"
+          f" {sum(os.path.getsize(history._path('BTCUSDT', d, 'bin')) for d in ('2022-07-01', '2022-07-02')) / 1e6:.1f}"
+          f" MB of checkpoints next to {2 * rows_per_day * dtype.itemsize / 1e6:.1f} MB of diffs")
+    print(f"second build: {BookHistory(root).build()} days rebuilt")
+
+    def scanned(ts: int) -> typing.Dict[typing.Tuple[int, float], float]:
+        """Reference: the book from the last snapshot at or before ts plus every diff after it, level by level."""
+        day = _day(ts)
+        snapshots = history._load("BTCUSDT", day, "depthSnapshot")
+        last = snapshots['event_time'] <= ts
+        snapshot_id = int(snapshots['final_update_id'][last][-1])
+        book = {(int(a), p): q for a, p, q in zip(snapshots['is_ask'][last & (snapshots['final_update_id'] == snapshot_id)],
+                                                 snapshots['price'][last & (snapshots['final_update_id'] == snapshot_id)],
+                                                 snapshots['quantity'][last & (snapshots['final_update_id'] == snapshot_id)])}
+        updates = history._load("BTCUSDT", day, "depthUpdate")
+        rows = updates[(updates['event_time'] <= ts) & (updates['final_update_id'] > snapshot_id)]
+        for is_ask, price, quantity in zip(rows['is_ask'].tolist(), rows['price'].tolist(), rows['quantity'].tolist()):
+            if quantity == 0:
+                book.pop((is_ask, price), None)
+            else:
+                book[(is_ask, price)] = quantity
+        return book
+
+    probes = [start + 3600000 * 5 + 1234, start + day_ms + day_ms // 2 + 7777, start + 2 * day_ms - 1]
+    for probe in probes:
+        ts = time.perf_counter()
+        reference = scanned(probe)
+        scan = time.perf_counter() - ts
+        state = history.book_at("BTCUSDT", probe)
+        matches = {(int(a), p): q for a, p, q in zip(state.levels['is_ask'], state.levels['price'],
+                                                    state.levels['quantity'])} == reference
+        print(f"book at {probe}: {len(state.levels)} levels, best {state.best_bid()} / {state.best_ask()},"
+              f" matches a full scan ({scan * 1000:.0f} ms): {matches}")
+
+    queries = start + rng.integers(0, 2 * day_ms, 2000)
+    ts = time.perf_counter()
+    for query in queries:
+        history.book_at("BTCUSDT", int(query))
+    elapsed = time.perf_counter() - ts
+    print(f"{len(queries)} random point in time queries: {elapsed / len(queries) * 1000:.2f} ms each")
+
+    ts = time.perf_counter()
+    states = list(history.evolution("BTCUSDT", start + day_ms + day_ms // 2 - 1800000,
+                                    start + day_ms + day_ms // 2 + 1800000, step=1000))
+    elapsed = time.perf_counter() - ts
+    crossing = history.book_at("BTCUSDT", states[-1].time)
+    print(f"evolution over an hour across the noon snapshot: {len(states)} states in {elapsed:.2f}s,"
+          f" last one equal to a direct query: {np.array_equal(states[-1].levels, crossing.levels)}")
+    print(f"as a LocalOrderBook: depth within 5bps {states[-1].to_order_book().depth_within(5)}")
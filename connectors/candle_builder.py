@@ -0,0 +1,270 @@
+import calendar
+import datetime as dt
+import logging
+import threading
+import time
+import typing
+
+import logkeeper
+from models import Candle, TIME_ENUM_CONVERSION
+
+logger = logging.getLogger("candle_builder.py")
+logkeeper.log_keeper("connectors.log", "candle_builder.py")
+
+MINUTE = 60 * 1000
+WEEK = 7 * 24 * 60 * MINUTE
+FIRST_MONDAY = 4 * 24 * 60 * MINUTE     # 1970/01/05, Binance weeks open on Monday 00:00 UTC
+
+
+def candle_open_time(timestamp: int, interval: str) -> int:
+    """Open time (ms) of the `interval` candle containing timestamp, aligned like Binance klines (UTC)."""
+    if interval == "1M":
+        day = dt.datetime.fromtimestamp(timestamp / 1000, tz=dt.timezone.utc)
+        return calendar.timegm((day.year, day.month, 1, 0, 0, 0)) * 1000
+    if interval == "1w":
+        return timestamp - (timestamp - FIRST_MONDAY) % WEEK
+    step = TIME_ENUM_CONVERSION[interval] * MINUTE
+    return timestamp - timestamp % step
+
+
+def next_open_time(open_time: int, interval: str) -> int:
+    if interval == "1M":
+        day = dt.datetime.fromtimestamp(open_time / 1000, tz=dt.timezone.utc)
+        year, month = (day.year + 1, 1) if day.month == 12 else (day.year, day.month + 1)
+        return calendar.timegm((year, month, 1, 0, 0, 0)) * 1000
+    if interval == "1w":
+        return open_time + WEEK
+    return open_time + TIME_ENUM_CONVERSION[interval] * MINUTE
+
+
+class OpenCandle:
+    __slots__ = ("interval", "open_time", "close_time", "open", "high", "low", "close", "volume_base", "volume_quote",
+                 "num_of_trades")
+
+    def __init__(self, interval: str, open_time: int, price: float):
+        self.interval = interval
+        self.open_time = open_time
+        self.close_time = next_open_time(open_time, interval) - 1
+        self.open = self.high = self.low = self.close = price
+        self.volume_base = 0.0
+        self.volume_quote = 0.0
+        self.num_of_trades = 0
+
+    def add_trade(self, price: float, quantity: float, trades: int):
+        if self.num_of_trades == 0:
+            # candles opened without a trade carry the previous close until something trades
+            self.open = self.high = self.low = price
+        if price > self.high:
+            self.high = price
+        elif price < self.low:
+            self.low = price
+        self.close = price
+        self.volume_base += quantity
+        self.volume_quote += price * quantity
+        self.num_of_trades += trades
+
+    def to_candle(self) -> Candle:
+        return Candle("binance_futures", [self.open_time, self.open, self.high, self.low, self.close,
+                                          self.volume_base, self.close_time, self.volume_quote, self.num_of_trades],
+                      self.interval)
+
+
+class CandleBuilder:
+    """
+    Builds candles of one symbol for several timeframes at once from aggTrade events.
+    A candle is closed when the first trade of the next one arrives or, with start_timer(), right after its close
+    time even if nothing trades. Timeframes without trades get flat candles at the last price, like exchange klines.
+    After a websocket reconnect call reconcile() to replace what was missed with REST klines.
+    """
+    def __init__(self, symbol: str, intervals: typing.Optional[typing.List[str]] = None,
+                 on_close: typing.Optional[typing.Callable[[str, str, Candle], None]] = None, close_delay_ms=50):
+        """
+        :param symbol: contract symbol, i.e. BTCUSDT
+        :param intervals: keys of TIME_ENUM_CONVERSION, defaults to all of them.
+        :param on_close: called with (symbol, interval, Candle) for every closed candle.
+        :param close_delay_ms: the timer waits this long after a boundary for trades still in flight.
+        """
+        self.symbol = symbol.upper()
+        self.intervals = list(TIME_ENUM_CONVERSION.keys()) if intervals is None else list(intervals)
+        self.on_close = on_close
+        self.close_delay_ms = close_delay_ms
+        self.open_candles: typing.Dict[str, typing.Optional[OpenCandle]] = {i: None for i in self.intervals}
+        self.last_closed: typing.Dict[str, typing.Optional[Candle]] = {i: None for i in self.intervals}
+        self.late_trades = 0
+        # trades received while reconcile() waits for REST, (time, first id, last id, price, quantity)
+        self._recording: typing.Optional[typing.List[tuple]] = None
+        self._lock = threading.Lock()
+        self._timer: typing.Optional[threading.Thread] = None
+        self._running = False
+
+    def _emit(self, interval: str, candle: OpenCandle):
+        closed = candle.to_candle()
+        self.last_closed[interval] = closed
+        if self.on_close is not None:
+            try:
+                self.on_close(self.symbol, interval, closed)
+            except Exception as e:
+                logger.error("Candle Builder | on_close callback failed for %s %s: %s", self.symbol, interval, e)
+
+    def _roll(self, interval: str, timestamp: int):
+        """Closes the open candle, and the empty ones after it, until the open candle contains timestamp."""
+        candle = self.open_candles[interval]
+        while candle.close_time < timestamp:
+            self._emit(interval, candle)
+            candle = OpenCandle(interval, candle.close_time + 1, candle.close)
+        self.open_candles[interval] = candle
+
+    def on_agg_trade(self, event: dict):
+        """Feeds one aggTrade event (already json-decoded)."""
+        price = float(event['p'])
+        quantity = float(event['q'])
+        with self._lock:
+            if self._recording is not None:
+                # reconcile() is loading candles from REST, it applies the trades those candles don't contain
+                self._recording.append((event['T'], event['f'], event['l'], price, quantity))
+                return
+            self._add_trade(self.intervals, event['T'], event['f'], event['l'], price, quantity)
+
+    def _add_trade(self, intervals: typing.List[str], trade_time: int, first_id: int, last_id: int, price: float,
+                   quantity: float):
+        trades = last_id - first_id + 1
+        late = False
+        for interval in intervals:
+            candle = self.open_candles[interval]
+            if candle is None:
+                candle = OpenCandle(interval, candle_open_time(trade_time, interval), price)
+                self.open_candles[interval] = candle
+            elif trade_time > candle.close_time:
+                self._roll(interval, trade_time)
+                candle = self.open_candles[interval]
+            elif trade_time < candle.open_time:
+                # belongs to a candle that was already closed by the timer
+                late = True
+                continue
+            candle.add_trade(price, quantity, trades)
+        if late:
+            self.late_trades += 1
+
+    def flush(self, now_ms: typing.Optional[int] = None):
+        """Closes every candle whose close time has passed by more than close_delay_ms."""
+        if now_ms is None:
+            now_ms = int(time.time() * 1000)
+        cutoff = now_ms - self.close_delay_ms
+        with self._lock:
+            for interval in self.intervals:
+                candle = self.open_candles[interval]
+                if candle is not None and candle.close_time < cutoff:
+                    self._roll(interval, cutoff)
+
+    def _timer_loop(self):
+        while self._running:
+            now = time.time() * 1000
+            next_boundary = now - now % MINUTE + MINUTE + self.close_delay_ms
+            time.sleep((next_boundary - now) / 1000)
+            self.flush()
+
+    def start_timer(self):
+        """Closes candles at every minute boundary from a background thread."""
+        if self._timer is None:
+            self._running = True
+            self._timer = threading.Thread(target=self._timer_loop, daemon=True)
+            self._timer.start()
+
+    def stop_timer(self):
+        self._running = False
+        self._timer = None
+
+    def reconcile(self, client):
+        """
+        Reloads the current candle of every timeframe from REST and emits the closed candles missed while the
+        websocket was down. Live trades arriving meanwhile are held back; once the REST candles are in, the ones
+        they don't contain are added. Which ones those are is decided by trade id: a kline counts the trades from
+        the first trade of its candle on, so it contains the ids up to first id + number of trades - 1.
+        :param client: BinanceFuturesClient (only make_request is used)
+        """
+        with self._lock:
+            if self._recording is None:
+                self._recording = list()
+        fetched: typing.Dict[str, typing.Tuple[list, typing.Optional[int]]] = dict()
+        try:
+            for interval in self.intervals:
+                params = {'pair': self.symbol, 'contractType': "PERPETUAL", 'interval': interval}
+                last = self.last_closed[interval]
+                if last is not None:
+                    params['startTime'] = last.end_timestamp + 1
+                    params['limit'] = 1500
+                else:
+                    params['limit'] = 1
+                klines = client.make_request("GET", "/fapi/v1/continuousKlines", params)
+                if not klines:
+                    logger.error("Candle Builder | Reconcile failed for %s %s.", self.symbol, interval)
+                    continue
+                fetched[interval] = (klines, self._last_trade_id(client, klines[-1]))
+        finally:
+            with self._lock:
+                recorded, self._recording = self._recording, None
+                for interval in self.intervals:
+                    if interval not in fetched:
+                        # keeps the candle it had, with every trade held back
+                        for trade in recorded:
+                            self._add_trade([interval], *trade)
+                        continue
+                    klines, last_trade_id = fetched[interval]
+                    for kline in klines[:-1]:
+                        self._emit(interval, _from_kline(interval, kline))
+                    self.open_candles[interval] = _from_kline(interval, klines[-1])
+                    for trade in recorded:
+                        if last_trade_id is None or trade[1] > last_trade_id:
+                            self._add_trade([interval], *trade)
+        logger.info("Candle Builder | %s reconciled with REST klines, %s trades held back meanwhile.", self.symbol,
+                    len(recorded))
+
+    def _last_trade_id(self, client, kline: list) -> typing.Optional[int]:
+        """
+        Id of the last trade counted in a kline: the id of the first aggTrade at or after its open time plus its
+        number of trades - 1. -1 for a kline without trades, None if the lookup fails (every held back trade
+        is then added, trades already in the kline are counted twice).
+        """
+        if int(kline[8]) == 0:
+            return -1
+        first = client.make_request("GET", "/fapi/v1/aggTrades", {'symbol': self.symbol, 'startTime': int(kline[0]),
+                                                                   'limit': 1})
+        if not first:
+            logger.warning("Candle Builder | First trade of the %s candle at %s not found, trades received during"
+                           " reconcile may be counted twice.", self.symbol, kline[0])
+            return None
+        return int(first[0]['f']) + int(kline[8]) - 1
+
+
+def _from_kline(interval: str, kline: list) -> OpenCandle:
+    candle = OpenCandle(interval, int(kline[0]), float(kline[1]))
+    candle.high = float(kline[2])
+    candle.low = float(kline[3])
+    candle.close = float(kline[4])
+    candle.volume_base = float(kline[5])
+    candle.volume_quote = float(kline[7])
+    candle.num_of_trades = int(kline[8])
+    return candle
+
+
+if __name__ == '__main__':
+    # Reconcile while trades keep arriving: the REST kline already holds trade ids 100-109 of the open candle, the
+    # stream delivers 108-111 while the request is in flight. Only 110 and 111 may be added on top.
+    open_time = 1656633600000
+
+    class ReconnectingClient:
+        def __init__(self, builder: "CandleBuilder"):
+            self.builder = builder
+
+        def make_request(self, method, endpoint, params):
+            if endpoint == "/fapi/v1/aggTrades":
+                return [{'a': 50, 'p': "100", 'q': "1", 'f': 100, 'l': 100, 'T': open_time + 100}]
+            for trade_id in range(108, 112):
+                self.builder.on_agg_trade({'e': "aggTrade", 'T': open_time + 100 * trade_id, 'p': "101",
+                                           'q': "1", 'f': trade_id, 'l': trade_id, 'a': trade_id})
+            return [[open_time, "100", "101", "99", "101", "10", open_time + 59999, "1000", 10]]
+
+    builder = CandleBuilder("BTCUSDT", ["1m"])
+    builder.reconcile(ReconnectingClient(builder))
+    candle = builder.open_candles["1m"]
+    print(f"after reconcile: {candle.num_of_trades} trades (expected 12), volume {candle.volume_base} (expected 12.0)")
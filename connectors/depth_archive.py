@@ -0,0 +1,465 @@
+import datetime as dt
+import io
+import json
+import logging
+import os
+import tarfile
+import threading
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+
+import numpy as np
+import pandas as pd
+import requests
+from dateutil.relativedelta import relativedelta
+
+import logkeeper
+from connectors.http_transport import HttpTransport
+from connectors.market_recorder import MarketRecorder, RECORD_DTYPES
+from connectors.retry import DEFAULT_POLICY, is_retryable
+
+logger = logging.getLogger("depth_archive.py")
+logkeeper.log_keeper("connectors.log", "depth_archive.py")
+
+DEPTH_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "depth_datas")
+SAPI_URL = "https://api.binance.com"    # historical data endpoints live on the spot api, not on fapi
+STATE_VERSION = 1
+
+DEPTH_SYMBOLS = ["BTCUSDT", "ADAUSDT", "LINKUSDT", "MANAUSDT", "ETHUSDT", "LTCUSDT", "1000SHIBUSDT", "SOLUSDT",
+                 "AVAXUSDT", "DYDXUSDT", "BCHUSDT", "XRPUSDT", "EOSUSDT", "TRXUSDT", "ETCUSDT", "BNBUSDT", "DOGEUSDT",
+                 "MKRUSDT", "BATUSDT", "ANKRUSDT"]
+
+# Job status, in the order a job goes through them.
+PLANNED, REQUESTED, READY, DOWNLOADED, DECODED, FAILED = \
+    "planned", "requested", "ready", "downloaded", "decoded", "failed"
+
+
+def _utc(ts: int) -> dt.datetime:
+    return dt.datetime.fromtimestamp(ts / 1000, tz=dt.timezone.utc)
+
+
+def _ms(moment: dt.datetime) -> int:
+    return int(moment.timestamp() * 1000)
+
+
+def plan_windows(start_time: int, end_time: int,
+                 step: relativedelta = relativedelta(months=1)) -> typing.List[typing.Tuple[int, int]]:
+    """
+    Splits [start_time, end_time] (ms) into windows of step, on whole UTC days so that every day of data comes from
+    exactly one archive. The exchange recommends 1-3 months per request for tick level depth.
+    :return: (start ms, end ms) per window, end inclusive.
+    """
+    start = _utc(start_time).replace(hour=0, minute=0, second=0, microsecond=0)
+    end = _utc(end_time)
+    end_day = end.replace(hour=0, minute=0, second=0, microsecond=0)
+    if end_day < end:
+        end_day += dt.timedelta(days=1)
+    windows = list()
+    while start < end_day:
+        stop = min(start + step, end_day)
+        windows.append((_ms(start), _ms(stop) - 1))
+        start = stop
+    return windows
+
+
+def _days(start_time: int, end_time: int) -> typing.List[str]:
+    first = _utc(start_time).date()
+    return [(first + dt.timedelta(days=i)).isoformat() for i in range((_utc(end_time).date() - first).days + 1)]
+
+
+class _MemberReader(io.RawIOBase):
+    """
+    Forward-only reader of a member of a streamed ("r|") tar. tarfile's own member file asks the underlying gzip
+    stream whether it is seekable, which that stream does not answer, and pandas and tarfile both ask.
+    """
+    def __init__(self, archive: tarfile.TarFile, member: tarfile.TarInfo):
+        self._archive = archive
+        self._remaining = member.size
+        archive.fileobj.seek(member.offset_data)
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        size = min(len(buffer), self._remaining)
+        if size <= 0:
+            return 0
+        data = self._archive.fileobj.read(size)
+        buffer[:len(data)] = data
+        self._remaining -= len(data)
+        return len(data)
+
+
+class DepthArchivePipeline:
+    """
+    Historical order book archives from request to columnar files:
+        plan windows -> POST /sapi/v1/futuresHistDataId -> poll GET /sapi/v1/downloadLink until the link is ready
+        -> download (concurrent, resumed from the partial file) -> stream-decode the CSVs into MarketRecorder segments
+    Every step is recorded in root/jobs.json, so an interrupted run continues where it stopped. Decoding reads the
+    tar.gz as a stream and the CSVs in chunks, an archive is never unpacked on disk or loaded whole.
+    The result is a recording readable with MarketReplay(root/store): depthSnapshot and depthUpdate segments per day.
+    """
+    def __init__(self, client, root=DEPTH_DIR, data_type="T_DEPTH", max_downloads=4, max_decoders=2,
+                 poll_interval=60.0, sapi_url=SAPI_URL, chunk_rows=500000, max_download_attempts=5,
+                 keep_archives=True):
+        """
+        :param client: BinanceFuturesClient, its keys sign the requests.
+        :param root: folder for jobs.json, archives/ and store/
+        :param data_type: T_DEPTH (tick level order book) or S_DEPTH (snapshots).
+        :param max_downloads: archives downloaded at the same time.
+        :param max_decoders: archives decoded at the same time.
+        :param poll_interval: seconds between downloadLink polls of a job whose link is being prepared.
+        :param chunk_rows: CSV rows parsed at a time, bounds the memory used by decoding.
+        :param keep_archives: False deletes an archive once it is decoded.
+        """
+        self.client = client
+        self.root = root
+        self.data_type = data_type
+        self.max_downloads = max_downloads
+        self.max_decoders = max_decoders
+        self.poll_interval = poll_interval
+        self.chunk_rows = chunk_rows
+        self.max_download_attempts = max_download_attempts
+        self.keep_archives = keep_archives
+        self.archive_dir = os.path.join(root, "archives")
+        self.state_path = os.path.join(root, "jobs.json")
+        self.sapi = HttpTransport(sapi_url, client._header)
+        # archive links are presigned urls of another host, the api key is not sent there
+        self.files = HttpTransport("", pool_size=max_downloads)
+        self.store = MarketRecorder(os.path.join(root, "store"))
+        self.jobs: typing.Dict[str, dict] = dict()
+        self._lock = threading.Lock()
+        self._polled_at: typing.Dict[str, float] = dict()
+        self._load_state()
+
+    # ----- state -----
+
+    def _load_state(self):
+        if not os.path.exists(self.state_path):
+            return
+        with open(self.state_path) as file:
+            data = json.load(file)
+        if data.get('version') == STATE_VERSION:
+            self.jobs = data['jobs']
+
+    def _save_state(self):
+        with self._lock:
+            os.makedirs(self.root, exist_ok=True)
+            with open(self.state_path + ".tmp", "w") as file:
+                json.dump({'version': STATE_VERSION, 'jobs': self.jobs}, file, indent=1)
+            os.replace(self.state_path + ".tmp", self.state_path)
+
+    def _set(self, key: str, **fields):
+        with self._lock:
+            self.jobs[key].update(fields)
+        self._save_state()
+
+    # ----- exchange requests -----
+
+    def _signed(self, method: str, endpoint: str, params: dict) -> typing.Optional[dict]:
+        for attempt in range(1, DEFAULT_POLICY.max_attempts + 1):
+            signed = dict(params, timestamp=int(time.time() * 1000))
+            signed['signature'] = self.client._get_signature(signed)
+            response, error = None, None
+            try:
+                response = self.sapi.request(method, endpoint, signed)
+            except requests.RequestException as e:
+                error = e
+            if response is not None and response.status_code == 200:
+                return response.json()
+            if attempt == DEFAULT_POLICY.max_attempts or not is_retryable(response, error):
+                break
+            time.sleep(DEFAULT_POLICY.delay(attempt))
+        logger.error("Depth Archive | %s %s failed: %s", method, endpoint,
+                     error if response is None else response.text[:200])
+        return None
+
+    def request_id(self, symbol: str, start_time: int, end_time: int) -> typing.Optional[dict]:
+        """:return: {'id': download id, ...} of one archive request."""
+        return self._signed("POST", "/sapi/v1/futuresHistDataId",
+                            {'symbol': symbol.upper().strip(), 'startTime': int(start_time),
+                             'endTime': int(end_time), 'dataType': self.data_type})
+
+    def link(self, download_id: int) -> typing.Optional[dict]:
+        """:return: {'link': url or "Link is preparing...", 'expirationTime': seconds}"""
+        return self._signed("GET", "/sapi/v1/downloadLink", {'downloadId': download_id})
+
+    # ----- steps -----
+
+    def plan(self, symbols: typing.Iterable[str], start_time: int, end_time: int, months=1,
+             step: typing.Optional[relativedelta] = None) -> typing.List[str]:
+        """Adds a job per (symbol, window). Known jobs keep their progress. :return: the job keys."""
+        if not 1 <= months <= 3:
+            logger.warning("Depth Archive | %s months per request, the exchange recommends 1-3.", months)
+        keys = list()
+        for symbol in symbols:
+            for start, end in plan_windows(int(start_time), int(end_time), step or relativedelta(months=months)):
+                key = f"{symbol}_{self.data_type}_{_utc(start).date()}_{_utc(end).date()}"
+                with self._lock:
+                    self.jobs.setdefault(key, {'symbol': symbol, 'start': start, 'end': end, 'status': PLANNED})
+                keys.append(key)
+        self._save_state()
+        return keys
+
+    def request_ids(self, keys: typing.List[str]):
+        for key in keys:
+            job = self.jobs[key]
+            if job['status'] != PLANNED:
+                continue
+            info = self.request_id(job['symbol'], job['start'], job['end'])
+            if info is not None and 'id' in info:
+                self._set(key, download_id=info['id'], status=REQUESTED)
+
+    def poll(self, key: str) -> bool:
+        """:return: True once the job's link is ready."""
+        self._polled_at[key] = time.time()
+        info = self.link(self.jobs[key]['download_id'])
+        if info is None or not str(info.get('link', "")).startswith("http"):
+            return False
+        self._set(key, link=info['link'], expires=info.get('expirationTime'), status=READY)
+        return True
+
+    def _archive_path(self, key: str) -> str:
+        return os.path.join(self.archive_dir, f"{key}.tar.gz")
+
+    def download(self, key: str) -> bool:
+        """Downloads the job's archive, resuming a partial file. :return: True when it is complete."""
+        job = self.jobs[key]
+        path = self._archive_path(key)
+        part = path + ".part"
+        os.makedirs(self.archive_dir, exist_ok=True)
+        for attempt in range(1, self.max_download_attempts + 1):
+            if job.get('expires') and time.time() > job['expires']:
+                logger.info("Depth Archive | Link of %s expired, asking for a new one.", key)
+                self._set(key, link=None, status=REQUESTED)
+                return False
+            offset = os.path.getsize(part) if os.path.exists(part) else 0
+            headers = {'Range': f"bytes={offset}-"} if offset else None
+            try:
+                response = self.files.request("GET", job['link'], headers=headers, stream=True,
+                                              timeout=(self.files.timeout[0], 60))
+                if response.status_code in (403, 404):
+                    self._set(key, link=None, status=REQUESTED)
+                    return False
+                response.raise_for_status()
+                # a server that ignores Range sends the whole file again
+                mode = "ab" if offset and response.status_code == 206 else "wb"
+                with open(part, mode) as file:
+                    for chunk in response.iter_content(chunk_size=1 << 20):
+                        file.write(chunk)
+                expected = int(response.headers.get('Content-Length', -1))
+                received = os.path.getsize(part) - (offset if mode == "ab" else 0)
+                if expected >= 0 and received < expected:
+                    raise requests.ConnectionError(f"{received} of {expected} bytes received")
+                os.replace(part, path)
+                self._set(key, status=DOWNLOADED, size=os.path.getsize(path))
+                return True
+            except requests.RequestException as e:
+                logger.warning("Depth Archive | Download of %s interrupted (attempt %s): %s", key, attempt, e)
+                time.sleep(DEFAULT_POLICY.delay(attempt))
+        self._set(key, status=FAILED, error="download failed")
+        return False
+
+    def decode(self, key: str) -> int:
+        """
+        Streams the archive's CSVs (also nested daily archives) into the store.
+        :return: number of records written.
+        """
+        job = self.jobs[key]
+        # a decode that was interrupted left part of these days behind
+        for day in _days(job['start'], job['end']):
+            self.store.discard(job['symbol'], day)
+        written = 0
+        with tarfile.open(self._archive_path(key), mode="r|gz") as archive:
+            written += self._decode_tar(archive, job['symbol'])
+        self.store.flush()
+        if not self.keep_archives:
+            os.remove(self._archive_path(key))
+        self._set(key, status=DECODED, records=written)
+        logger.info("Depth Archive | %s decoded: %s records.", key, written)
+        return written
+
+    def _decode_tar(self, archive: tarfile.TarFile, symbol: str) -> int:
+        written = 0
+        for member in archive:
+            if not member.isfile():
+                continue
+            stream = io.BufferedReader(_MemberReader(archive, member), 1 << 20)
+            if member.name.endswith((".tar.gz", ".tgz")):
+                with tarfile.open(fileobj=stream, mode="r|gz") as inner:
+                    written += self._decode_tar(inner, symbol)
+            elif member.name.endswith(".csv"):
+                written += self._decode_csv(stream, symbol)
+        return written
+
+    def _decode_csv(self, stream: typing.BinaryIO, symbol: str) -> int:
+        """
+        Columns of the exchange's depth CSVs (the snapshot file also has trans_id, the update file has pu):
+        symbol,timestamp,[trans_id,]first_update_id,last_update_id,side,update_type,price,qty[,pu]
+        update_type is 'snap' for rows of a full book and 'set' for diffs.
+        """
+        written = 0
+        dtype = RECORD_DTYPES["depthUpdate"]
+        for chunk in pd.read_csv(stream, chunksize=self.chunk_rows):
+            records = np.empty(len(chunk), dtype=dtype)
+            records['event_time'] = chunk['timestamp'].to_numpy()
+            records['transaction_time'] = chunk['trans_id'].to_numpy() if 'trans_id' in chunk \
+                else records['event_time']
+            records['first_update_id'] = chunk['first_update_id'].to_numpy()
+            records['final_update_id'] = chunk['last_update_id'].to_numpy()
+            records['previous_update_id'] = chunk['pu'].to_numpy() if 'pu' in chunk else -1
+            records['is_ask'] = (chunk['side'] == "a").to_numpy()
+            records['price'] = chunk['price'].to_numpy()
+            records['quantity'] = chunk['qty'].to_numpy()
+            is_snapshot = (chunk['update_type'] == "snap").to_numpy()
+            self.store.append(symbol, "depthSnapshot", records[is_snapshot])
+            self.store.append(symbol, "depthUpdate", records[~is_snapshot])
+            written += len(records)
+        return written
+
+    # ----- pipeline -----
+
+    def run(self, symbols: typing.Iterable[str], start_time: int, end_time: int, months=1,
+            timeout: typing.Optional[float] = None) -> typing.Dict[str, str]:
+        """
+        Runs every step for every (symbol, window) until all are decoded or failed. Links are polled while other
+        archives download and decode.
+        :param timeout: seconds to give up after (links of long ranges can take hours); a later run resumes.
+        :return: job key -> status
+        """
+        keys = self.plan(symbols, start_time, end_time, months)
+        self.request_ids(keys)
+        deadline = time.time() + timeout if timeout is not None else None
+        in_flight: typing.Dict[str, Future] = dict()
+        with ThreadPoolExecutor(self.max_downloads, thread_name_prefix="depth-download") as downloads, \
+                ThreadPoolExecutor(self.max_decoders, thread_name_prefix="depth-decode") as decoders:
+            while True:
+                for key, future in list(in_flight.items()):
+                    if future.done():
+                        del in_flight[key]
+                        if future.exception() is not None:
+                            logger.error("Depth Archive | %s failed: %s", key, future.exception())
+                            self._set(key, status=FAILED, error=str(future.exception()))
+                open_keys = [key for key in keys if self.jobs[key]['status'] not in (DECODED, FAILED)]
+                if not open_keys or deadline is not None and time.time() > deadline:
+                    break
+                for key in open_keys:
+                    if key in in_flight:
+                        continue
+                    status = self.jobs[key]['status']
+                    if status == PLANNED:
+                        self.request_ids([key])
+                    elif status == REQUESTED:
+                        if time.time() - self._polled_at.get(key, 0) >= self.poll_interval and self.poll(key):
+                            in_flight[key] = downloads.submit(self.download, key)
+                    elif status == READY:
+                        in_flight[key] = downloads.submit(self.download, key)
+                    elif status == DOWNLOADED:
+                        in_flight[key] = decoders.submit(self.decode, key)
+                if in_flight:
+                    wait(list(in_flight.values()), timeout=self.poll_interval, return_when=FIRST_COMPLETED)
+                else:
+                    time.sleep(min(self.poll_interval, 1.0))
+        return {key: self.jobs[key]['status'] for key in keys}
+
+
+if __name__ == '__main__':
+    # Three months of two symbols against a local stand-in: links are "preparing" for the first polls and
+    # one download breaks halfway. Each archive nests daily tar.gz files like the exchange's.
+    import io
+    import tempfile
+    from connectors.local_exchange import LocalExchange
+    from connectors.market_recorder import MarketReplay
+
+    rows_per_day = 20000
+
+    def daily_csv(symbol: str, day: dt.date, snapshot: bool) -> bytes:
+        base = int(dt.datetime(day.year, day.month, day.day, tzinfo=dt.timezone.utc).timestamp() * 1000)
+        rng = np.random.default_rng(day.toordinal())
+        if snapshot:
+            n = 200
+            frame = pd.DataFrame({'symbol': symbol, 'timestamp': base, 'trans_id': base, 'first_update_id': 1,
+                                  'last_update_id': 1, 'side': np.where(np.arange(n) < n // 2, "b", "a"),
+                                  'update_type': "snap", 'price': 20000 + np.arange(n) * 0.1 - 10,
+                                  'qty': rng.random(n).round(3)})
+        else:
+            ids = np.arange(2, rows_per_day + 2)
+            frame = pd.DataFrame({'symbol': symbol, 'timestamp': base + np.arange(rows_per_day) * 4,
+                                  'first_update_id': ids, 'last_update_id': ids, 'side': rng.choice(["a", "b"], rows_per_day),
+                                  'update_type': "set", 'price': (20000 + rng.normal(0, 5, rows_per_day)).round(1),
+                                  'qty': rng.random(rows_per_day).round(3), 'pu': ids - 1})
+        return frame.to_csv(index=False).encode()
+
+    def tar_gz(files: typing.Dict[str, bytes]) -> bytes:
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode="w:gz", compresslevel=1) as archive:
+            for name, content in files.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                archive.addfile(info, io.BytesIO(content))
+        return buffer.getvalue()
+
+    class LocalClient:
+        _header = {"X-MBX-APIKEY": "key"}
+
+        @staticmethod
+        def _get_signature(data: dict) -> str:
+            return "signature"
+
+    def window_archive(symbol: str, start: int, end: int) -> bytes:
+        daily = dict()
+        for day in _days(start, end):
+            date = dt.date.fromisoformat(day)
+            daily[f"{symbol}_T_DEPTH_{day}.tar.gz"] = tar_gz({
+                f"{symbol}_T_DEPTH_{day}_depth_snap.csv": daily_csv(symbol, date, True),
+                f"{symbol}_T_DEPTH_{day}_depth_update.csv": daily_csv(symbol, date, False)})
+        return tar_gz(daily)
+
+    symbols = ["BTCUSDT", "ETHUSDT"]
+    start = _ms(dt.datetime(2022, 4, 1, tzinfo=dt.timezone.utc))
+    end = _ms(dt.datetime(2022, 6, 30, 23, 59, tzinfo=dt.timezone.utc))
+    # built up front, the exchange prepares them while the link is "preparing"
+    archives = {(symbol, window_start, window_end): window_archive(symbol, window_start, window_end)
+                for symbol in symbols for window_start, window_end in plan_windows(start, end)}
+    requests_by_id: typing.Dict[int, dict] = dict()
+    polls: typing.Dict[int, int] = dict()
+
+    with LocalExchange() as exchange:
+        def hist_data_id(method, params):
+            download_id = len(requests_by_id) + 1
+            requests_by_id[download_id] = params
+            return 200, {"id": download_id, "s": "OK"}, {}
+
+        def download_link(method, params):
+            download_id = int(params['downloadId'])
+            polls[download_id] = polls.get(download_id, 0) + 1
+            if polls[download_id] < 3:
+                return 200, {"expirationTime": None, "link": "Link is preparing; please request later."}, {}
+            request = requests_by_id[download_id]
+            path = f"/archives/{download_id}.tar.gz"
+            content = archives[(request['symbol'], int(request['startTime']), int(request['endTime']))]
+            exchange.add_file(path, content, drop_after=len(content) // 2 if download_id == 1 else None)
+            return 200, {"expirationTime": int(time.time()) + 3600, "link": exchange.base_url + path}, {}
+
+        exchange.add_route("POST", "/sapi/v1/futuresHistDataId", hist_data_id)
+        exchange.add_route("GET", "/sapi/v1/downloadLink", download_link)
+
+        root = tempfile.mkdtemp()
+        pipeline = DepthArchivePipeline(LocalClient(), root, sapi_url=exchange.base_url, poll_interval=0.05,
+                                        chunk_rows=50000)
+        ts = time.perf_counter()
+        statuses = pipeline.run(symbols, start, end, months=1)
+        elapsed = time.perf_counter() - ts
+
+    archive_bytes = sum(job.get('size', 0) for job in pipeline.jobs.values())
+    records = sum(job.get('records', 0) for job in pipeline.jobs.values())
+    print(f"{len(statuses)} windows {set(statuses.values())} in {elapsed:.2f}s: {archive_bytes / 1e6:.1f} MB of"
+          f" archives, {records:,} rows decoded ({records / elapsed:,.0f} rows/s)")
+    print(f"link polls: {sum(polls.values())}, requests served: {exchange.requests_served}")
+    replay = MarketReplay(os.path.join(root, "store"))
+    first = next(replay.events(["ETHUSDT"], ["depthSnapshot"]))
+    print(f"{len(replay.segments())} day segments; first ETHUSDT snapshot at {first['E']} with"
+          f" {len(first['bids'])} bids / {len(first['asks'])} asks")
+    again = DepthArchivePipeline(LocalClient(), root, sapi_url=exchange.base_url)
+    print(f"a second run only reads jobs.json: {set(again.jobs[key]['status'] for key in statuses)}")
@@ -0,0 +1,119 @@
+import logging
+import threading
+import time
+import typing
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import logkeeper
+
+logger = logging.getLogger("http_transport.py")
+logkeeper.log_keeper("connectors.log", "http_transport.py")
+
+
+class HttpTransport:
+    """
+    Shared REST transport for the connectors. Every client owns one requests.Session whose connection pool keeps
+    TCP+TLS connections alive between calls, so only the first request to a host pays for the handshake.
+    """
+    def __init__(self, base_url: str, headers: typing.Optional[dict] = None, pool_size=10, connect_timeout=3.05,
+                 read_timeout=10.0):
+        """
+        :param base_url: prefix for endpoints, i.e. https://fapi.binance.com
+        :param headers: headers sent with every request (API key etc.)
+        :param pool_size: maximum number of kept-alive connections per host.
+        :param connect_timeout: seconds to wait while opening a connection.
+        :param read_timeout: seconds to wait for the server to respond.
+        """
+        self.base_url = base_url
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        if headers is not None:
+            self.session.headers.update(headers)
+
+    def request(self, method: str, endpoint: str, params: typing.Optional[dict] = None,
+                headers: typing.Optional[dict] = None, timeout=None, stream=False) -> requests.Response:
+        """
+        :param method: GET/POST/PUT/DELETE
+        :param endpoint: path appended to base_url, or a full url.
+        :param params: GET and DELETE send them as a query string, POST and PUT as a form body.
+        :param headers: extra headers for this request only.
+        :param timeout: overrides the (connect, read) timeout of the transport.
+        :param stream: do not download the body up front.
+        :return: requests.Response
+        """
+        method = method.strip().upper()
+        url = endpoint if endpoint.startswith("http") else self.base_url + endpoint
+        if timeout is None:
+            timeout = self.timeout
+        if method in ("GET", "DELETE"):
+            return self.session.request(method, url, params=params, headers=headers, timeout=timeout, stream=stream)
+        return self.session.request(method, url, data=params, headers=headers, timeout=timeout, stream=stream)
+
+    def prewarm(self, connections=None, endpoint="/fapi/v1/ping"):
+        """
+        Opens connections up front so the first trading requests don't pay for the handshake.
+        Requests are sent concurrently, otherwise the pool would keep reusing a single connection.
+        :param connections: number of connections to open, defaults to pool size.
+        :param endpoint: cheap endpoint to hit while warming up.
+        :return: number of connections that answered.
+        """
+        if connections is None:
+            connections = self.pool_size
+        connections = min(connections, self.pool_size)
+        succeeded = list()
+
+        def warm():
+            try:
+                response = self.request("GET", endpoint)
+                response.close()
+                succeeded.append(response.status_code)
+            except requests.RequestException as e:
+                logger.warning("HTTP Transport | Prewarm request to %s failed: %s", endpoint, e)
+
+        threads = [threading.Thread(target=warm) for _ in range(connections)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        logger.info("HTTP Transport | %s/%s connections prewarmed for %s", len(succeeded), connections,
+                    self.base_url)
+        return len(succeeded)
+
+    def close(self):
+        self.session.close()
+
+
+if __name__ == '__main__':
+    # Per-request latency with and without pooling against a local stand-in.
+    # handshake_delay simulates the TCP+TLS setup cost that a real exchange connection pays.
+    from connectors.local_exchange import LocalExchange
+
+    n_requests = 200
+    with LocalExchange(handshake_delay=0.005) as exchange:
+        timings = dict()
+
+        ts = time.perf_counter()
+        for _ in range(n_requests):
+            requests.get(exchange.base_url + "/fapi/v1/time")
+        timings["module-level requests.get"] = (time.perf_counter() - ts) / n_requests
+        opened_unpooled = exchange.connections_opened
+
+        transport = HttpTransport(exchange.base_url, pool_size=4)
+        transport.prewarm()
+        opened_before = exchange.connections_opened
+        ts = time.perf_counter()
+        for _ in range(n_requests):
+            transport.request("GET", "/fapi/v1/time")
+        timings["pooled HttpTransport"] = (time.perf_counter() - ts) / n_requests
+        opened_pooled = exchange.connections_opened - opened_before
+        transport.close()
+
+    for label, per_request in timings.items():
+        print(f"{label:<28} {per_request * 1000:8.3f} ms/request")
+    print(f"connections opened: unpooled={opened_unpooled} pooled(after prewarm)={opened_pooled}")
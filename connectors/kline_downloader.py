@@ -0,0 +1,190 @@
+import calendar
+import datetime as dt
+import json
+import logging
+import os
+import threading
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import logkeeper
+from models import Contract, TIME_ENUM_CONVERSION
+from connectors.candle_builder import candle_open_time, next_open_time
+from connectors.rate_limiter import PRIORITY_BACKFILL
+
+logger = logging.getLogger("kline_downloader.py")
+logkeeper.log_keeper("connectors.log", "kline_downloader.py")
+
+CHECKPOINT_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "kline_checkpoints")
+MAX_KLINE_LIMIT = 1500
+
+
+def _grid_window(interval: str, open_time: int, limit=MAX_KLINE_LIMIT) -> typing.Tuple[int, int]:
+    """
+    Grid window of `limit` candles holding the candle that opens at open_time. The grid counts candles from the first
+    one at or before the epoch: Monday 1969/12/29 for weeks (Binance weeks open on Monday), January 1970 for months.
+    :return: (open time of its first candle, close time of its last candle) in ms.
+    """
+    if interval == "1M":
+        def month_open_time(months: int) -> int:
+            return calendar.timegm((1970 + months // 12, months % 12 + 1, 1, 0, 0, 0)) * 1000
+
+        day = dt.datetime.fromtimestamp(open_time / 1000, tz=dt.timezone.utc)
+        months = (day.year - 1970) * 12 + day.month - 1
+        months -= months % limit
+        return month_open_time(months), month_open_time(months + limit) - 1
+    span = TIME_ENUM_CONVERSION[interval] * 60 * 1000 * limit
+    grid_start = open_time - (open_time - candle_open_time(0, interval)) % span
+    return grid_start, grid_start + span - 1
+
+
+class KlineDownloader:
+    """
+    Downloads continuous klines over arbitrary long ranges. The range is cut into non-overlapping windows of at most
+    1500 candles that are fetched concurrently, then stitched into one sorted, de-duplicated series.
+    Windows sit on a fixed grid of 1500 candles. Every complete one (whole grid window, last candle closed) is saved
+    under checkpoint_dir/{symbol}_{interval}, so an interrupted download resumes where it stopped and any later
+    download of an overlapping range reuses it, whatever its own start and end.
+    Request weight is paced by the client's RateLimiter, at backfill priority.
+    """
+    def __init__(self, client, max_workers=4, checkpoint_dir=CHECKPOINT_DIR):
+        """
+        :param client: BinanceFuturesClient (or anything with a compatible make_request)
+        :param max_workers: windows fetched at the same time.
+        :param checkpoint_dir: folder of finished windows, None to disable checkpoints.
+        """
+        self.client = client
+        self.max_workers = max_workers
+        self.checkpoint_dir = checkpoint_dir
+        self.gaps: typing.List[typing.Tuple[int, int]] = list()
+
+    @staticmethod
+    def plan_windows(interval: str, start_time: int, end_time: int,
+                     limit=MAX_KLINE_LIMIT) -> typing.List[typing.Tuple[int, int]]:
+        """
+        Splits [start_time, end_time] along a grid of `limit` candles (see _grid_window), so the same candles
+        always fall into the same window; only the first and last window may be cut short by the range.
+        :param interval: key of TIME_ENUM_CONVERSION
+        :param start_time: timestamp in ms
+        :param end_time: timestamp in ms
+        :return: list of (window_start, window_end) timestamps in ms, both inclusive.
+        """
+        start_time = candle_open_time(int(start_time), interval)
+        windows = list()
+        grid_start, grid_end = _grid_window(interval, start_time, limit)
+        while grid_start <= end_time:
+            windows.append((max(grid_start, start_time), min(grid_end, end_time)))
+            grid_start, grid_end = _grid_window(interval, grid_end + 1, limit)
+        return windows
+
+    def _checkpoint_folder(self, contract: Contract, interval: str) -> typing.Optional[str]:
+        if self.checkpoint_dir is None:
+            return None
+        folder = os.path.join(self.checkpoint_dir, f"{contract.symbol}_{interval}")
+        os.makedirs(folder, exist_ok=True)
+        return folder
+
+    @staticmethod
+    def _is_complete(interval: str, window: typing.Tuple[int, int]) -> bool:
+        """True if window is a whole grid window whose last candle has closed, i.e. its klines can't change."""
+        # one candle of slack for the local clock
+        return _grid_window(interval, window[0]) == window \
+            and next_open_time(window[1] + 1, interval) < time.time() * 1000
+
+    def _fetch_window(self, contract: Contract, interval: str, window: typing.Tuple[int, int],
+                      folder: typing.Optional[str]) -> typing.Optional[list]:
+        complete = self._is_complete(interval, window)
+        part_path = os.path.join(folder, f"{window[0]}.json") if folder is not None and complete else None
+        if part_path is not None and os.path.exists(part_path):
+            with open(part_path) as file:
+                return json.load(file)
+
+        step = TIME_ENUM_CONVERSION[interval] * 60 * 1000
+        params = dict()
+        params['pair'] = contract.symbol
+        params['contractType'] = "PERPETUAL"
+        params['interval'] = interval
+        params['startTime'] = window[0]
+        params['endTime'] = window[1]
+        # a short window asks for fewer candles, which also costs less weight (+1 as months are longer than step)
+        params['limit'] = min((window[1] - window[0]) // step + 2, MAX_KLINE_LIMIT)
+        klines = self.client.make_request("GET", "/fapi/v1/continuousKlines", params, priority=PRIORITY_BACKFILL)
+        if klines is None:
+            return None
+
+        if part_path is not None:
+            tmp_path = f"{part_path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w") as file:
+                json.dump(klines, file)
+            os.replace(tmp_path, part_path)     # a part file either exists complete or not at all
+        return klines
+
+    def stitch(self, interval: str, parts: typing.List[list]) -> typing.List[list]:
+        """
+        Joins window results into one series sorted by open time, dropping duplicates and recording gaps in self.gaps.
+        """
+        step = TIME_ENUM_CONVERSION[interval] * 60 * 1000
+        series = list()
+        self.gaps = list()
+        last_open = None
+        for kline in sorted((kline for part in parts for kline in part), key=lambda k: k[0]):
+            open_time = kline[0]
+            if last_open is not None:
+                if open_time == last_open:
+                    series[-1] = kline  # later copy of the same candle is the fresher one
+                    continue
+                # Month lengths vary, so 1M candles are only checked for order.
+                if interval != "1M" and open_time - last_open != step:
+                    self.gaps.append((last_open + step, open_time - step))
+            series.append(kline)
+            last_open = open_time
+        return series
+
+    def download(self, contract: Contract, interval: str, start_time, end_time,
+                 is_timestamp=True) -> typing.Optional[typing.List[list]]:
+        """
+        :param contract: Contract object of interested contract.
+        :param interval: 1m, 3m, 5m, 15m, 30m, 1h, 2h, 4h, 6h, 8h, 12h, 1d, 3d, 1w, 1M
+        :param start_time: in timestamp format OR '%Y/%m/%d %H:%M:%S' string format.
+        :param end_time: in timestamp format OR '%Y/%m/%d %H:%M:%S' string format.
+        :param is_timestamp: True if start_time and end_time are in timestamp format, false if string format.
+        :return: raw kline lists sorted by open time, None if some windows could not be downloaded (finished windows
+                 stay in the checkpoint, call again to resume).
+        """
+        if not is_timestamp:
+            start_time = time.mktime(dt.datetime.strptime(start_time, '%Y/%m/%d %H:%M:%S').timetuple()) * 1000
+            end_time = time.mktime(dt.datetime.strptime(end_time, '%Y/%m/%d %H:%M:%S').timetuple()) * 1000
+        start_time, end_time = int(start_time), int(end_time)
+
+        windows = self.plan_windows(interval, start_time, end_time)
+        folder = self._checkpoint_folder(contract, interval)
+        parts: typing.Dict[int, list] = dict()
+        failed = 0
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self._fetch_window, contract, interval, window, folder): window
+                       for window in windows}
+            for future in as_completed(futures):
+                window = futures[future]
+                try:
+                    klines = future.result()
+                except Exception as e:
+                    logger.error("Kline Downloader | Window %s failed for %s-%s: %s", window, contract.symbol,
+                                 interval, e)
+                    klines = None
+                if klines is None:
+                    failed += 1
+                else:
+                    parts[window[0]] = klines
+
+        if failed:
+            logger.error(f"Kline Downloader | {failed}/{len(windows)} windows failed for {contract.symbol}-{interval},"
+                         f" progress kept in {folder}.")
+            return None
+
+        series = self.stitch(interval, [parts[window[0]] for window in windows])
+        if self.gaps:
+            logger.warning(f"Kline Downloader | {len(self.gaps)} gaps in {contract.symbol}-{interval} series.")
+        logger.info(f"Kline Downloader | {len(series)} {interval} candles retrieved for {contract.symbol}"
+                    f" in {len(windows)} windows.")
+        return series
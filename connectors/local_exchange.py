@@ -0,0 +1,194 @@
+import json
+import threading
+import time
+import typing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# Local HTTP stand-in for the Binance REST API. Used by the benchmarks in the connectors package so that they can
+# run offline and without touching exchange rate limits.
+
+Route = typing.Callable[[str, dict], typing.Tuple[int, typing.Any, dict]]
+
+
+class _LocalExchangeServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128    # default backlog of 5 drops SYNs when many clients connect at once
+
+
+class _LocalExchangeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"   # keep-alive, otherwise every request gets a fresh connection anyway
+    disable_nagle_algorithm = True  # headers and body go out in separate writes
+
+    def setup(self):
+        super().setup()
+        # Simulated TCP+TLS handshake cost, paid once per new connection.
+        self.server.exchange.connections_opened += 1
+        if self.server.exchange.handshake_delay > 0:
+            time.sleep(self.server.exchange.handshake_delay)
+
+    def _handle(self, method: str):
+        exchange = self.server.exchange
+        parsed = urlparse(self.path)
+        params = {key: values[-1] for key, values in parse_qs(parsed.query).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            body = self.rfile.read(length).decode()
+            params.update({key: values[-1] for key, values in parse_qs(body).items()})
+
+        if method == "GET" and parsed.path in exchange.files:
+            self._send_file(parsed.path)
+            return
+        route = exchange.routes.get((method, parsed.path)) or exchange.routes.get(("*", parsed.path))
+        limit_headers = exchange.count_weight(method, parsed.path, params)
+        if limit_headers.get("Retry-After") is not None:
+            status, payload, headers = 429, {"code": -1003, "msg": "Too many requests."}, dict()
+        elif route is None:
+            status, payload, headers = 404, {"code": -1, "msg": f"Unknown endpoint {parsed.path}"}, dict()
+        else:
+            status, payload, headers = route(method, params)
+        exchange.requests_served += 1
+
+        if isinstance(payload, (bytes, bytearray)):
+            content = bytes(payload)
+            content_type = "application/octet-stream"
+        else:
+            content = json.dumps(payload).encode()
+            content_type = "application/json"
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        for key, value in list(headers.items()) + list(limit_headers.items()):
+            self.send_header(key, str(value))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _send_file(self, path: str):
+        # plain file download with Range support, like the S3 links of historical data archives
+        exchange = self.server.exchange
+        content, drop_after = exchange.files[path]
+        exchange.requests_served += 1
+        first = 0
+        range_header = self.headers.get("Range")
+        if range_header and range_header.startswith("bytes="):
+            first = int(range_header[len("bytes="):].split("-")[0])
+        self.send_response(206 if first else 200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(content) - first))
+        self.send_header("Accept-Ranges", "bytes")
+        if first:
+            self.send_header("Content-Range", f"bytes {first}-{len(content) - 1}/{len(content)}")
+        self.end_headers()
+        if drop_after is not None and len(content) - first > drop_after:
+            # the connection breaks once mid-transfer
+            exchange.files[path] = (content, None)
+            self.wfile.write(content[first:first + drop_after])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(content[first:])
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LocalExchange:
+    """
+    Minimal threaded HTTP/1.1 server answering Binance-like endpoints.
+    Routes are registered as (method, path) -> callable(method, params) returning (status, payload, headers).
+    Method "*" matches any method.
+    """
+    def __init__(self, host="127.0.0.1", port=0, handshake_delay=0.0):
+        self.handshake_delay = handshake_delay
+        self.connections_opened = 0
+        self.requests_served = 0
+        self.routes: typing.Dict[typing.Tuple[str, str], Route] = dict()
+        self.files: typing.Dict[str, typing.Tuple[bytes, typing.Optional[int]]] = dict()
+        self.weight_limit = None
+        self.weight_of = None
+        self.window_seconds = 60.0
+        self.used_weight = 0
+        self.accepted_weight = 0
+        self.rejected_requests = 0
+        self._window_start = 0.0
+        self._limit_lock = threading.Lock()
+        self._server = _LocalExchangeServer((host, port), _LocalExchangeHandler)
+        self._server.exchange = self
+        self._thread = None
+
+        self.add_route("GET", "/fapi/v1/ping", lambda method, params: (200, {}, {}))
+        self.add_route("GET", "/fapi/v1/time",
+                       lambda method, params: (200, {"serverTime": int(time.time() * 1000)}, {}))
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def add_route(self, method: str, path: str, route: Route):
+        self.routes[(method.upper(), path)] = route
+
+    def add_file(self, path: str, content: bytes, drop_after: typing.Optional[int] = None):
+        """
+        Serves content at path for GET, honouring Range requests.
+        :param drop_after: the first transfer is cut off after that many bytes, to test resumed downloads.
+        """
+        self.files[path] = (content, drop_after)
+
+    def enforce_limits(self, weight_per_minute: int, weight_of: typing.Callable[[str, str, dict], int],
+                       window_seconds=60.0):
+        """
+        Counts request weight per fixed window like the exchange does, reports it in X-MBX-USED-WEIGHT-1M and
+        answers 429 with Retry-After once the limit is exceeded.
+        :param weight_of: (method, path, params) -> weight, i.e. connectors.rate_limiter.request_weight
+        :param window_seconds: window length, shorten it to test pacing without waiting for whole minutes.
+        """
+        self.weight_limit = weight_per_minute
+        self.weight_of = weight_of
+        self.window_seconds = window_seconds
+
+    def count_weight(self, method: str, path: str, params: dict) -> dict:
+        if self.weight_limit is None:
+            return dict()
+        with self._limit_lock:
+            now = time.time()
+            window_start = now - now % self.window_seconds
+            if window_start != self._window_start:
+                self._window_start = window_start
+                self.used_weight = 0
+            weight = self.weight_of(method, path, params)
+            self.used_weight += weight
+            headers = {"X-MBX-USED-WEIGHT-1M": self.used_weight}
+            if self.used_weight > self.weight_limit:
+                self.rejected_requests += 1
+                headers["Retry-After"] = max(1, int(window_start + self.window_seconds - now + 0.999))
+            else:
+                self.accepted_weight += weight
+            return headers
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
@@ -0,0 +1,519 @@
+import collections
+import functools
+import heapq
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import typing
+
+import numpy as np
+
+import logkeeper
+from connectors.ws_dispatch import loads
+
+logger = logging.getLogger("market_recorder.py")
+logkeeper.log_keeper("connectors.log", "market_recorder.py")
+
+RECORD_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "market_data")
+RECORD_VERSION = 1   # bump when a record layout changes
+
+# One fixed-width record per aggTrade and bookTicker event, one per price level of a depthUpdate event
+# (the levels of one event share event_time and final_update_id and are stored next to each other).
+# depthSnapshot holds full books in the depthUpdate layout, i.e. the snapshots of historical depth archives.
+RECORD_DTYPES = {
+    "aggTrade": np.dtype([("event_time", "<i8"), ("trade_time", "<i8"), ("agg_id", "<i8"), ("first_id", "<i8"),
+                          ("last_id", "<i8"), ("price", "<f8"), ("quantity", "<f8"), ("is_buyer_maker", "u1")]),
+    "bookTicker": np.dtype([("event_time", "<i8"), ("transaction_time", "<i8"), ("update_id", "<i8"),
+                            ("bid_price", "<f8"), ("bid_quantity", "<f8"), ("ask_price", "<f8"),
+                            ("ask_quantity", "<f8")]),
+    "depthUpdate": np.dtype([("event_time", "<i8"), ("transaction_time", "<i8"), ("first_update_id", "<i8"),
+                             ("final_update_id", "<i8"), ("previous_update_id", "<i8"), ("is_ask", "u1"),
+                             ("price", "<f8"), ("quantity", "<f8")]),
+}
+RECORD_DTYPES["depthSnapshot"] = RECORD_DTYPES["depthUpdate"]
+LIVE_EVENT_TYPES = ("aggTrade", "bookTicker", "depthUpdate")    # the ones recorded from websocket messages
+REPLAY_CHUNK = 65536    # records turned into events at a time
+# Days kept open per (symbol, event type). Concurrent decoders of one symbol write different days; switching between
+# them must not close and re-scan (_recover) the other one's segment.
+OPEN_DAYS = 4
+
+
+def _rows(event_type: str, data: dict) -> typing.List[tuple]:
+    if event_type == "aggTrade":
+        return [(data['E'], data['T'], data['a'], data['f'], data['l'], float(data['p']), float(data['q']),
+                 data['m'])]
+    if event_type == "bookTicker":
+        return [(data['E'], data.get('T', data['E']), data['u'], float(data['b']), float(data['B']),
+                 float(data['a']), float(data['A']))]
+    head = (data['E'], data.get('T', data['E']), data['U'], data['u'], data.get('pu', -1))
+    return [head + (0, float(price), float(quantity)) for price, quantity in data['b']] + \
+        [head + (1, float(price), float(quantity)) for price, quantity in data['a']]
+
+
+@functools.lru_cache(maxsize=64)
+def _day_name(day_number: int) -> str:
+    return time.strftime("%Y-%m-%d", time.gmtime(day_number * 86400))
+
+
+def _day(ts: int) -> str:
+    return _day_name(ts // 86400000)
+
+
+class MarketRecorder:
+    """
+    Appends aggTrade, bookTicker and depthUpdate events to binary segment files, one per
+    root/SYMBOL/YYYY-MM-DD/<event type>.bin (UTC day of the event time), and keeps root/index.json with the
+    record count and time range of every segment.
+    Live recording (attach/start) keeps the raw websocket messages in a list on the reader thread and hands them
+    in batches to a writer process, which decodes and packs them at a lower priority; recording then costs the
+    process a list append per message instead of the decode and pack work holding the GIL.
+    """
+    def __init__(self, root=RECORD_DIR, flush_interval=1.0, index_interval=10.0, batch_size=4096, writer_nice=10):
+        """
+        :param root: folder of the recording.
+        :param flush_interval: most seconds a message waits in memory before it is sent to the writer.
+        :param index_interval: seconds between rewrites of index.json (it is always written on stop).
+        :param batch_size: messages per batch sent to the writer process.
+        :param writer_nice: niceness added to the writer process, so it yields to the live process on a busy CPU.
+        """
+        self.root = root
+        self.flush_interval = flush_interval
+        self.index_interval = index_interval
+        self.batch_size = batch_size
+        self.writer_nice = writer_nice
+        self.recorded = 0
+        self.index: typing.Dict[str, dict] = dict()
+        # (symbol, event type) -> {day: open segment}, least recently written day first
+        self._files: typing.Dict[typing.Tuple[str, str], "collections.OrderedDict[str, typing.BinaryIO]"] = dict()
+        self._append_lock = threading.Lock()
+        self._batch: typing.List[typing.Union[str, bytes]] = list()
+        self._batch_lock = threading.Lock()
+        self._batches: "queue.SimpleQueue" = queue.SimpleQueue()
+        self._sender: typing.Optional[threading.Thread] = None
+        self._process = None
+        self._connection = None
+        self._load_index()
+
+    def _load_index(self):
+        path = os.path.join(self.root, "index.json")
+        if not os.path.exists(path):
+            return
+        with open(path) as file:
+            data = json.load(file)
+        if data.get('version') == RECORD_VERSION:
+            self.index = data['segments']
+        else:
+            logger.warning("Market Recorder | %s has version %s, expected %s; the index is rebuilt.", path,
+                           data.get('version'), RECORD_VERSION)
+
+    def _write_index(self):
+        os.makedirs(self.root, exist_ok=True)
+        path = os.path.join(self.root, "index.json")
+        with open(path + ".tmp", "w") as file:
+            json.dump({'version': RECORD_VERSION, 'segments': self.index}, file)
+        os.replace(path + ".tmp", path)
+
+    def attach(self, dispatcher):
+        """
+        Records every aggTrade, bookTicker and depthUpdate message going through a MessageDispatcher. Only those
+        reach the writer process: user data stream messages (orders, balances) going through the same dispatcher
+        are not kept.
+        """
+        dispatcher.add_tap(self.record_raw, LIVE_EVENT_TYPES)
+
+    def record_raw(self, msg: typing.Union[str, bytes]):
+        """Called on the live path with a websocket message as received: a list append."""
+        with self._batch_lock:
+            self._batch.append(msg)
+            if len(self._batch) >= self.batch_size:
+                self._batches.put(self._batch)
+                self._batch = list()
+
+    def record(self, data: dict):
+        """Records an event that is already decoded."""
+        if data.get('e') in LIVE_EVENT_TYPES:
+            self.record_raw(json.dumps(data))
+
+    def start(self):
+        """Starts the writer process and the thread feeding it."""
+        if self._process is not None:
+            return
+        # not fork: the client runs websocket, listener and pool threads, a forked child would inherit their locks
+        # in whatever state they were. forkserver forks from a clean single-threaded server where there is one.
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+        self._connection, child = context.Pipe()
+        self._process = context.Process(target=_writer_main, args=(self.root, self.index_interval,
+                                                                   self.writer_nice, child),
+                                        daemon=True, name="market-recorder")
+        self._process.start()
+        child.close()
+        self._sender = threading.Thread(target=self._send_loop, daemon=True, name="market-recorder-sender")
+        self._sender.start()
+
+    def stop(self):
+        """Sends what is still buffered, waits for the writer to write it and the index, and reloads the index."""
+        if self._process is None:
+            return
+        with self._batch_lock:
+            batch, self._batch = self._batch, list()
+        self._batches.put(batch)
+        self._batches.put(None)
+        self._sender.join()
+        try:
+            self.recorded += self._connection.recv()
+        except EOFError:
+            logger.error("Market Recorder | The writer process exited without confirming the last batches.")
+        self._process.join()
+        self._connection.close()
+        self._process, self._sender, self._connection = None, None, None
+        self._load_index()
+
+    def _send_loop(self):
+        while True:
+            try:
+                batch = self._batches.get(timeout=self.flush_interval)
+            except queue.Empty:
+                with self._batch_lock:
+                    batch, self._batch = self._batch, list()
+            if batch is None:
+                self._connection.send(None)
+                return
+            if batch:
+                try:
+                    self._connection.send(batch)
+                except (OSError, ValueError) as e:
+                    logger.error("Market Recorder | %s messages could not be sent to the writer: %s", len(batch), e)
+
+    def _write_batch(self, batch: typing.List[dict]):
+        groups: typing.Dict[typing.Tuple[str, str, str], typing.List[tuple]] = dict()
+        for data in batch:
+            event_type = data.get('e')
+            if event_type not in RECORD_DTYPES:
+                continue
+            key = (data['s'], event_type, _day(data['E']))
+            groups.setdefault(key, list()).extend(_rows(event_type, data))
+        for (symbol, event_type, day), rows in groups.items():
+            if rows:
+                self._append_day(symbol, event_type, day, np.array(rows, dtype=RECORD_DTYPES[event_type]))
+        with self._append_lock:
+            for file in self._open_segments():
+                file.flush()
+
+    def append(self, symbol: str, event_type: str, records: np.ndarray):
+        """
+        Appends records that are already packed (dtype RECORD_DTYPES[event_type]), i.e. decoded archives.
+        Each run of records is written to the segment of its day.
+        """
+        if len(records) == 0:
+            return
+        days = records['event_time'] // 86400000
+        bounds = np.concatenate([[0], np.flatnonzero(days[1:] != days[:-1]) + 1, [len(records)]])
+        for first, last in zip(bounds[:-1], bounds[1:]):
+            self._append_day(symbol, event_type, _day_name(int(days[first])), records[first:last])
+
+    def _append_day(self, symbol: str, event_type: str, day: str, records: np.ndarray):
+        with self._append_lock:
+            self._segment_file(symbol, event_type, day).write(records.tobytes())
+            name = f"{symbol}/{day}/{event_type}"
+            entry = self.index.setdefault(name, {'records': 0, 'first': int(records['event_time'][0]),
+                                                 'last': int(records['event_time'][-1])})
+            entry['records'] += len(records)
+            entry['first'] = min(entry['first'], int(records['event_time'].min()))
+            entry['last'] = max(entry['last'], int(records['event_time'].max()))
+            self.recorded += len(records)
+
+    def discard(self, symbol: str, day: str):
+        """Deletes every segment of symbol on day, i.e. before decoding that day again."""
+        with self._append_lock:
+            for event_type in RECORD_DTYPES:
+                file = self._files.get((symbol, event_type), dict()).pop(day, None)
+                if file is not None:
+                    file.close()
+                path = os.path.join(self.root, symbol, day, f"{event_type}.bin")
+                if os.path.exists(path):
+                    os.remove(path)
+                self.index.pop(f"{symbol}/{day}/{event_type}", None)
+
+    def flush(self):
+        """Flushes the open segments and writes the index, for use without the writer thread."""
+        with self._append_lock:
+            for file in self._open_segments():
+                file.flush()
+            self._write_index()
+
+    def close(self):
+        with self._append_lock:
+            for file in self._open_segments():
+                file.close()
+            self._files = dict()
+            self._write_index()
+
+    def _open_segments(self) -> typing.List[typing.BinaryIO]:
+        return [file for days in self._files.values() for file in days.values()]
+
+    def _segment_file(self, symbol: str, event_type: str, day: str) -> typing.BinaryIO:
+        days = self._files.setdefault((symbol, event_type), collections.OrderedDict())
+        file = days.get(day)
+        if file is not None:
+            days.move_to_end(day)
+            return file
+        if len(days) >= OPEN_DAYS:
+            # a new day starts a new segment, the one written longest ago is closed
+            days.popitem(last=False)[1].close()
+        folder = os.path.join(self.root, symbol, day)
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f"{event_type}.bin")
+        if os.path.exists(path):
+            self._recover(path, f"{symbol}/{day}/{event_type}", RECORD_DTYPES[event_type])
+        file = open(path, "ab")
+        days[day] = file
+        return file
+
+    def _recover(self, path: str, name: str, dtype: np.dtype):
+        """
+        Appending to a segment of an earlier run: a half written record is cut off and the index entry is made to
+        match the file, which may hold records written after the index was last saved.
+        """
+        size = os.path.getsize(path)
+        count = size // dtype.itemsize
+        if size != count * dtype.itemsize:
+            logger.warning("Market Recorder | Cutting %s bytes of a torn record off %s.", size % dtype.itemsize, path)
+            os.truncate(path, count * dtype.itemsize)
+        if count == 0:
+            self.index.pop(name, None)
+            return
+        times = np.memmap(path, dtype=dtype, mode="r", shape=(count,))['event_time']
+        self.index[name] = {'records': count, 'first': int(times.min()), 'last': int(times.max())}
+
+
+def _writer_main(root: str, index_interval: float, nice: int, connection):
+    """Writer process: decodes the batches of raw messages and appends their events until it receives None."""
+    # the parent writes and rotates connectors.log, this process keeps its own file
+    logkeeper.redirect_loggers("market_recorder_writer.log")
+    if nice and hasattr(os, "nice"):
+        os.nice(nice)
+    recorder = MarketRecorder(root, index_interval=index_interval)
+    index_written = time.time()
+    while True:
+        try:
+            batch = connection.recv()
+        except EOFError:
+            batch = None
+        if batch is None:
+            break
+        events = list()
+        for msg in batch:
+            try:
+                data = loads(msg)
+            except ValueError:
+                continue
+            if isinstance(data, dict) and 'stream' in data and 'data' in data:
+                data = data['data']
+            if isinstance(data, dict) and data.get('e') in LIVE_EVENT_TYPES:
+                events.append(data)
+        try:
+            recorder._write_batch(events)
+        except Exception as e:
+            logger.error("Market Recorder | %s events could not be written: %s", len(events), e)
+        if time.time() - index_written > index_interval:
+            with recorder._append_lock:
+                recorder._write_index()
+            index_written = time.time()
+    recorder.close()
+    try:
+        connection.send(recorder.recorded)
+    except OSError:
+        pass
+    # the process ends with os._exit, atexit handlers don't run
+    logkeeper.stop_listeners()
+
+
+class MarketReplay:
+    """
+    Reads a recording back. Segments are memory-mapped; events of all requested symbols and types are merged in
+    event time order one day at a time, so memory use does not grow with the length of the recording.
+    """
+    def __init__(self, root=RECORD_DIR):
+        self.root = root
+        with open(os.path.join(root, "index.json")) as file:
+            data = json.load(file)
+        if data.get('version') != RECORD_VERSION:
+            raise ValueError(f"recording version {data.get('version')}, expected {RECORD_VERSION}")
+        self.index: typing.Dict[str, dict] = data['segments']
+
+    def segments(self, symbols: typing.Optional[typing.Iterable[str]] = None,
+                 event_types: typing.Optional[typing.Iterable[str]] = None, start_time: typing.Optional[int] = None,
+                 end_time: typing.Optional[int] = None) -> typing.List[typing.Tuple[str, str, str]]:
+        """(symbol, day, event type) of the segments overlapping the request, sorted by day."""
+        symbols = set(symbols) if symbols is not None else None
+        event_types = set(event_types) if event_types is not None else None
+        found = list()
+        for name, entry in self.index.items():
+            symbol, day, event_type = name.split("/")
+            if symbols is not None and symbol not in symbols or event_types is not None and event_type not in event_types:
+                continue
+            if start_time is not None and entry['last'] < start_time or end_time is not None and entry['first'] > end_time:
+                continue
+            found.append((symbol, day, event_type))
+        return sorted(found, key=lambda segment: (segment[1], segment[0], segment[2]))
+
+    def load(self, symbol: str, day: str, event_type: str) -> np.ndarray:
+        """Memory-mapped records of one segment (only the records listed in the index, a torn tail is ignored)."""
+        path = os.path.join(self.root, symbol, day, f"{event_type}.bin")
+        count = self.index[f"{symbol}/{day}/{event_type}"]['records']
+        return np.memmap(path, dtype=RECORD_DTYPES[event_type], mode="r", shape=(count,))
+
+    def events(self, symbols: typing.Optional[typing.Iterable[str]] = None,
+               event_types: typing.Optional[typing.Iterable[str]] = None, start_time: typing.Optional[int] = None,
+               end_time: typing.Optional[int] = None, speed: typing.Optional[float] = None) -> typing.Iterator[dict]:
+        """
+        Events as the websocket delivers them ({'e': 'aggTrade', 's': ..., ...}), in event time order.
+        :param speed: None replays as fast as possible, 1.0 in real time, 10.0 ten times faster.
+        """
+        segments = self.segments(symbols, event_types, start_time, end_time)
+        started, first_ts = None, None
+        for day in sorted({segment[1] for segment in segments}):
+            for ts, event in self._merge_day([s for s in segments if s[1] == day], start_time, end_time):
+                if speed is not None:
+                    if started is None:
+                        started, first_ts = time.perf_counter(), ts
+                    wait = (ts - first_ts) / 1000 / speed - (time.perf_counter() - started)
+                    if wait > 0:
+                        time.sleep(wait)
+                yield event
+
+    def _merge_day(self, segments: typing.List[typing.Tuple[str, str, str]], start_time, end_time):
+        streams = list()
+        for position, (symbol, day, event_type) in enumerate(segments):
+            records = self.load(symbol, day, event_type)
+            times = np.asarray(records['event_time'])
+            order = np.argsort(times, kind="stable") if np.any(times[1:] < times[:-1]) else None
+            if order is not None:
+                records, times = records[order], times[order]
+            first = np.searchsorted(times, start_time, side="left") if start_time is not None else 0
+            last = np.searchsorted(times, end_time, side="right") if end_time is not None else len(times)
+            if first < last:
+                streams.append(self._segment_events(symbol, event_type, records[first:last], position))
+        # segments are already sorted, so a k-way merge keeps the replay streaming
+        for ts, _, event in heapq.merge(*streams, key=lambda item: (item[0], item[1])):
+            yield ts, event
+
+    @staticmethod
+    def _segment_events(symbol: str, event_type: str, records: np.ndarray, position: int):
+        # converted chunk by chunk, a day of tick depth does not fit in python objects at once
+        chunks = (records[i:i + REPLAY_CHUNK].tolist() for i in range(0, len(records), REPLAY_CHUNK))
+        if event_type == "aggTrade":
+            for rows in chunks:
+                for e, t, a, f, l, p, q, m in rows:
+                    yield e, position, {'e': "aggTrade", 'E': e, 's': symbol, 'a': a, 'p': p, 'q': q, 'f': f,
+                                        'l': l, 'T': t, 'm': bool(m)}
+        elif event_type == "bookTicker":
+            for rows in chunks:
+                for e, t, u, b, bq, a, aq in rows:
+                    yield e, position, {'e': "bookTicker", 'u': u, 's': symbol, 'b': b, 'B': bq, 'a': a, 'A': aq,
+                                        'T': t, 'E': e}
+        else:
+            event = None
+            for rows in chunks:
+                for e, t, first_id, final_id, previous_id, is_ask, price, quantity in rows:
+                    if event is None or event['u'] != final_id or event['E'] != e:
+                        if event is not None:
+                            yield event['E'], position, _depth_event(event_type, event)
+                        event = {'e': event_type, 'E': e, 'T': t, 's': symbol, 'U': first_id, 'u': final_id,
+                                 'pu': previous_id, 'b': [], 'a': []}
+                    (event['a'] if is_ask else event['b']).append([price, quantity])
+            if event is not None:
+                yield event['E'], position, _depth_event(event_type, event)
+
+
+def _depth_event(event_type: str, event: dict) -> dict:
+    if event_type == "depthSnapshot":
+        # same keys as a /fapi/v1/depth response, plus the event and symbol
+        return {'e': event_type, 'E': event['E'], 'T': event['T'], 's': event['s'], 'lastUpdateId': event['u'],
+                'bids': event['b'], 'asks': event['a']}
+    return event
+
+
+if __name__ == '__main__':
+    # Cost of recording on the live path, write throughput, file size and a merged replay of 3 symbols.
+    import random
+    import tempfile
+    from connectors.ws_dispatch import MessageDispatcher
+
+    random.seed(5)
+    symbols = ["BTCUSDT", "ETHUSDT", "SOLUSDT"]
+    start = 1658016000000 - 30 * 60 * 1000   # 30 minutes before a UTC midnight, so segments rotate
+    messages = list()
+    for i in range(300000):
+        symbol, ts = symbols[i % 3], start + i * 12
+        kind = i % 10
+        if kind < 5:
+            data = {"e": "bookTicker", "u": i, "s": symbol, "b": "20000.1", "B": "1.5", "a": "20000.2", "A": "0.7",
+                    "T": ts, "E": ts}
+        elif kind < 8:
+            data = {"e": "aggTrade", "E": ts, "s": symbol, "a": i, "p": "20000.1", "q": "0.010", "f": i, "l": i,
+                    "T": ts, "m": True}
+        else:
+            data = {"e": "depthUpdate", "E": ts, "T": ts, "s": symbol, "U": i, "u": i + 3, "pu": i - 1,
+                    "b": [["20000.1", "1.2"], ["19999.9", "0"]], "a": [["20000.2", "3.1"]]}
+        messages.append(json.dumps(data))
+
+    def run_dispatcher(recorder: typing.Optional[MarketRecorder]) -> float:
+        dispatcher = MessageDispatcher(block_on_full=True)
+        for event_type in RECORD_DTYPES:
+            dispatcher.register(event_type, lambda data: None)
+        if recorder is not None:
+            recorder.attach(dispatcher)
+            recorder.start()
+        dispatcher.start()
+        ts = time.perf_counter()
+        for msg in messages:
+            dispatcher.dispatch(msg)
+        while any(not q.empty() for q in dispatcher._queues):
+            time.sleep(0.001)
+        elapsed = time.perf_counter() - ts
+        dispatcher.stop()
+        return elapsed
+
+    root = tempfile.mkdtemp()
+    plain = run_dispatcher(None)
+    recorder = MarketRecorder(root)
+    recorded = run_dispatcher(recorder)
+    ts = time.perf_counter()
+    recorder.stop()
+    drain = time.perf_counter() - ts
+
+    size = sum(os.path.getsize(os.path.join(folder, name)) for folder, _, names in os.walk(root) for name in names
+               if name.endswith(".bin"))
+    calls = 200000
+    probe = MarketRecorder(tempfile.mkdtemp())
+    ts = time.perf_counter()
+    for _ in range(calls):
+        probe.record_raw(messages[0])
+    per_call = (time.perf_counter() - ts) / calls
+
+    print(f"dispatch of {len(messages)} events: {plain:.2f}s without recording, {recorded:.2f}s with recording"
+          f" ({recorded / plain:.2f}x), then {drain * 1000:.0f} ms for the writer process to finish on stop")
+    print(f"record_raw() on the live path: {per_call * 1e9:.0f} ns per message")
+    print(f"{recorder.recorded} records in {len(recorder.index)} segments, {size / len(messages):.1f} bytes per event"
+          f" vs {sum(map(len, messages)) / len(messages):.1f} bytes of json")
+
+    replay = MarketReplay(root)
+    ts = time.perf_counter()
+    count, previous, ordered = 0, 0, True
+    for event in replay.events():
+        ordered &= event['E'] >= previous
+        previous = event['E']
+        count += 1
+    elapsed = time.perf_counter() - ts
+    print(f"replay: {count} events merged over {len(replay.segments())} segments in {elapsed:.2f}s"
+          f" ({count / elapsed:,.0f} events/s), in time order: {ordered}")
+    ts = time.perf_counter()
+    paced = sum(1 for _ in replay.events(["BTCUSDT"], ["aggTrade"], start_time=start, end_time=start + 500,
+                                         speed=1.0))
+    print(f"paced replay of 500 ms of BTCUSDT trades: {paced} events in {time.perf_counter() - ts:.2f}s")
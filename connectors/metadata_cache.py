@@ -0,0 +1,237 @@
+import json
+import logging
+import os
+import threading
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+import logkeeper
+from models import Contract
+
+logger = logging.getLogger("metadata_cache.py")
+logkeeper.log_keeper("connectors.log", "metadata_cache.py")
+
+METADATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "metadata_cache")
+CACHE_VERSION = 1   # bump when the layout of the cache file changes
+
+
+class MetadataCache:
+    """
+    exchangeInfo and leverageBracket, fetched once, indexed by symbol and saved to disk.
+    A restart loads the file instead of calling the exchange; a file older than ttl is still served while a
+    background refresh replaces it. Commission rates are kept per symbol in the same file with their own ttl.
+    """
+    def __init__(self, client, name: str, cache_dir: typing.Optional[str] = METADATA_DIR, ttl=6 * 3600,
+                 commission_ttl=24 * 3600, on_refresh: typing.Optional[typing.Callable[["MetadataCache"], None]] = None):
+        """
+        :param client: BinanceFuturesClient (only make_request is used)
+        :param name: file name of the cache, keeps testnet and real account metadata apart.
+        :param cache_dir: folder of the cache file, None keeps everything in memory.
+        :param ttl: seconds until exchange info and leverage brackets are refreshed.
+        :param commission_ttl: seconds until a symbol's commission rates are fetched again.
+        :param on_refresh: called after a background refresh replaced the data.
+        """
+        self.client = client
+        self.path = os.path.join(cache_dir, f"{name}.json") if cache_dir is not None else None
+        self.ttl = ttl
+        self.commission_ttl = commission_ttl
+        self.on_refresh = on_refresh
+        self.fetched_at = 0.0
+        self.assets: typing.List[str] = list()
+        self.rate_limits: typing.List[dict] = list()
+        self.symbols: typing.Dict[str, dict] = dict()
+        self.leverage_brackets: typing.Dict[str, list] = dict()
+        self.commissions: typing.Dict[str, typing.Tuple[float, float, float]] = dict()
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    @property
+    def is_loaded(self) -> bool:
+        return bool(self.symbols)
+
+    @property
+    def is_fresh(self) -> bool:
+        return time.time() - self.fetched_at < self.ttl
+
+    def load(self) -> bool:
+        """Reads the cache file. False if it is missing, unreadable or written by another cache version."""
+        if self.path is None or not os.path.exists(self.path):
+            return False
+        try:
+            with open(self.path) as file:
+                data = json.load(file)
+        except (OSError, ValueError) as e:
+            logger.warning("Metadata Cache | Ignoring unreadable cache %s: %s", self.path, e)
+            return False
+        if data.get('version') != CACHE_VERSION:
+            logger.info("Metadata Cache | Cache %s has version %s, expected %s.", self.path, data.get('version'),
+                        CACHE_VERSION)
+            return False
+        with self._lock:
+            self.fetched_at = data['fetched_at']
+            self.assets = data['assets']
+            self.rate_limits = data['rate_limits']
+            self.symbols = data['symbols']
+            self.leverage_brackets = data['leverage_brackets']
+            self.commissions = {symbol: tuple(rates) for symbol, rates in data['commissions'].items()}
+        return True
+
+    def save(self):
+        if self.path is None:
+            return
+        # commission() saves from caller threads and the refresh from its own: one writer of the temp file at a
+        # time, and no dict changes while it is being dumped
+        with self._lock:
+            data = {'version': CACHE_VERSION, 'fetched_at': self.fetched_at, 'assets': self.assets,
+                    'rate_limits': self.rate_limits, 'symbols': self.symbols,
+                    'leverage_brackets': self.leverage_brackets, 'commissions': self.commissions}
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as file:
+                json.dump(data, file)
+            os.replace(tmp_path, self.path)
+
+    def fetch(self) -> bool:
+        """Downloads exchangeInfo and leverageBracket (one request each, concurrently) and saves them."""
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            info_future = executor.submit(self.client.make_request, "GET", "/fapi/v1/exchangeInfo", dict())
+            brackets_future = executor.submit(self.client.make_request, "GET", "/fapi/v1/leverageBracket", dict())
+            exchange_info, brackets = info_future.result(), brackets_future.result()
+        if exchange_info is None or brackets is None:
+            logger.error("Metadata Cache | Exchange info could not be downloaded.")
+            return False
+        with self._lock:
+            self.fetched_at = time.time()
+            self.assets = [asset['asset'] for asset in exchange_info['assets']]
+            self.rate_limits = exchange_info['rateLimits']
+            self.symbols = {info['symbol']: info for info in exchange_info['symbols']}
+            self.leverage_brackets = {each['symbol']: each['brackets'] for each in brackets}
+        self.save()
+        logger.info("Metadata Cache | %s symbols fetched from the exchange.", len(self.symbols))
+        return True
+
+    def ensure(self) -> bool:
+        """
+        Makes the metadata available as fast as possible: memory, then the cache file, then the exchange.
+        Stale data is returned right away and refreshed in the background.
+        :return: False only if nothing could be loaded at all.
+        """
+        if not self.is_loaded and not self.load():
+            return self.fetch()
+        if not self.is_fresh:
+            self.refresh_in_background()
+        return True
+
+    def refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def refresh():
+            try:
+                if self.fetch() and self.on_refresh is not None:
+                    self.on_refresh(self)
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def max_leverage(self, symbol: str) -> int:
+        brackets = self.leverage_brackets.get(symbol)
+        return brackets[0]['initialLeverage'] if brackets else int()
+
+    def contracts(self) -> typing.Dict[str, Contract]:
+        """Perpetual contracts that are trading and margined in a listed asset."""
+        assets = set(self.assets)
+        contract_dict = dict()
+        for symbol, info in self.symbols.items():
+            if info['contractType'] == "PERPETUAL" and info['status'] == "TRADING" and info['quoteAsset'] in assets:
+                contract_dict[symbol] = Contract("binance_futures", dict(info, leverage=self.max_leverage(symbol)))
+        return contract_dict
+
+    def commission(self, symbol: str) -> typing.Optional[typing.Tuple[float, float]]:
+        """(maker, taker) commission rate of symbol, fetched at most once per commission_ttl."""
+        cached = self.commissions.get(symbol)
+        if cached is not None and time.time() - cached[2] < self.commission_ttl:
+            return cached[0], cached[1]
+        rates = self.client.make_request("GET", "/fapi/v1/commissionRate", {'symbol': symbol})
+        if rates is None:
+            return (cached[0], cached[1]) if cached is not None else None
+        with self._lock:
+            self.commissions[symbol] = (float(rates["makerCommissionRate"]), float(rates["takerCommissionRate"]),
+                                        time.time())
+        self.save()
+        return self.commissions[symbol][0], self.commissions[symbol][1]
+
+
+if __name__ == '__main__':
+    # Startup cost of loading contracts: the old per-construction downloads vs a cold and a warm cache.
+    import tempfile
+    from connectors.http_transport import HttpTransport
+    from connectors.local_exchange import LocalExchange
+
+    n_symbols = 300
+    symbol_infos = [{"symbol": f"COIN{i}USDT", "pair": f"COIN{i}USDT", "contractType": "PERPETUAL",
+                     "status": "TRADING", "baseAsset": f"COIN{i}", "quoteAsset": "USDT", "marginAsset": "USDT",
+                     "requiredMarginPercent": "5.0000", "pricePrecision": 2, "quantityPrecision": 3,
+                     "filters": [{"filterType": "PRICE_FILTER", "tickSize": "0.10"},
+                                 {"filterType": "LOT_SIZE", "minQty": "0.001"},
+                                 {"filterType": "MARKET_LOT_SIZE"}, {"filterType": "MAX_NUM_ORDERS", "limit": 200},
+                                 {"filterType": "MAX_NUM_ALGO_ORDERS", "limit": 10}],
+                     "orderTypes": ["LIMIT", "MARKET", "STOP"], "timeInForce": ["GTC", "IOC", "FOK", "GTX"]}
+                    for i in range(n_symbols)]
+    exchange_info = {"assets": [{"asset": "USDT"}, {"asset": "BUSD"}], "symbols": symbol_infos,
+                     "rateLimits": [{"rateLimitType": "REQUEST_WEIGHT", "interval": "MINUTE", "limit": 2400}]}
+    brackets = [{"symbol": info["symbol"], "brackets": [{"bracket": 1, "initialLeverage": 20}]}
+                for info in symbol_infos]
+
+    class LocalClient:
+        def __init__(self, base_url):
+            self.transport = HttpTransport(base_url)
+
+        def make_request(self, method, endpoint, params, priority=None):
+            return self.transport.request(method, endpoint, params).json()
+
+        def old_get_current_contracts(self):
+            info = self.make_request("GET", "/fapi/v1/exchangeInfo", dict())
+            leverage_finder = self.make_request("GET", "/fapi/v1/leverageBracket", dict())
+            assets = [asset['asset'] for asset in self.make_request("GET", "/fapi/v1/exchangeInfo", dict())['assets']]
+            contract_dict = dict()
+            for contract in info['symbols']:
+                if contract['contractType'] == "PERPETUAL" and contract['status'] == "TRADING" \
+                        and contract['quoteAsset'] in assets:
+                    for each in leverage_finder:
+                        if each['symbol'] == contract['symbol']:
+                            contract['leverage'] = each["brackets"][0]['initialLeverage']
+                    contract_dict[contract['symbol']] = Contract("binance_futures", contract)
+            return contract_dict
+
+    with LocalExchange(handshake_delay=0.005) as exchange:
+        exchange.add_route("GET", "/fapi/v1/exchangeInfo", lambda method, params: (200, exchange_info, {}))
+        exchange.add_route("GET", "/fapi/v1/leverageBracket", lambda method, params: (200, brackets, {}))
+        client = LocalClient(exchange.base_url)
+        cache_dir = tempfile.mkdtemp()
+
+        ts = time.perf_counter()
+        old = client.old_get_current_contracts()
+        old_time = time.perf_counter() - ts
+
+        ts = time.perf_counter()
+        cache = MetadataCache(client, "bench", cache_dir)
+        cache.ensure()
+        cold = cache.contracts()
+        cold_time = time.perf_counter() - ts
+
+        served = exchange.requests_served
+        ts = time.perf_counter()
+        cache = MetadataCache(client, "bench", cache_dir)
+        cache.ensure()
+        warm = cache.contracts()
+        warm_time = time.perf_counter() - ts
+        warm_requests = exchange.requests_served - served
+
+    print(f"old get_current_contracts: {len(old)} contracts in {old_time * 1000:.1f} ms (3 requests)")
+    print(f"cold cache:                {len(cold)} contracts in {cold_time * 1000:.1f} ms (2 requests)")
+    print(f"warm cache:                {len(warm)} contracts in {warm_time * 1000:.1f} ms ({warm_requests} requests)")
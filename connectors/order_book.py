@@ -0,0 +1,327 @@
+import bisect
+import logging
+import threading
+import time
+import typing
+
+import logkeeper
+
+logger = logging.getLogger("order_book.py")
+logkeeper.log_keeper("connectors.log", "order_book.py")
+
+MAX_BUFFERED_EVENTS = 10000     # events kept while waiting for a snapshot, the oldest are dropped beyond it
+SNAPSHOT_MAX_DELAY = 30.0       # seconds, cap of the backoff between snapshot attempts
+
+
+class PriceLevels:
+    """
+    One side of a book. Quantities live in a dict keyed by price, prices are also kept in an ascending list so the
+    best level, top-N and cumulative depth are a slice away. Inserting a new level costs one bisect + memmove.
+    """
+    __slots__ = ("is_bid", "quantities", "prices")
+
+    def __init__(self, is_bid: bool):
+        self.is_bid = is_bid
+        self.quantities: typing.Dict[float, float] = dict()
+        self.prices: typing.List[float] = list()
+
+    def clear(self):
+        self.quantities.clear()
+        self.prices.clear()
+
+    def set(self, price: float, quantity: float):
+        if quantity == 0:
+            if self.quantities.pop(price, None) is not None:
+                del self.prices[bisect.bisect_left(self.prices, price)]
+        else:
+            if price not in self.quantities:
+                bisect.insort(self.prices, price)
+            self.quantities[price] = quantity
+
+    def __len__(self):
+        return len(self.prices)
+
+    def best(self) -> typing.Optional[typing.Tuple[float, float]]:
+        if not self.prices:
+            return None
+        price = self.prices[-1] if self.is_bid else self.prices[0]
+        return price, self.quantities[price]
+
+    def top(self, n: int) -> typing.List[typing.Tuple[float, float]]:
+        """Best n levels, best first."""
+        prices = self.prices[:-n - 1:-1] if self.is_bid else self.prices[:n]
+        return [(price, self.quantities[price]) for price in prices]
+
+    def cumulative(self, n: int) -> typing.List[typing.Tuple[float, float]]:
+        """Best n levels with running totals of quantity, best first."""
+        total = 0.0
+        levels = list()
+        for price, quantity in self.top(n):
+            total += quantity
+            levels.append((price, total))
+        return levels
+
+    def quantity_until(self, limit_price: float) -> float:
+        """Total quantity from the best level up to and including limit_price."""
+        if self.is_bid:
+            prices = self.prices[bisect.bisect_left(self.prices, limit_price):]
+        else:
+            prices = self.prices[:bisect.bisect_right(self.prices, limit_price)]
+        return sum(self.quantities[price] for price in prices)
+
+
+class LocalOrderBook:
+    """
+    Order book of one symbol kept from a REST /fapi/v1/depth snapshot plus <symbol>@depth diff events, following
+    Binance's futures rules:
+        1. events are buffered until a snapshot arrives,
+        2. events with u < lastUpdateId of the snapshot are dropped,
+        3. the first applied event must have U <= lastUpdateId <= u,
+        4. every later event must have pu equal to the previous event's u.
+    Any violation drops the book back to buffering and asks for a new snapshot through `needs_snapshot`.
+    """
+    def __init__(self, symbol: str, on_resync: typing.Optional[typing.Callable[["LocalOrderBook"], None]] = None,
+                 max_buffer=MAX_BUFFERED_EVENTS):
+        """
+        :param symbol: contract symbol, i.e. BTCUSDT
+        :param on_resync: called whenever a new snapshot is required (on start and after a gap).
+        :param max_buffer: events buffered while unsynced. Only the newest matter, a snapshot fetched later is
+        newer than the dropped ones.
+        """
+        self.symbol = symbol.upper()
+        self.bids = PriceLevels(is_bid=True)
+        self.asks = PriceLevels(is_bid=False)
+        self.last_update_id = 0
+        self.event_time = 0
+        self.is_synced = False
+        self.needs_snapshot = True
+        self.resync_count = 0
+        self.updates_applied = 0
+        self.buffer_dropped = 0
+        self.max_buffer = max_buffer
+        self._expect_first = False  # synced from a snapshot, first bridging event not seen yet
+        self._buffer: typing.List[dict] = list()
+        self._on_resync = on_resync
+        self._lock = threading.Lock()
+
+    def _apply(self, event: dict):
+        set_bid = self.bids.set
+        set_ask = self.asks.set
+        for price, quantity in event['b']:
+            set_bid(float(price), float(quantity))
+        for price, quantity in event['a']:
+            set_ask(float(price), float(quantity))
+        self.last_update_id = event['u']
+        self.event_time = event['E']
+        self.updates_applied += 1
+
+    def _resync(self, reason: str):
+        logger.warning("Order Book | %s out of sync (%s), waiting for a new snapshot.", self.symbol, reason)
+        self.is_synced = False
+        self.needs_snapshot = True
+        self.resync_count += 1
+        if self._on_resync is not None:
+            self._on_resync(self)
+
+    def on_depth_event(self, event: dict):
+        """Feeds one depthUpdate event (already json-decoded)."""
+        with self._lock:
+            if not self.is_synced:
+                self._buffer.append(event)
+                if len(self._buffer) > self.max_buffer:
+                    # trimmed in blocks, so the list isn't shifted on every event
+                    dropped = len(self._buffer) - self.max_buffer // 2
+                    del self._buffer[:dropped]
+                    self.buffer_dropped += dropped
+                return
+            if self._expect_first:
+                if event['u'] < self.last_update_id:
+                    return
+                if event['U'] > self.last_update_id:
+                    self._buffer = [event]
+                    self._resync(f"first event U {event['U']} is after snapshot {self.last_update_id}")
+                    return
+                self._expect_first = False
+            elif event['pu'] != self.last_update_id:
+                self._buffer = [event]
+                self._resync(f"pu {event['pu']} != last u {self.last_update_id}")
+                return
+            self._apply(event)
+
+    def apply_snapshot(self, snapshot: dict) -> bool:
+        """
+        Loads a /fapi/v1/depth response and replays the buffered events on top of it.
+        :return: True if the book is in sync afterwards.
+        """
+        with self._lock:
+            self.bids.clear()
+            self.asks.clear()
+            for price, quantity in snapshot['bids']:
+                self.bids.set(float(price), float(quantity))
+            for price, quantity in snapshot['asks']:
+                self.asks.set(float(price), float(quantity))
+            self.last_update_id = snapshot['lastUpdateId']
+            self.needs_snapshot = False
+
+            buffered = [event for event in self._buffer if event['u'] >= self.last_update_id]
+            self._buffer = list()
+            if buffered and buffered[0]['U'] > self.last_update_id:
+                # snapshot is older than the oldest buffered event, the events in between are lost
+                self._buffer = buffered
+                self._resync("snapshot older than buffered events")
+                return False
+            for i, event in enumerate(buffered):
+                if i > 0 and event['pu'] != self.last_update_id:
+                    self._buffer = buffered[i:]
+                    self._resync("gap in buffered events")
+                    return False
+                self._apply(event)
+            self._expect_first = not buffered
+            self.is_synced = True
+            return True
+
+    def best_bid(self) -> typing.Optional[typing.Tuple[float, float]]:
+        return self.bids.best()
+
+    def best_ask(self) -> typing.Optional[typing.Tuple[float, float]]:
+        return self.asks.best()
+
+    def mid_price(self) -> typing.Optional[float]:
+        bid, ask = self.bids.best(), self.asks.best()
+        if bid is None or ask is None:
+            return None
+        return (bid[0] + ask[0]) / 2
+
+    def top(self, n=10) -> typing.Dict[str, typing.List[typing.Tuple[float, float]]]:
+        return {"bids": self.bids.top(n), "asks": self.asks.top(n)}
+
+    def cumulative_depth(self, n=10) -> typing.Dict[str, typing.List[typing.Tuple[float, float]]]:
+        return {"bids": self.bids.cumulative(n), "asks": self.asks.cumulative(n)}
+
+    def depth_within(self, bps: float) -> typing.Tuple[float, float]:
+        """(bid quantity, ask quantity) within `bps` basis points of the mid price."""
+        mid = self.mid_price()
+        if mid is None:
+            return 0.0, 0.0
+        return self.bids.quantity_until(mid * (1 - bps / 10000)), self.asks.quantity_until(mid * (1 + bps / 10000))
+
+
+class OrderBookManager:
+    """
+    Keeps LocalOrderBook objects for the client's depth streams. Snapshots are fetched on a separate thread so the
+    websocket reader never waits for REST; events keep buffering in the meantime.
+    """
+    def __init__(self, snapshot_provider: typing.Callable[[str], typing.Optional[dict]]):
+        """
+        :param snapshot_provider: returns the /fapi/v1/depth response for a symbol, None on failure.
+        """
+        self.snapshot_provider = snapshot_provider
+        self.books: typing.Dict[str, LocalOrderBook] = dict()
+        self._fetching = set()
+        self._lock = threading.Lock()
+
+    def add(self, symbol: str) -> LocalOrderBook:
+        symbol = symbol.upper()
+        if symbol not in self.books:
+            self.books[symbol] = LocalOrderBook(symbol, on_resync=self._request_snapshot)
+            self._request_snapshot(self.books[symbol])
+        return self.books[symbol]
+
+    def remove(self, symbol: str):
+        self.books.pop(symbol.upper(), None)
+
+    def on_depth_event(self, event: dict):
+        book = self.books.get(event['s'])
+        if book is not None:
+            book.on_depth_event(event)
+
+    def _request_snapshot(self, book: LocalOrderBook):
+        with self._lock:
+            if book.symbol in self._fetching:
+                return
+            self._fetching.add(book.symbol)
+        threading.Thread(target=self._fetch_snapshot, args=(book,), daemon=True).start()
+
+    def _fetch_snapshot(self, book: LocalOrderBook):
+        """Tries until the book is synced or removed, backing off up to SNAPSHOT_MAX_DELAY between attempts."""
+        try:
+            # give the stream a moment to buffer events, otherwise the snapshot may be newer than all of them
+            time.sleep(0.5)
+            attempt = 0
+            while self.books.get(book.symbol) is book and not book.is_synced:
+                try:
+                    snapshot = self.snapshot_provider(book.symbol)
+                except Exception as e:
+                    logger.error("Order Book | %s snapshot request failed: %s", book.symbol, e)
+                    snapshot = None
+                if snapshot is not None and book.apply_snapshot(snapshot):
+                    logger.info("Order Book | %s synced at update id %s.", book.symbol, book.last_update_id)
+                    return
+                attempt += 1
+                delay = min(SNAPSHOT_MAX_DELAY, 2 ** (attempt - 1))
+                if attempt == 5:
+                    logger.error("Order Book | %s could not be synced after 5 snapshots, retrying every %.0fs"
+                                 " at most.", book.symbol, SNAPSHOT_MAX_DELAY)
+                time.sleep(delay)
+        finally:
+            with self._lock:
+                self._fetching.discard(book.symbol)
+
+
+if __name__ == '__main__':
+    # Throughput on a synthetic diff-depth stream, with one injected gap to show the resync.
+    import random
+
+    random.seed(1)
+    mid = 20000.0
+    snapshot = {"lastUpdateId": 1000,
+                "bids": [[f"{mid - 0.1 * i:.1f}", "1.000"] for i in range(1, 1001)],
+                "asks": [[f"{mid + 0.1 * i:.1f}", "1.000"] for i in range(1, 1001)]}
+
+    def synthetic_events(first_update_id: int, count: int, levels_per_event=20):
+        events = list()
+        previous_u = first_update_id - 1
+        for n in range(count):
+            first = previous_u + 1
+            last = first + random.randint(0, 5)
+            events.append({"e": "depthUpdate", "E": n, "s": "BTCUSDT", "U": first, "u": last, "pu": previous_u,
+                           "b": [[f"{mid - 0.1 * random.randint(1, 1200):.1f}", random.choice(["0", "0.500", "2.1"])]
+                                 for _ in range(levels_per_event // 2)],
+                           "a": [[f"{mid + 0.1 * random.randint(1, 1200):.1f}", random.choice(["0", "0.500", "2.1"])]
+                                 for _ in range(levels_per_event // 2)]})
+            previous_u = last
+        return events
+
+    stream = synthetic_events(990, 100000)
+    book = LocalOrderBook("BTCUSDT")
+    for event in stream[:50]:
+        book.on_depth_event(event)
+    book.apply_snapshot(snapshot)
+
+    ts = time.perf_counter()
+    for event in stream[50:]:
+        book.on_depth_event(event)
+    elapsed = time.perf_counter() - ts
+    print(f"{len(stream) - 50} events with 20 levels each in {elapsed:.2f}s -> {(len(stream) - 50) / elapsed:,.0f}"
+          f" updates/s, synced={book.is_synced}, levels={len(book.bids)}/{len(book.asks)}")
+    print(f"best bid {book.best_bid()} best ask {book.best_ask()} depth within 5bps {book.depth_within(5)}")
+
+    gap = dict(stream[-1], U=stream[-1]['u'] + 10, u=stream[-1]['u'] + 12, pu=stream[-1]['u'] + 9)
+    book.on_depth_event(gap)
+    print(f"after injected gap: synced={book.is_synced} needs_snapshot={book.needs_snapshot}"
+          f" resyncs={book.resync_count}")
+
+    unsynced = LocalOrderBook("BTCUSDT", max_buffer=1000)
+    for event in stream[:5000]:
+        unsynced.on_depth_event(event)
+    print(f"unsynced book: {len(unsynced._buffer)} events buffered, {unsynced.buffer_dropped} dropped")
+
+    failures = iter([None] * 3)
+    manager = OrderBookManager(lambda symbol: next(failures, dict(snapshot, lastUpdateId=stream[0]['u'])))
+    managed = manager.add("BTCUSDT")
+    for event in stream[:200]:
+        manager.on_depth_event(event)
+    ts = time.perf_counter()
+    while not managed.is_synced and time.perf_counter() - ts < 15:
+        time.sleep(0.05)
+    print(f"manager after 3 failed snapshots: synced={managed.is_synced} in {time.perf_counter() - ts + 0.5:.1f}s")
@@ -0,0 +1,572 @@
+import heapq
+import itertools
+import json
+import logging
+import threading
+import typing
+
+import logkeeper
+from models import Contract, Order, Position, Wallet
+from connectors.batch_orders import OrderResult
+from connectors.ws_dispatch import loads, AggTrade, BookTicker
+
+logger = logging.getLogger("paper_trading.py")
+logkeeper.log_keeper("connectors.log", "paper_trading.py")
+
+OPEN_STATUSES = ("NEW", "PARTIALLY_FILLED")
+
+
+class _SimOrder:
+    __slots__ = ("order_id", "symbol", "side", "type", "quantity", "price", "stop_price", "tif", "status",
+                 "executed", "avg_price", "time", "update_time", "client_order_id", "triggered")
+
+    def __init__(self, order_id: int, symbol: str, side: str, order_type: str, quantity: float, price: float,
+                 stop_price: float, tif: str, now: int, client_order_id: str):
+        self.order_id = order_id
+        self.symbol = symbol
+        self.side = side
+        self.type = order_type
+        self.quantity = quantity
+        self.price = price
+        self.stop_price = stop_price
+        self.tif = tif
+        self.status = "NEW"
+        self.executed = 0.0
+        self.avg_price = 0.0
+        self.time = now
+        self.update_time = now
+        self.client_order_id = client_order_id
+        self.triggered = order_type != "STOP"
+
+    @property
+    def remaining(self) -> float:
+        return self.quantity - self.executed
+
+    def to_dict(self) -> dict:
+        """Same keys as the exchange's order responses."""
+        return {'avgPrice': str(self.avg_price), 'orderId': self.order_id, 'executedQty': str(self.executed),
+                'origQty': str(self.quantity), 'origType': self.type, 'type': self.type, 'price': str(self.price),
+                'side': self.side, 'status': self.status, 'stopPrice': str(self.stop_price), 'symbol': self.symbol,
+                'time': self.time, 'updateTime': self.update_time, 'timeInForce': self.tif,
+                'clientOrderId': self.client_order_id}
+
+    def to_order(self) -> Order:
+        return Order("binance_futures", self.to_dict())
+
+
+class _Book:
+    """Resting limit orders and waiting stop orders of one symbol, as heaps with lazy deletion."""
+    __slots__ = ("bids", "asks", "buy_stops", "sell_stops", "bid", "ask", "bid_quantity", "ask_quantity",
+                 "last_price")
+
+    def __init__(self):
+        self.bids: typing.List[tuple] = list()         # (-price, sequence, order)
+        self.asks: typing.List[tuple] = list()         # (price, sequence, order)
+        self.buy_stops: typing.List[tuple] = list()    # (stop price, sequence, order), trigger at or above
+        self.sell_stops: typing.List[tuple] = list()   # (-stop price, sequence, order), trigger at or below
+        self.bid = 0.0
+        self.ask = 0.0
+        self.bid_quantity = 0.0
+        self.ask_quantity = 0.0
+        self.last_price = 0.0
+
+    @property
+    def mark(self) -> float:
+        if self.last_price:
+            return self.last_price
+        return (self.bid + self.ask) / 2 if self.bid and self.ask else 0.0
+
+
+class PaperTradingClient:
+    """
+    Local stand-in for BinanceFuturesClient: the same order, position and balance methods, matched in-process
+    against bookTicker and aggTrade events instead of being sent to the exchange.
+
+    Matching rules (one-way position mode, one margin asset):
+      - MARKET orders and marketable LIMIT orders fill at once at the best bid/ask, as taker.
+      - Resting LIMIT orders fill at their own price, as maker, when the book ticker crosses them or a trade
+        prints through them; the ticker's or trade's quantity caps the fill, so large orders fill partially.
+      - STOP orders trigger on the last trade price (the ticker's mid until a trade is seen), then act as LIMIT.
+      - Prices and quantities are checked against the contract's tick size, lot size, order types and time in
+        forces; a rejected order returns None like a refused request does on the real client.
+    Time is the event time of the market data, so a replay of recorded data always gives the same result.
+    """
+    def __init__(self, contracts: typing.Dict[str, Contract], initial_balance=10000.0, margin_asset="USDT",
+                 maker_commission=0.02 / 100, taker_commission=0.04 / 100, leverage=20,
+                 on_fill: typing.Optional[typing.Callable[[Order, float, float], None]] = None):
+        """
+        :param contracts: symbol -> Contract, i.e BinanceFuturesClient.contracts or MetadataCache.contracts()
+        :param initial_balance: wallet balance in margin_asset.
+        :param leverage: initial leverage of every symbol, capped by the contract's max leverage.
+        :param on_fill: called with (order, fill price, fill quantity) after every fill.
+        """
+        self.platform = "binance_futures"
+        self.connection_type = "Paper Trading"
+        self.contracts = contracts
+        self.margin_asset = margin_asset
+        self.maker_commission = maker_commission
+        self.taker_commission = taker_commission
+        self.on_fill = on_fill
+        self.balance = float(initial_balance)
+        self.fees_paid = 0.0
+        self.realized_pnl = 0.0
+        self.now = 0
+        self.leverage: typing.Dict[str, int] = {symbol: min(leverage, contract.max_leverage or leverage)
+                                                for symbol, contract in contracts.items()}
+        self.margin_types: typing.Dict[str, str] = dict()
+        self.orders: typing.Dict[int, _SimOrder] = dict()
+        self.open_orders: typing.Dict[int, _SimOrder] = dict()
+        self._open_notional: typing.Dict[str, float] = dict()   # symbol -> price * remaining of open orders
+        self.positions: typing.Dict[str, typing.List[float]] = dict()   # symbol -> [amount, entry price]
+        self.books: typing.Dict[str, _Book] = dict()
+        self.last_trades: typing.Dict[str, AggTrade] = dict()
+        self.book_tickers: typing.Dict[str, BookTicker] = dict()
+        self.fills = 0
+        self.events_applied = 0
+        self._countdowns: typing.Dict[str, int] = dict()
+        self._order_ids = itertools.count(1)
+        self._sequence = itertools.count()
+        self._lock = threading.RLock()
+
+    # ----- market data -----
+
+    def attach(self, dispatcher):
+        """Matches against the live market data of a client's MessageDispatcher."""
+        dispatcher.register("bookTicker", self.book_tickers_update, BookTicker)
+        dispatcher.register("aggTrade", self.last_trades_update, AggTrade)
+
+    def on_message(self, msg: typing.Union[str, bytes, dict]):
+        """One raw stream message (plain or combined stream form), i.e. a line of recorded data."""
+        data = loads(msg) if not isinstance(msg, dict) else msg
+        if 'stream' in data and 'data' in data:
+            data = data['data']
+        event_type = data.get('e')
+        if event_type == "bookTicker":
+            self.book_tickers_update(BookTicker(data))
+        elif event_type == "aggTrade":
+            self.last_trades_update(AggTrade(data))
+
+    def replay(self, messages: typing.Iterable[typing.Union[str, bytes, dict]]) -> int:
+        """Feeds recorded messages in order. :return: number of messages."""
+        count = 0
+        for count, msg in enumerate(messages, start=1):
+            self.on_message(msg)
+        return count
+
+    def replay_file(self, path: str) -> int:
+        """Replays a file with one raw stream message per line."""
+        with open(path, "rb") as file:
+            return self.replay(line for line in file if line.strip())
+
+    def _book(self, symbol: str) -> _Book:
+        book = self.books.get(symbol)
+        if book is None:
+            book = self.books[symbol] = _Book()
+        return book
+
+    def book_tickers_update(self, ticker: BookTicker):
+        with self._lock:
+            self.book_tickers[ticker.symbol] = ticker
+            self._advance(ticker.event_time)
+            book = self._book(ticker.symbol)
+            book.bid, book.ask = ticker.bid_price, ticker.ask_price
+            book.bid_quantity, book.ask_quantity = ticker.bid_quantity, ticker.ask_quantity
+            if not book.last_price:
+                self._trigger_stops(book, book.mark)
+            self._match_resting(book, "BUY", ticker.ask_price, ticker.ask_quantity, through=False)
+            self._match_resting(book, "SELL", ticker.bid_price, ticker.bid_quantity, through=False)
+            self.events_applied += 1
+
+    def last_trades_update(self, trade: AggTrade):
+        with self._lock:
+            self.last_trades[trade.symbol] = trade
+            self._advance(trade.trade_time)
+            book = self._book(trade.symbol)
+            book.last_price = trade.price
+            self._trigger_stops(book, trade.price)
+            # a print at the limit price says nothing about the queue ahead, only prints through it fill
+            self._match_resting(book, "BUY", trade.price, trade.quantity, through=True)
+            self._match_resting(book, "SELL", trade.price, trade.quantity, through=True)
+            self.events_applied += 1
+
+    def _advance(self, event_time: int):
+        self.now = max(self.now, event_time)
+        if self._countdowns:
+            for symbol, deadline in list(self._countdowns.items()):
+                if self.now >= deadline:
+                    del self._countdowns[symbol]
+                    self._cancel_symbol(symbol)
+
+    # ----- matching -----
+
+    def _match_resting(self, book: _Book, side: str, price: float, available: float, through: bool):
+        heap = book.bids if side == "BUY" else book.asks
+        while heap and available > 0:
+            key, _, order = heap[0]
+            if order.status not in OPEN_STATUSES:
+                heapq.heappop(heap)
+                continue
+            limit = -key if side == "BUY" else key
+            crosses = (limit > price if through else limit >= price) if side == "BUY" \
+                else (limit < price if through else limit <= price)
+            if not crosses:
+                return
+            quantity = min(order.remaining, available)
+            available -= quantity
+            self._fill(order, limit, quantity, maker=True)
+            if order.status not in OPEN_STATUSES:
+                heapq.heappop(heap)
+
+    def _trigger_stops(self, book: _Book, price: float):
+        if not price:
+            return
+        for heap, sign in ((book.buy_stops, 1), (book.sell_stops, -1)):
+            while heap and (heap[0][0] * sign <= price if sign > 0 else -heap[0][0] >= price):
+                _, _, order = heapq.heappop(heap)
+                if order.status in OPEN_STATUSES:
+                    order.triggered = True
+                    self._execute_limit(order, book)
+
+    def _execute_limit(self, order: _SimOrder, book: _Book):
+        """A new or just triggered limit order: takes liquidity if it crosses the book, rests otherwise."""
+        opposite = book.ask if order.side == "BUY" else book.bid
+        marketable = opposite > 0 and (order.price >= opposite if order.side == "BUY" else order.price <= opposite)
+        if marketable:
+            if order.tif == "GTX":
+                # post only orders never take liquidity
+                self._finish(order, "EXPIRED")
+                return
+            self._fill(order, opposite, order.remaining, maker=False)
+            return
+        if order.tif in ("IOC", "FOK"):
+            self._finish(order, "EXPIRED")
+            return
+        if order.side == "BUY":
+            heapq.heappush(book.bids, (-order.price, next(self._sequence), order))
+        else:
+            heapq.heappush(book.asks, (order.price, next(self._sequence), order))
+
+    def _fill(self, order: _SimOrder, price: float, quantity: float, maker: bool):
+        contract = self.contracts[order.symbol]
+        quantity = round(quantity, contract.quantity_precision)
+        if quantity <= 0:
+            return
+        fee = price * quantity * (self.maker_commission if maker else self.taker_commission)
+        signed = quantity if order.side == "BUY" else -quantity
+        position = self.positions.setdefault(order.symbol, [0.0, 0.0])
+        amount, entry = position
+        realized = 0.0
+        if amount == 0 or (amount > 0) == (signed > 0):
+            new_amount = amount + signed
+            entry = (entry * abs(amount) + price * quantity) / abs(new_amount)
+        else:
+            closed = min(abs(amount), quantity)
+            realized = closed * (price - entry) * (1 if amount > 0 else -1)
+            new_amount = amount + signed
+            if abs(new_amount) < contract.lot_size / 2:
+                new_amount, entry = 0.0, 0.0
+            elif (new_amount > 0) != (amount > 0):
+                entry = price
+        position[0], position[1] = round(new_amount, contract.quantity_precision), entry
+
+        self.balance += realized - fee
+        self.realized_pnl += realized
+        self.fees_paid += fee
+        if order.order_id in self.open_orders:
+            self._open_notional[order.symbol] -= order.price * quantity
+        order.avg_price = (order.avg_price * order.executed + price * quantity) / (order.executed + quantity)
+        order.executed = round(order.executed + quantity, contract.quantity_precision)
+        order.update_time = self.now
+        if order.remaining < contract.lot_size / 2:
+            self._finish(order, "FILLED")
+        else:
+            order.status = "PARTIALLY_FILLED"
+        self.fills += 1
+        if self.on_fill is not None:
+            self.on_fill(order.to_order(), price, quantity)
+
+    def _finish(self, order: _SimOrder, status: str):
+        order.status = status
+        order.update_time = self.now
+        if self.open_orders.pop(order.order_id, None) is not None:
+            self._open_notional[order.symbol] -= order.price * order.remaining
+
+    # ----- orders -----
+
+    def _reject(self, symbol: str, reason: str, params: dict) -> None:
+        logger.error("Paper Trading | %s order rejected: %s %s", symbol, reason, params)
+        return None
+
+    def _check(self, contract: Contract, order_type: str, side: str, quantity: float, price: float,
+               tif: str) -> typing.Optional[str]:
+        """The exchange's filter checks, :return: the reason of a rejection, None if the order is valid."""
+        if side not in ("BUY", "SELL"):
+            return f"invalid side {side}"
+        if contract.order_types and order_type not in contract.order_types:
+            return f"order type {order_type} not allowed"
+        if order_type != "MARKET" and contract.time_in_forces and tif not in contract.time_in_forces:
+            return f"time in force {tif} not allowed"
+        if quantity < contract.lot_size or abs(quantity / contract.lot_size - round(quantity / contract.lot_size)) > 1e-6:
+            return f"quantity {quantity} does not match lot size {contract.lot_size}"
+        if order_type != "MARKET" and (price <= 0 or
+                                       abs(price / contract.tick_size - round(price / contract.tick_size)) > 1e-6):
+            return f"price {price} does not match tick size {contract.tick_size}"
+        return None
+
+    def _available(self) -> float:
+        """Wallet balance plus unrealized pnl minus the margin of positions and resting orders."""
+        available = self.balance
+        for symbol, (amount, entry) in self.positions.items():
+            if amount:
+                mark = self._book(symbol).mark or entry
+                available += amount * (mark - entry) - abs(amount) * mark / self.leverage.get(symbol, 1)
+        for symbol, notional in self._open_notional.items():
+            available -= notional / self.leverage.get(symbol, 1)
+        return available
+
+    def _submit(self, symbol: str, side: str, order_type: str, quantity: float, price=0.0, stop_price=0.0,
+                tif="GTC", client_order_id="") -> typing.Optional[_SimOrder]:
+        params = {'side': side, 'type': order_type, 'quantity': quantity, 'price': price, 'stopPrice': stop_price,
+                  'timeInForce': tif}
+        contract = self.contracts.get(symbol)
+        if contract is None:
+            return self._reject(symbol, "unknown symbol", params)
+        reason = self._check(contract, order_type, side, quantity, price, tif)
+        if reason is not None:
+            return self._reject(symbol, reason, params)
+        with self._lock:
+            book = self._book(symbol)
+            reference = price or (book.ask if side == "BUY" else book.bid)
+            if order_type == "MARKET" and not reference:
+                return self._reject(symbol, "no market data to fill against", params)
+            amount = self.positions.get(symbol, (0.0, 0.0))[0]
+            reduces = amount and (amount > 0) != (side == "BUY") and quantity <= abs(amount)
+            if not reduces and quantity * reference / self.leverage.get(symbol, 1) > self._available():
+                return self._reject(symbol, "margin is insufficient", params)
+
+            order = _SimOrder(next(self._order_ids), symbol, side, order_type, quantity, price, stop_price, tif,
+                              self.now, client_order_id)
+            self.orders[order.order_id] = order
+            if order_type != "MARKET":
+                self.open_orders[order.order_id] = order
+                self._open_notional[symbol] = self._open_notional.get(symbol, 0.0) + quantity * price
+            if order_type == "MARKET":
+                self._fill(order, book.ask if side == "BUY" else book.bid, quantity, maker=False)
+            elif order_type == "STOP":
+                if side == "BUY":
+                    heapq.heappush(book.buy_stops, (stop_price, next(self._sequence), order))
+                else:
+                    heapq.heappush(book.sell_stops, (-stop_price, next(self._sequence), order))
+                self._trigger_stops(book, book.mark)
+            else:
+                self._execute_limit(order, book)
+            return order
+
+    def place_market_order(self, contract: Contract, quantity: float, side: str) -> typing.Optional[Order]:
+        order = self._submit(contract.symbol, side.strip().upper(), "MARKET", quantity)
+        return order.to_order() if order is not None else None
+
+    def place_limit_order(self, contract: Contract, amount: float, side: str, price: float,
+                          tif="GTC") -> typing.Optional[Order]:
+        while amount * price < 10:
+            amount += contract.lot_size
+        amount = round(amount, contract.quantity_precision)
+        order = self._submit(contract.symbol, side.strip().upper(), "LIMIT", amount, price, tif=tif)
+        return order.to_order() if order is not None else None
+
+    def place_stop_order(self, contract: Contract, quantity: float, side: str, price: float, stop_price: float,
+                         tif="GTC") -> typing.Optional[Order]:
+        while quantity * price < 10:
+            quantity += contract.lot_size
+        quantity = round(quantity, contract.quantity_precision)
+        price = round(price, contract.price_precision)
+        stop_price = round(stop_price, contract.price_precision)
+        order = self._submit(contract.symbol, side.strip().upper(), "STOP", quantity, price, stop_price, tif)
+        return order.to_order() if order is not None else None
+
+    def place_orders(self, orders: typing.List[dict]) -> typing.List[OrderResult]:
+        """Same parameters and results as BinanceFuturesClient.place_orders."""
+        results = list()
+        for params in orders:
+            order = self._submit(params['symbol'], params['side'], params['type'], float(params['quantity']),
+                                 float(params.get('price', 0)), float(params.get('stopPrice', 0)),
+                                 params.get('timeInForce', "GTC"), params.get('newClientOrderId', ""))
+            if order is not None:
+                results.append(OrderResult(params, order.to_order()))
+            else:
+                results.append(OrderResult(params, code=-1013, msg="Filter failure."))
+        return results
+
+    def place_limit_orders(self, orders: typing.List[typing.Tuple[Contract, float, str, float]],
+                           tif="GTC") -> typing.List[OrderResult]:
+        params = list()
+        for contract, amount, side, price in orders:
+            while amount * price < 10:
+                amount += contract.lot_size
+            params.append({'symbol': contract.symbol, 'side': side.strip().upper(), 'type': "LIMIT",
+                           'timeInForce': tif, 'quantity': round(amount, contract.quantity_precision),
+                           'price': round(price, contract.price_precision)})
+        return self.place_orders(params)
+
+    def cancel_order(self, order: Order) -> typing.Optional[dict]:
+        with self._lock:
+            sim = self.open_orders.get(order.order_id)
+            if sim is None:
+                logger.error(f"Paper Trading | {order.symbol} order id:{order.order_id} cancel FAILED.")
+                return None
+            self._finish(sim, "CANCELED")
+            return sim.to_dict()
+
+    def cancel_orders(self, orders: typing.List[Order]) -> typing.List[OrderResult]:
+        results = list()
+        for order in orders:
+            response = self.cancel_order(order)
+            request = {'symbol': order.symbol, 'orderId': order.order_id}
+            results.append(OrderResult(request, Order("binance_futures", response)) if response is not None
+                           else OrderResult(request, code=-2011, msg="Unknown order sent."))
+        return results
+
+    def _cancel_symbol(self, symbol: str) -> int:
+        orders = [order for order in self.open_orders.values() if order.symbol == symbol]
+        for order in orders:
+            self._finish(order, "CANCELED")
+        return len(orders)
+
+    def cancel_open_orders(self, contract: Contract, countdown=2) -> dict:
+        """Like countdownCancelAll: the symbol's open orders are cancelled once countdown seconds of data passed."""
+        countdown = max(countdown, 1)
+        with self._lock:
+            self._countdowns[contract.symbol] = self.now + int(countdown * 1000)
+        return {'symbol': contract.symbol, 'countdownTime': str(int(countdown * 1000))}
+
+    # ----- account -----
+
+    def get_all_open_orders(self, contract=None, use_cache=True) -> typing.List[Order]:
+        with self._lock:
+            return [order.to_order() for order in self.open_orders.values()
+                    if contract is None or order.symbol == contract.symbol]
+
+    def get_single_open_order(self, contract: Contract, order_id) -> typing.Optional[Order]:
+        order = self.open_orders.get(int(order_id))
+        if order is not None and order.symbol == contract.symbol:
+            return order.to_order()
+
+    def _position_dict(self, symbol: str) -> dict:
+        amount, entry = self.positions.get(symbol, (0.0, 0.0))
+        mark = self._book(symbol).mark or entry
+        return {'symbol': symbol, 'entryPrice': str(entry), 'marginType': self.margin_types.get(symbol, "cross"),
+                'leverage': str(self.leverage.get(symbol, 1)), 'liquidationPrice': "0", 'markPrice': str(mark),
+                'positionAmt': str(amount), 'positionSide': "BOTH",
+                'unRealizedProfit': str(amount * (mark - entry)), 'updateTime': self.now}
+
+    def get_positions(self, contract=None, use_cache=True) -> typing.List[Position]:
+        with self._lock:
+            symbols = [contract.symbol] if contract is not None else list(self.positions)
+            return [Position("binance_futures", self._position_dict(symbol)) for symbol in symbols]
+
+    def get_balances(self, use_cache=True) -> Wallet:
+        with self._lock:
+            positions = [self._position_dict(symbol) for symbol, (amount, _) in self.positions.items() if amount]
+            margin = sum(abs(float(p['positionAmt'])) * float(p['markPrice']) / int(p['leverage']) for p in positions)
+            unrealized = sum(float(p['unRealizedProfit']) for p in positions)
+            available = self._available()
+            for p in positions:
+                p.update(initialMargin=str(abs(float(p['positionAmt'])) * float(p['markPrice']) / int(p['leverage'])),
+                         isolated=p['marginType'] == "isolated", unrealizedProfit=p['unRealizedProfit'])
+            return Wallet("binance_futures", {
+                'assets': [{'asset': self.margin_asset, 'availableBalance': str(available),
+                            'walletBalance': str(self.balance), 'unrealizedProfit': str(unrealized),
+                            'initialMargin': str(margin)}],
+                'availableBalance': str(available), 'totalWalletBalance': str(self.balance), 'canDeposit': False,
+                'canTrade': True, 'canWithdraw': False, 'feeTier': 0, 'totalPositionInitialMargin': str(margin),
+                'totalUnrealizedProfit': str(unrealized), 'positions': positions})
+
+    def get_current_commissions(self, contract: Contract) -> typing.Tuple[float, float]:
+        return self.maker_commission, self.taker_commission
+
+    def get_current_contracts(self) -> typing.Dict[str, Contract]:
+        return self.contracts
+
+    def adjust_leverage(self, contract: Contract, leverage: int) -> typing.Optional[dict]:
+        if not 1 <= leverage <= (contract.max_leverage or leverage):
+            logger.error(f"Paper Trading | Leverage {leverage} is not valid for {contract.symbol}")
+            return None
+        self.leverage[contract.symbol] = leverage
+        return {'symbol': contract.symbol, 'leverage': leverage}
+
+    def change_margin_type(self, contract: Contract, margin: str) -> dict:
+        self.margin_types[contract.symbol] = margin.lower()
+        return {'code': 200, 'msg': "success"}
+
+
+if __name__ == '__main__':
+    # Orders per second through the simulator, and a deterministic replay of recorded market data.
+    import os
+    import random
+    import tempfile
+    import time
+
+    contract = Contract("binance_futures", {"symbol": "BTCUSDT", "baseAsset": "BTC", "quoteAsset": "USDT",
+                                            "marginAsset": "USDT", "requiredMarginPercent": "5.0000",
+                                            "pricePrecision": 1, "quantityPrecision": 3,
+                                            "filters": [{"tickSize": "0.10"}, {"minQty": "0.001"}, {}, {},
+                                                        {"limit": 200}],
+                                            "orderTypes": ["LIMIT", "MARKET", "STOP"],
+                                            "timeInForce": ["GTC", "IOC", "FOK", "GTX"], "leverage": 125})
+
+    random.seed(3)
+    messages = list()
+    price, event_time = 20000.0, 1658000000000
+    for i in range(200000):
+        event_time += 5
+        price = round(price + random.choice((-0.1, 0, 0.1)), 1)
+        if i % 4:
+            messages.append(json.dumps({"e": "bookTicker", "u": i, "s": "BTCUSDT", "b": f"{price:.1f}", "B": "2.5",
+                                        "a": f"{price + 0.1:.1f}", "A": "1.7", "T": event_time, "E": event_time}))
+        else:
+            messages.append(json.dumps({"e": "aggTrade", "E": event_time, "s": "BTCUSDT", "a": i,
+                                        "p": f"{price + random.choice((0, 0.1)):.1f}", "q": "0.350", "f": i,
+                                        "l": i, "T": event_time, "m": random.random() < 0.5}))
+    path = os.path.join(tempfile.mkdtemp(), "btcusdt.jsonl")
+    with open(path, "w") as file:
+        file.write("\n".join(messages))
+
+    def run_strategy() -> typing.Tuple[PaperTradingClient, int, float]:
+        # a market maker quoting both sides around every 20th event, with a stop below
+        paper = PaperTradingClient({"BTCUSDT": contract}, initial_balance=100000)
+        placed, order_time = 0, 0.0
+        resting: typing.List[Order] = list()
+        for i, msg in enumerate(messages):
+            paper.on_message(msg)
+            if i % 20 == 0 and "BTCUSDT" in paper.book_tickers:
+                ticker = paper.book_tickers["BTCUSDT"]
+                ts = time.perf_counter()
+                if len(resting) > 40:
+                    paper.cancel_orders([order for order in resting[:20] if order.order_id in paper.open_orders])
+                    resting = resting[20:]
+                for offset in (0.1, 0.5, 1.0):
+                    resting.append(paper.place_limit_order(contract, 0.002, "BUY", round(ticker.bid_price - offset, 1)))
+                    resting.append(paper.place_limit_order(contract, 0.002, "SELL", round(ticker.ask_price + offset, 1)))
+                paper.place_stop_order(contract, 0.001, "SELL", round(ticker.bid_price - 5, 1),
+                                       round(ticker.bid_price - 4, 1))
+                placed += 7
+                order_time += time.perf_counter() - ts
+        return paper, placed, order_time
+
+    ts = time.perf_counter()
+    paper, placed, order_time = run_strategy()
+    elapsed = time.perf_counter() - ts
+    wallet = paper.get_balances()
+    print(f"{len(messages)} events and {placed} orders in {elapsed:.2f}s: {len(messages) / elapsed:,.0f} events/s,"
+          f" {placed / order_time:,.0f} orders/s ({paper.fills} fills)")
+    print(f"balance {wallet.total_balance:.2f}, fees {paper.fees_paid:.2f},"
+          f" position {paper.get_positions(contract)[0].amount}")
+
+    again, _, _ = run_strategy()
+    print(f"second run identical: {again.get_balances().total_balance == wallet.total_balance}")
+
+    replayed = PaperTradingClient({"BTCUSDT": contract}, initial_balance=100000)
+    ts = time.perf_counter()
+    count = replayed.replay_file(path)
+    print(f"replay of the recorded file: {count} messages in {time.perf_counter() - ts:.2f}s")
+    print(f"rejected as expected: {replayed.place_limit_order(contract, 0.0015, 'BUY', 19000.05) is None}")
@@ -0,0 +1,300 @@
+import heapq
+import itertools
+import json
+import logging
+import threading
+import time
+import typing
+
+import logkeeper
+
+logger = logging.getLogger("rate_limiter.py")
+logkeeper.log_keeper("connectors.log", "rate_limiter.py")
+
+# Lower value goes first. Orders never wait behind anything else that is queued.
+PRIORITY_ORDER = 0
+PRIORITY_DEFAULT = 1
+PRIORITY_BACKFILL = 2
+
+
+def kline_request_weight(limit: int) -> int:
+    """Request weight of /fapi/v1/continuousKlines depending on the limit parameter."""
+    if limit < 100:
+        return 1
+    elif limit < 500:
+        return 2
+    elif limit <= 1000:
+        return 5
+    return 10
+
+
+def _depth_weight(params: dict) -> int:
+    limit = int(params.get('limit', 500))
+    if limit <= 50:
+        return 2
+    elif limit <= 100:
+        return 5
+    elif limit <= 500:
+        return 10
+    return 20
+
+
+def _kline_weight(params: dict) -> int:
+    return kline_request_weight(int(params.get('limit', 500)))
+
+
+# (method, endpoint) -> weight, or a callable of the request parameters. Unlisted endpoints count as 1.
+ENDPOINT_WEIGHTS: typing.Dict[typing.Tuple[str, str], typing.Union[int, typing.Callable[[dict], int]]] = {
+    ("GET", "/fapi/v1/exchangeInfo"): 1,
+    ("GET", "/fapi/v1/leverageBracket"): 1,
+    ("GET", "/fapi/v1/depth"): _depth_weight,
+    ("GET", "/fapi/v1/klines"): _kline_weight,
+    ("GET", "/fapi/v1/continuousKlines"): _kline_weight,
+    ("GET", "/fapi/v1/markPriceKlines"): _kline_weight,
+    ("GET", "/fapi/v1/indexPriceKlines"): _kline_weight,
+    ("GET", "/fapi/v1/aggTrades"): 20,
+    ("GET", "/fapi/v1/ticker/24hr"): lambda params: 1 if 'symbol' in params else 40,
+    ("GET", "/fapi/v1/ticker/price"): lambda params: 1 if 'symbol' in params else 2,
+    ("GET", "/fapi/v1/ticker/bookTicker"): lambda params: 2 if 'symbol' in params else 5,
+    ("GET", "/fapi/v2/account"): 5,
+    ("GET", "/fapi/v2/balance"): 5,
+    ("GET", "/fapi/v2/positionRisk"): 5,
+    ("GET", "/fapi/v1/commissionRate"): 20,
+    ("GET", "/fapi/v1/income"): 30,
+    ("GET", "/fapi/v1/userTrades"): 5,
+    ("GET", "/fapi/v1/allOrders"): 5,
+    ("GET", "/fapi/v1/openOrders"): lambda params: 1 if 'symbol' in params else 40,
+    ("POST", "/fapi/v1/batchOrders"): 5,
+}
+
+
+# Requests that place or cancel orders, they get PRIORITY_ORDER unless told otherwise.
+ORDER_ENDPOINTS = {"/fapi/v1/order", "/fapi/v1/batchOrders", "/fapi/v1/allOpenOrders", "/fapi/v1/countdownCancelAll"}
+
+
+def default_priority(method: str, endpoint: str) -> int:
+    if method.upper() != "GET" and endpoint in ORDER_ENDPOINTS:
+        return PRIORITY_ORDER
+    return PRIORITY_DEFAULT
+
+
+def request_weight(method: str, endpoint: str, params: typing.Optional[dict] = None) -> int:
+    weight = ENDPOINT_WEIGHTS.get((method.upper(), endpoint), 1)
+    if callable(weight):
+        return weight(params or dict())
+    return weight
+
+
+def order_count(method: str, endpoint: str, params: typing.Optional[dict] = None) -> int:
+    """Number of orders a request adds to the X-MBX-ORDER-COUNT-* counters."""
+    if method.upper() != "POST":
+        return 0
+    if endpoint == "/fapi/v1/order":
+        return 1
+    if endpoint == "/fapi/v1/batchOrders":
+        orders = (params or dict()).get('batchOrders', "[]")
+        return len(json.loads(orders) if isinstance(orders, str) else orders)
+    return 0
+
+
+class _FixedWindow:
+    """Counter that resets at every multiple of `length` seconds, like the exchange's minute/10 second windows."""
+    __slots__ = ("limit", "length", "start", "used", "previous")
+
+    def __init__(self, limit: int, length: float):
+        self.limit = limit
+        self.length = length
+        self.start = 0.0
+        self.used = 0
+        self.previous = 0
+
+    def roll(self, now: float):
+        start = now - now % self.length
+        if start != self.start:
+            # what the window ended with, unless it is older than the one just before
+            self.previous = self.used if start - self.start <= self.length else 0
+            self.start = start
+            self.used = 0
+
+    def time_left(self, now: float) -> float:
+        return self.start + self.length - now
+
+
+class RateLimiter:
+    """
+    Paces REST requests below the exchange's request weight and order count limits instead of finding them by
+    getting 429s. Every request asks for its weight (and order count) with acquire() before it is sent; the usage
+    reported in X-MBX-USED-WEIGHT-1M / X-MBX-ORDER-COUNT-* headers is fed back with update(), which also catches
+    weight spent by other processes on the same IP.
+    Waiting requests are served by priority, and backfill requests may only use backfill_share of the window, so
+    orders find room even while a bulk download is saturating the limit.
+    """
+    def __init__(self, weight_per_minute=2400, orders_per_10s=300, orders_per_minute=1200, safety=0.9,
+                 backfill_share=0.7, boundary_guard=0.25, time_scale=1.0):
+        """
+        :param weight_per_minute: REQUEST_WEIGHT limit of exchangeInfo.
+        :param orders_per_10s: ORDERS limit per 10 seconds.
+        :param orders_per_minute: ORDERS limit per minute.
+        :param safety: fraction of each limit the limiter will use.
+        :param backfill_share: fraction of the usable weight PRIORITY_BACKFILL requests may take.
+        :param boundary_guard: seconds to wait after a window boundary if the previous window ended close to the limit,
+            covers clock offset with the exchange.
+        :param time_scale: shortens the windows, for testing against a local stand-in.
+        """
+        self.safety = safety
+        self.backfill_share = backfill_share
+        self.boundary_guard = boundary_guard * time_scale
+        self.weight = _FixedWindow(weight_per_minute, 60 * time_scale)
+        self.orders_10s = _FixedWindow(orders_per_10s, 10 * time_scale)
+        self.orders_1m = _FixedWindow(orders_per_minute, 60 * time_scale)
+        self.banned_until = 0.0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self._waiting: typing.List[typing.Tuple[int, int]] = list()
+        self._tickets = itertools.count()
+        self._cond = threading.Condition()
+
+    def _roll(self, now: float):
+        self.weight.roll(now)
+        self.orders_10s.roll(now)
+        self.orders_1m.roll(now)
+
+    def _wait_time(self, now: float, weight: int, orders: int, priority: int) -> float:
+        if self.banned_until > now:
+            return self.banned_until - now
+        capacity = self.weight.limit * self.safety
+        # right after a boundary the exchange may not have rolled its window yet, which only matters if the request
+        # would not have fit into what the previous window ended with
+        if now - self.weight.start < self.boundary_guard and \
+                self.weight.previous + self.weight.used + weight > capacity:
+            return self.weight.start + self.boundary_guard - now
+        if priority >= PRIORITY_BACKFILL:
+            capacity *= self.backfill_share
+        wait = 0.0
+        if self.weight.used and self.weight.used + weight > capacity:
+            wait = self.weight.time_left(now)
+        if orders:
+            for window in (self.orders_10s, self.orders_1m):
+                if window.used and window.used + orders > window.limit * self.safety:
+                    wait = max(wait, window.time_left(now))
+        return wait
+
+    def acquire(self, weight: int, orders=0, priority=PRIORITY_DEFAULT,
+                timeout: typing.Optional[float] = None) -> typing.Optional[float]:
+        """
+        Blocks until the request fits into the current windows and every request with a higher priority is through.
+        :param timeout: give up if the request can't be sent within this many seconds.
+        :return: seconds waited, None if timeout ran out first.
+        """
+        ticket = (priority, next(self._tickets))
+        started = time.time()
+        give_up = started + timeout if timeout is not None else None
+        with self._cond:
+            heapq.heappush(self._waiting, ticket)
+            while True:
+                now = time.time()
+                self._roll(now)
+                wait = self._wait_time(now, weight, orders, priority) if self._waiting[0] == ticket else None
+                if wait is not None and wait <= 0:
+                    break
+                if give_up is not None and (now >= give_up or (wait is not None and now + wait > give_up)):
+                    self._waiting.remove(ticket)
+                    heapq.heapify(self._waiting)
+                    self._cond.notify_all()
+                    return None
+                if give_up is not None:
+                    wait = min(wait, give_up - now) if wait is not None else give_up - now
+                self._cond.wait(wait)
+            heapq.heappop(self._waiting)
+            self.weight.used += weight
+            self.orders_10s.used += orders
+            self.orders_1m.used += orders
+            self._cond.notify_all()
+        waited = time.time() - started
+        self.total_wait += waited
+        return waited
+
+    def update(self, headers, status_code: int, sent_at: float):
+        """
+        :param headers: response headers (case-insensitive mapping).
+        :param status_code: 429 and 418 stop every request until Retry-After has passed.
+        :param sent_at: time.time() when the request was sent, older windows' counters are ignored.
+        """
+        with self._cond:
+            now = time.time()
+            self._roll(now)
+            for header, window in (("X-MBX-USED-WEIGHT-1M", self.weight),
+                                   ("X-MBX-ORDER-COUNT-10S", self.orders_10s),
+                                   ("X-MBX-ORDER-COUNT-1M", self.orders_1m)):
+                value = headers.get(header)
+                if value is not None and sent_at >= window.start:
+                    window.used = max(window.used, int(value))
+            if status_code in (418, 429):
+                self.rejected += 1
+                retry_after = headers.get("Retry-After")
+                pause = float(retry_after) if retry_after is not None else self.weight.time_left(now)
+                self.banned_until = max(self.banned_until, now + pause)
+                logger.critical("Rate Limiter | %s received, requests paused for %.1fs.", status_code, pause)
+            self._cond.notify_all()
+
+
+if __name__ == '__main__':
+    # Backfill threads saturate a local stand-in that enforces the weight limit while one thread places orders.
+    # Windows are shortened 30x: 2 seconds stand in for a minute.
+    import statistics
+    from connectors.http_transport import HttpTransport
+    from connectors.local_exchange import LocalExchange
+
+    time_scale = 1 / 30
+    weight_limit = 300
+    duration = 6.0
+
+    def run(use_limiter: bool):
+        with LocalExchange() as exchange:
+            exchange.enforce_limits(weight_limit, request_weight, window_seconds=60 * time_scale)
+            exchange.add_route("GET", "/fapi/v1/continuousKlines", lambda method, params: (200, [], {}))
+            exchange.add_route("POST", "/fapi/v1/order", lambda method, params: (200, {"orderId": 1}, {}))
+            transport = HttpTransport(exchange.base_url, pool_size=8)
+            limiter = RateLimiter(weight_per_minute=weight_limit, time_scale=time_scale)
+            stop_at = time.time() + duration
+            statuses = list()
+            order_latency = list()
+
+            def send(method, endpoint, params, priority):
+                if use_limiter:
+                    limiter.acquire(request_weight(method, endpoint, params), order_count(method, endpoint, params),
+                                    priority)
+                sent_at = time.time()
+                response = transport.request(method, endpoint, params)
+                if use_limiter:
+                    limiter.update(response.headers, response.status_code, sent_at)
+                statuses.append(response.status_code)
+                return response
+
+            def backfill():
+                params = {'pair': "BTCUSDT", 'interval': "1m", 'limit': 1500}
+                while time.time() < stop_at:
+                    send("GET", "/fapi/v1/continuousKlines", params, PRIORITY_BACKFILL)
+
+            def orders():
+                while time.time() < stop_at:
+                    ts = time.perf_counter()
+                    send("POST", "/fapi/v1/order", {'symbol': "BTCUSDT"}, PRIORITY_ORDER)
+                    order_latency.append(time.perf_counter() - ts)
+                    time.sleep(0.05)
+
+            threads = [threading.Thread(target=backfill) for _ in range(6)] + [threading.Thread(target=orders)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            transport.close()
+            accepted_weight = exchange.accepted_weight
+        ok = statuses.count(200)
+        print(f"limiter={'on ' if use_limiter else 'off'} requests={len(statuses)} ok={ok}"
+              f" 429={statuses.count(429)} accepted weight/s={accepted_weight / duration:.0f}"
+              f" (limit {weight_limit / (60 * time_scale):.0f}) order latency p50={statistics.median(order_latency) * 1000:.1f}ms"
+              f" max={max(order_latency) * 1000:.1f}ms")
+
+    run(use_limiter=False)
+    run(use_limiter=True)
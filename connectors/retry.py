@@ -0,0 +1,195 @@
+import random
+import typing
+import uuid
+
+import requests
+
+# Binance error codes worth another attempt: -1001 internal disconnect, -1021 timestamp outside recvWindow
+# (a fresh signature fixes it), -1007 backend timeout.
+RETRY_ERROR_CODES = {-1001, -1021, -1007}
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Failures after which the request may or may not have been executed. An order is only sent again once the
+# exchange confirms it doesn't have it: a repeated newClientOrderId is refused only while the first order is open,
+# so a filled or cancelled order would execute a second time.
+UNKNOWN_OUTCOME_CODES = {-1001, -1007}
+DUPLICATE_CLIENT_ORDER_ID = -4116
+ORDER_DOES_NOT_EXIST = -2013
+
+# Endpoints that place orders, never re-sent blindly after an unknown outcome.
+ORDER_PLACEMENT = {("POST", "/fapi/v1/order"), ("POST", "/fapi/v1/batchOrders")}
+
+CLIENT_ORDER_ID_PREFIX = "tb-"
+
+
+class RetryPolicy:
+    """
+    How often and how long a request may be retried. Delays grow exponentially with full jitter, and no attempt
+    starts once the deadline (seconds from the first attempt) would be passed.
+    """
+    __slots__ = ("max_attempts", "base_delay", "max_delay", "deadline")
+
+    def __init__(self, max_attempts=4, base_delay=0.1, max_delay=2.0, deadline=10.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+
+    def delay(self, attempt: int) -> float:
+        """Sleep before retry number `attempt` (1 for the first retry)."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+DEFAULT_POLICY = RetryPolicy()
+# orders are only worth placing quickly: few, short retries and a tight deadline
+ORDER_POLICY = RetryPolicy(max_attempts=3, base_delay=0.05, max_delay=0.4, deadline=2.0)
+NO_RETRY = RetryPolicy(max_attempts=1)
+
+ENDPOINT_POLICIES: typing.Dict[typing.Tuple[str, str], RetryPolicy] = {
+    ("POST", "/fapi/v1/order"): ORDER_POLICY,
+    ("POST", "/fapi/v1/batchOrders"): ORDER_POLICY,
+    ("DELETE", "/fapi/v1/order"): ORDER_POLICY,
+    ("DELETE", "/fapi/v1/batchOrders"): ORDER_POLICY,
+    ("DELETE", "/fapi/v1/allOpenOrders"): ORDER_POLICY,
+    # changing leverage or margin twice is harmless, but a late change is worse than an error
+    ("POST", "/fapi/v1/leverage"): RetryPolicy(max_attempts=2, deadline=3.0),
+    ("POST", "/fapi/v1/marginType"): RetryPolicy(max_attempts=2, deadline=3.0),
+    # batch cancels of a countdown are only meaningful on time
+    ("POST", "/fapi/v1/countdownCancelAll"): NO_RETRY,
+}
+
+
+def policy_for(method: str, endpoint: str) -> RetryPolicy:
+    return ENDPOINT_POLICIES.get((method, endpoint), DEFAULT_POLICY)
+
+
+def new_client_order_id() -> str:
+    """Unique newClientOrderId (at most 36 characters of [.A-Z:/a-z0-9_-])."""
+    return CLIENT_ORDER_ID_PREFIX + uuid.uuid4().hex
+
+
+def error_code(response: requests.Response) -> typing.Optional[int]:
+    try:
+        body = response.json()
+    except ValueError:
+        return None
+    return body.get('code') if isinstance(body, dict) else None
+
+
+def is_unknown_outcome(response: typing.Optional[requests.Response], error: typing.Optional[Exception]) -> bool:
+    """
+    True when the request may have been executed although it failed: a timeout or broken connection once the
+    request could have been sent, a 5xx, or -1001/-1007. A connect timeout or a 429 means it was never processed.
+    """
+    if error is not None:
+        return not isinstance(error, requests.ConnectTimeout)
+    return is_unknown_status(response.status_code, error_code(response) if response.status_code == 400 else None)
+
+
+def is_retryable(response: typing.Optional[requests.Response], error: typing.Optional[Exception]) -> bool:
+    """Connection errors, timeouts, 5xx, 429 and the transient error codes are retried; anything else is final."""
+    if error is not None:
+        return isinstance(error, (requests.ConnectionError, requests.Timeout))
+    return is_retryable_status(response.status_code,
+                               error_code(response) if response.status_code == 400 else None)
+
+
+def is_unknown_status(status_code: int, code: typing.Optional[int]) -> bool:
+    """is_unknown_outcome() for a response that came back, given its status and Binance error code."""
+    if status_code // 100 == 5:
+        return True
+    return status_code == 400 and code in UNKNOWN_OUTCOME_CODES
+
+
+def is_retryable_status(status_code: int, code: typing.Optional[int]) -> bool:
+    """is_retryable() for a response that came back, given its status and Binance error code."""
+    if status_code in RETRY_STATUSES:
+        return True
+    return status_code == 400 and code in RETRY_ERROR_CODES
+
+if __name__ == '__main__':
+    # Order placement against a stand-in that fails 30% of the requests with 503. Half of those failures happen
+    # after the order was executed (status unknown). Like the exchange, the stand-in refuses a repeated client id
+    # only while that order is open: market orders fill at once, so a blind retry executes them twice.
+    import json
+    import statistics
+    import tempfile
+    import threading
+    import time
+    from connectors.binance_futures import BinanceFuturesClient
+    from connectors.local_exchange import LocalExchange
+
+    random.seed(7)
+    executions: typing.Dict[str, typing.List[dict]] = dict()
+    lock = threading.Lock()
+
+    def execute(params: dict) -> dict:
+        """Places one order, or returns the -4116 error while an open order has the same client id."""
+        client_id = params['newClientOrderId']
+        with lock:
+            previous = executions.get(client_id)
+            if previous and previous[-1]['status'] == "NEW":
+                return {"code": DUPLICATE_CLIENT_ORDER_ID, "msg": "ClientOrderId is duplicated."}
+            order = {"avgPrice": "0", "orderId": sum(map(len, executions.values())) + 1, "executedQty": "0",
+                     "origQty": params['quantity'], "origType": params['type'], "price": params.get('price', "0"),
+                     "side": params['side'], "status": "FILLED" if params['type'] == "MARKET" else "NEW",
+                     "stopPrice": "0", "symbol": params['symbol'], "updateTime": 0, "timeInForce": "GTC",
+                     "clientOrderId": client_id}
+            executions.setdefault(client_id, list()).append(order)
+        return order
+
+    def order_route(method, params):
+        time.sleep(0.005)
+        if method == "GET":
+            found = executions.get(params['origClientOrderId'])
+            return (200, found[-1], {}) if found else (400, {"code": ORDER_DOES_NOT_EXIST,
+                                                             "msg": "Order does not exist."}, {})
+        roll = random.random()
+        if roll < 0.15:
+            return 503, {"code": -1001, "msg": "Internal error; unable to process your request."}, {}
+        order = execute(params)
+        if 'code' in order:
+            return 400, order, {}
+        if roll < 0.30:
+            return 503, {"code": -1007, "msg": "Timeout waiting for response from backend server."}, {}
+        return 200, order, {}
+
+    def batch_route(method, params):
+        time.sleep(0.005)
+        roll = random.random()
+        if roll < 0.15:
+            return 503, {"code": -1001, "msg": "Internal error; unable to process your request."}, {}
+        placed = [execute(order) for order in json.loads(params['batchOrders'])]
+        if roll < 0.30:
+            return 503, {"code": -1007, "msg": "Timeout waiting for response from backend server."}, {}
+        return 200, placed, {}
+
+    with LocalExchange() as exchange:
+        exchange.add_route("*", "/fapi/v1/order", order_route)
+        exchange.add_route("POST", "/fapi/v1/batchOrders", batch_route)
+        client = BinanceFuturesClient("key", "secret", testnet=True, base_url=exchange.base_url,
+                                      metadata_dir=tempfile.mkdtemp(), wait_ready=False)
+        latencies = list()
+        placed = 0
+        n = 200
+        for i in range(n):
+            params = {'symbol': "BTCUSDT", 'side': "BUY", 'quantity': "0.001"}
+            params.update({'type': "MARKET"} if i % 2 else {'type': "LIMIT", 'timeInForce': "GTC",
+                                                              'price': str(20000 + i)})
+            ts = time.perf_counter()
+            response = client.make_request("POST", "/fapi/v1/order", params)
+            latencies.append(time.perf_counter() - ts)
+            placed += response is not None
+        single_orders = len(executions)
+        single_duplicates = sum(len(orders) - 1 for orders in executions.values())
+
+        batch_results = client.place_orders([{'symbol': "BTCUSDT", 'side': "SELL", 'type': "MARKET",
+                                              'quantity': 0.001} for _ in range(100)])
+        batch_duplicates = sum(len(orders) - 1 for orders in executions.values()) - single_duplicates
+
+    latencies.sort()
+    print(f"{n} orders (half market): {placed} confirmed, {single_orders} executed, {single_duplicates} duplicates,"
+          f" {n - placed} unconfirmed")
+    print(f"latency p50={statistics.median(latencies) * 1000:.1f}ms p99={latencies[int(n * 0.99)] * 1000:.1f}ms"
+          f" max={latencies[-1] * 1000:.1f}ms (order deadline {ORDER_POLICY.deadline * 1000:.0f}ms)")
+    print(f"100 market orders in batches: {sum(result.ok for result in batch_results)} confirmed,"
+          f" {len(executions) - single_orders} executed, {batch_duplicates} duplicates")
@@ -0,0 +1,280 @@
+import json
+import logging
+import math
+import threading
+import time
+import typing
+
+import websocket
+
+import logkeeper
+
+logger = logging.getLogger("stream_manager.py")
+logkeeper.log_keeper("connectors.log", "stream_manager.py")
+
+MAX_STREAMS_PER_CONNECTION = 200    # Binance allows 1024, fewer keeps each reader thread and URL small
+MAX_CONTROL_MESSAGES_PER_SECOND = 10    # incoming message limit per connection, including SUBSCRIBE/UNSUBSCRIBE
+MAX_PARAMS_PER_MESSAGE = 100
+
+
+def stream_symbol(stream: str) -> str:
+    """'btcusdt@depth@100ms' -> 'btcusdt'"""
+    return stream.split("@", 1)[0]
+
+
+class StreamConnection:
+    """
+    One websocket connection on the combined endpoint (/stream?streams=a/b/c). The set of streams lives here, not
+    in the socket, so every reconnect opens with the current set and nothing has to be re-subscribed by hand.
+    """
+    def __init__(self, connection_id: int, base_url: str, on_message: typing.Callable,
+                 on_open: typing.Optional[typing.Callable] = None, on_error: typing.Optional[typing.Callable] = None,
+                 on_close: typing.Optional[typing.Callable] = None):
+        self.connection_id = connection_id
+        self.base_url = base_url
+        self.streams: typing.Set[str] = set()
+        self.is_connected = False
+        self.reconnects = 0
+        self._on_message = on_message
+        self._on_open = on_open
+        self._on_error = on_error
+        self._on_close = on_close
+        self._ws: typing.Optional[websocket.WebSocketApp] = None
+        self._thread: typing.Optional[threading.Thread] = None
+        self._running = False
+        self._request_id = 1
+        self._url_streams: typing.Set[str] = set()
+        self._last_send = 0.0
+        self._send_lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        if not self.streams:
+            return f"{self.base_url}/stream"
+        return f"{self.base_url}/stream?streams={'/'.join(sorted(self.streams))}"
+
+    def start(self):
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._ws is not None:
+            self._ws.close()
+        self._thread = None
+
+    def _run(self):
+        backoff = 1
+        while self._running:
+            self._url_streams = set(self.streams)
+            self._ws = websocket.WebSocketApp(self.url, on_open=self._opened, on_message=self._on_message,
+                                              on_error=self._errored, on_close=self._closed)
+            opened_at = time.time()
+            try:
+                self._ws.run_forever(ping_interval=180, ping_timeout=10)
+            except Exception as e:
+                logger.error("Stream Manager | Connection %s crashed: %s", self.connection_id, e)
+            self.is_connected = False
+            if not self._running:
+                break
+            # a connection that stayed up for a while starts the backoff over
+            backoff = 1 if time.time() - opened_at > 60 else min(backoff * 2, 30)
+            self.reconnects += 1
+            logger.warning("Stream Manager | Connection %s dropped, reconnecting in %ss with %s streams.",
+                           self.connection_id, backoff, len(self.streams))
+            time.sleep(backoff)
+
+    def _opened(self, ws):
+        self.is_connected = True
+        logger.info("Stream Manager | Connection %s open with %s streams.", self.connection_id, len(self.streams))
+        # streams added while the socket was connecting are not in its URL
+        self.send_streams("SUBSCRIBE", sorted(self.streams - self._url_streams))
+        if self._on_open is not None:
+            self._on_open(ws)
+
+    def _errored(self, ws, error):
+        if self._on_error is not None:
+            self._on_error(ws, error)
+
+    def _closed(self, ws, close_status_code, close_msg):
+        self.is_connected = False
+        if self._on_close is not None:
+            self._on_close(ws, close_status_code, close_msg)
+
+    def send(self, method: str, params: typing.Optional[typing.List[str]] = None) -> bool:
+        """Sends a control message, throttled to the per-connection limit. False if the socket is down."""
+        if not self.is_connected:
+            return False
+        with self._send_lock:
+            wait = self._last_send + 1 / MAX_CONTROL_MESSAGES_PER_SECOND - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            data = {'method': method, 'id': self._request_id}
+            if params is not None:
+                data['params'] = params
+            self._request_id += 1
+            try:
+                self._ws.send(json.dumps(data))
+            except Exception as e:
+                logger.error("Stream Manager | Connection %s could not send %s: %s", self.connection_id, method, e)
+                return False
+            finally:
+                self._last_send = time.time()
+        return True
+
+    def send_streams(self, method: str, streams: typing.List[str]):
+        """SUBSCRIBE/UNSUBSCRIBE in messages of up to MAX_PARAMS_PER_MESSAGE streams."""
+        for i in range(0, len(streams), MAX_PARAMS_PER_MESSAGE):
+            self.send(method, streams[i:i + MAX_PARAMS_PER_MESSAGE])
+
+    def add(self, streams: typing.List[str], send=True) -> typing.List[str]:
+        """
+        :param send: False only records the streams, the caller sends the returned ones with send_streams().
+        :return: the streams that were new to this connection.
+        """
+        new = [stream for stream in streams if stream not in self.streams]
+        self.streams.update(new)
+        # when the socket is down the streams go into the URL of the next reconnect instead
+        if send:
+            self.send_streams("SUBSCRIBE", new)
+        return new
+
+    def discard(self, streams: typing.List[str]):
+        old = [stream for stream in streams if stream in self.streams]
+        self.streams.difference_update(old)
+        self.send_streams("UNSUBSCRIBE", old)
+
+
+class StreamManager:
+    """
+    Spreads market streams over as many connections as needed. All streams of a symbol share a connection; new
+    symbols go to the connection with the fewest streams. After removals, rebalance() folds connections together
+    when fewer of them would do, subscribing on the new connection before the old one is closed.
+    """
+    def __init__(self, base_url: str, on_message: typing.Callable, on_open: typing.Optional[typing.Callable] = None,
+                 on_error: typing.Optional[typing.Callable] = None, on_close: typing.Optional[typing.Callable] = None,
+                 max_streams_per_connection=MAX_STREAMS_PER_CONNECTION):
+        """
+        :param base_url: websocket root without path, i.e. wss://fstream.binance.com
+        :param on_message: websocket callback (ws, msg), shared by all connections.
+        :param on_open: called with (ws) every time a connection opens, reconnects included.
+        """
+        self.base_url = base_url.rstrip("/")
+        self.max_streams_per_connection = max_streams_per_connection
+        self.connections: typing.Dict[int, StreamConnection] = dict()
+        self.symbol_connection: typing.Dict[str, int] = dict()
+        self._callbacks = (on_message, on_open, on_error, on_close)
+        self._next_id = 1
+        self._running = False
+        self._lock = threading.RLock()
+
+    @property
+    def streams(self) -> typing.Set[str]:
+        return set().union(*(connection.streams for connection in self.connections.values()))
+
+    def start(self):
+        with self._lock:
+            self._running = True
+            for connection in self.connections.values():
+                if connection.streams:
+                    connection.start()
+
+    def stop(self):
+        with self._lock:
+            self._running = False
+            for connection in self.connections.values():
+                connection.stop()
+
+    def _new_connection(self) -> StreamConnection:
+        connection = StreamConnection(self._next_id, self.base_url, *self._callbacks)
+        self.connections[self._next_id] = connection
+        self._next_id += 1
+        return connection
+
+    def _connection_for(self, symbol: str, count: int) -> StreamConnection:
+        connection_id = self.symbol_connection.get(symbol)
+        if connection_id is not None:
+            return self.connections[connection_id]
+        candidates = [c for c in self.connections.values()
+                      if len(c.streams) + count <= self.max_streams_per_connection]
+        if candidates:
+            return min(candidates, key=lambda c: len(c.streams))
+        return self._new_connection()
+
+    def subscribe(self, streams: typing.List[str]):
+        """:param streams: stream names, i.e. ['btcusdt@aggTrade', 'ethusdt@depth@100ms']"""
+        by_symbol: typing.Dict[str, typing.List[str]] = dict()
+        for stream in streams:
+            by_symbol.setdefault(stream_symbol(stream), list()).append(stream)
+        by_connection: typing.Dict[int, typing.List[str]] = dict()
+        with self._lock:
+            for symbol, symbol_streams in by_symbol.items():
+                connection = self._connection_for(symbol, len(symbol_streams))
+                self.symbol_connection[symbol] = connection.connection_id
+                # counted right away so the next symbol sees the load, sent below in one go per connection
+                by_connection.setdefault(connection.connection_id, list()).extend(
+                    connection.add(symbol_streams, send=False))
+            connections = [(self.connections[connection_id], new) for connection_id, new in by_connection.items()]
+            if self._running:
+                for connection, _ in connections:
+                    connection.start()
+        # paced sends (10 messages/s per connection) don't hold the lock
+        for connection, new in connections:
+            connection.send_streams("SUBSCRIBE", new)
+
+    def unsubscribe(self, streams: typing.List[str]):
+        by_connection: typing.Dict[int, typing.List[str]] = dict()
+        with self._lock:
+            for stream in streams:
+                connection_id = self.symbol_connection.get(stream_symbol(stream))
+                if connection_id is not None:
+                    by_connection.setdefault(connection_id, list()).append(stream)
+            for connection_id, connection_streams in by_connection.items():
+                connection = self.connections[connection_id]
+                connection.discard(connection_streams)
+                for symbol in {stream_symbol(stream) for stream in connection_streams}:
+                    if not any(stream_symbol(stream) == symbol for stream in connection.streams):
+                        del self.symbol_connection[symbol]
+                if not connection.streams:
+                    connection.stop()
+                    del self.connections[connection_id]
+            self.rebalance()
+
+    def rebalance(self):
+        """Empties the least loaded connections into the others while fewer connections would be enough."""
+        with self._lock:
+            total = sum(len(connection.streams) for connection in self.connections.values())
+            needed = max(1, math.ceil(total / self.max_streams_per_connection))
+            while len(self.connections) > needed:
+                source = min(self.connections.values(), key=lambda c: len(c.streams))
+                moves: typing.Dict[str, typing.List[str]] = dict()
+                for stream in source.streams:
+                    moves.setdefault(stream_symbol(stream), list()).append(stream)
+                load = {c.connection_id: len(c.streams) for c in self.connections.values() if c is not source}
+                plan = dict()
+                for symbol, symbol_streams in moves.items():
+                    room = [i for i, n in load.items() if n + len(symbol_streams) <= self.max_streams_per_connection]
+                    if not room:
+                        return
+                    target = min(room, key=load.get)
+                    load[target] += len(symbol_streams)
+                    plan[symbol] = self.connections[target]
+                by_target: typing.Dict[int, typing.List[str]] = dict()
+                for symbol, target in plan.items():
+                    by_target.setdefault(target.connection_id, list()).extend(moves[symbol])
+                    self.symbol_connection[symbol] = target.connection_id
+                for connection_id, target_streams in by_target.items():
+                    self.connections[connection_id].add(target_streams)
+                source.stop()
+                del self.connections[source.connection_id]
+                logger.info("Stream Manager | Folded connection %s into the others, %s connections left.",
+                            source.connection_id, len(self.connections))
+
+    def broadcast(self, method: str):
+        """Sends a parameterless control message (i.e. LIST_SUBSCRIPTIONS) on every connection."""
+        with self._lock:
+            connections = list(self.connections.values())
+        for connection in connections:
+            connection.send(method)
@@ -0,0 +1,493 @@
+import math
+import typing
+from collections import deque
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Vectorized technical indicators over candle arrays.
+#
+# Every function takes 1-D arrays (one symbol) or 2-D arrays of shape (symbols, time) for a batch of symbols that
+# share the same candle timestamps. `periods` can be one look-back or a list of them:
+#   periods=14        -> result has the shape of the input
+#   periods=[7, 14]   -> a period axis is inserted before time: (periods, time) or (symbols, periods, time)
+# Values that are not defined yet (not enough candles) are NaN.
+
+Periods = typing.Union[int, typing.Sequence[int]]
+
+
+# Recurrences run over time slices of about this many bytes (all rows), so every pass over a slice stays in cache.
+CHUNK_BYTES = 1 << 20
+
+
+def _recurrence_chunks(x: np.ndarray, beta: float, y0: np.ndarray, alpha=1.0,
+                       start=0) -> typing.Iterator[typing.Tuple[int, np.ndarray]]:
+    """
+    Solves y[t] = beta * y[t-1] + alpha * x[t] along the last axis of a 2-D array from column start on, with
+    y[start - 1] = y0, one cache-sized slice of time at a time. Inside a slice the recurrence becomes a cumulative
+    sum of x * beta ** -step; the slice is short enough that beta ** -step does not overflow, and the value carried
+    in from the previous slice is added to its first element.
+    :return: (first column, y of the slice). The slice is a scratch buffer that the next one overwrites.
+    """
+    rows, length = x.shape
+    block = max(256, CHUNK_BYTES // (8 * rows))
+    if beta > 0:
+        block = max(1, min(block, int(230 / -math.log(beta))))     # beta ** -block stays below ~1e100
+    steps = np.arange(block)
+    grow = alpha * beta ** -steps if beta > 0 else None
+    shrink = beta ** steps
+    work = np.empty((rows, block))
+    carry = np.array(y0, dtype=np.float64)
+    for first in range(start, length, block):
+        n = min(block, length - first)
+        y = work[:, :n]
+        if beta == 0:
+            np.multiply(x[:, first:first + n], alpha, out=y)
+            yield first, y
+            continue
+        np.multiply(x[:, first:first + n], grow[:n], out=y)
+        y[:, 0] += beta * carry
+        np.cumsum(y, axis=1, out=y)
+        y *= shrink[:n]
+        carry = y[:, -1].copy()
+        yield first, y
+
+
+def linear_recurrence(ax: np.ndarray, beta: float, y0: np.ndarray, alpha=1.0,
+                      out: typing.Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Solves y[t] = beta * y[t-1] + alpha * ax[t] along the last axis of a 2-D array with y[-1] = y0, without a
+    Python loop over every time step (see _recurrence_chunks).
+    :param ax: (rows, time) input.
+    :param beta: decay per step, 0 <= beta < 1.
+    :param y0: (rows,) value before the first step.
+    :param alpha: factor applied to ax, i.e. the smoothing factor.
+    :param out: (rows, time) array to write into.
+    :return: (rows, time)
+    """
+    if out is None:
+        out = np.empty(ax.shape)
+    for first, y in _recurrence_chunks(ax, beta, y0, alpha):
+        out[:, first:first + y.shape[1]] = y
+    return out
+
+
+def _as_batch(values: np.ndarray) -> np.ndarray:
+    return np.atleast_2d(np.asarray(values, dtype=np.float64))
+
+
+def _shape_result(results: typing.List[np.ndarray], values: np.ndarray, periods: Periods) -> np.ndarray:
+    """Stacks per-period (symbols, time) results and drops the axes the caller did not ask for."""
+    if np.isscalar(periods):
+        out = results[0]
+    else:
+        out = np.stack(results, axis=1)     # (symbols, periods, time)
+    if np.ndim(values) == 1:
+        out = out[0]
+    return out
+
+
+def _period_list(periods: Periods) -> typing.List[int]:
+    return [int(periods)] if np.isscalar(periods) else [int(p) for p in periods]
+
+
+def ema(values: np.ndarray, periods: Periods) -> np.ndarray:
+    """Exponential moving average with alpha = 2 / (period + 1), seeded with the first value."""
+    x = _as_batch(values)
+    results = list()
+    for period in _period_list(periods):
+        alpha = 2 / (period + 1)
+        results.append(linear_recurrence(x, 1 - alpha, x[:, 0], alpha))
+    return _shape_result(results, values, periods)
+
+
+def sma(values: np.ndarray, periods: Periods) -> np.ndarray:
+    """Simple moving average. All periods reuse one cumulative sum."""
+    x = _as_batch(values)
+    # subtracting the first value keeps the cumulative sum small, so long series lose no precision
+    base = x[:, :1]
+    csum = np.cumsum(x - base, axis=1)
+    csum = np.concatenate([np.zeros((x.shape[0], 1)), csum], axis=1)
+    results = list()
+    for period in _period_list(periods):
+        out = np.full(x.shape, np.nan)
+        if period <= x.shape[1]:
+            out[:, period - 1:] = (csum[:, period:] - csum[:, :-period]) / period + base
+        results.append(out)
+    return _shape_result(results, values, periods)
+
+
+def _wilder(values: np.ndarray, period: int, first: int) -> np.ndarray:
+    """
+    Wilder's smoothing (alpha = 1 / period). The first defined value, at index first + period - 1, is the simple
+    average of values[first:first + period].
+    """
+    out = np.full(values.shape, np.nan)
+    seed_at = first + period - 1
+    if seed_at >= values.shape[1]:
+        return out
+    seed = values[:, first:seed_at + 1].mean(axis=1)
+    out[:, seed_at] = seed
+    if seed_at + 1 < values.shape[1]:
+        linear_recurrence(values[:, seed_at + 1:], 1 - 1 / period, seed, 1 / period, out=out[:, seed_at + 1:])
+    return out
+
+
+def _gain_ratio(gain: np.ndarray, loss: np.ndarray, total: np.ndarray, out: np.ndarray):
+    """100 * gain / (gain + loss) into out, 50 where both are 0. total is scratch of the same shape."""
+    np.add(gain, loss, out=total)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        np.divide(gain, total, out=out)
+    out *= 100
+    if not total.all():
+        np.copyto(out, 50.0, where=total == 0)
+
+
+def rsi(close: np.ndarray, periods: Periods) -> np.ndarray:
+    """
+    Relative strength index with Wilder's smoothing. First value is defined at index period.
+    Every period is one recurrence over gains and losses stacked together (two per symbol); each cache-sized
+    slice of it is turned into RSI right away and written into the result, so no full-length average is stored.
+    The ratio doesn't change with the scale of the averages, so they are kept as sums (seed = sum, alpha = 1).
+    """
+    x = _as_batch(close)
+    symbols, length = x.shape
+    change = np.diff(x, axis=1, prepend=x[:, :1])
+    # gains on top, losses below, computed once for all periods
+    moves = np.concatenate([np.maximum(change, 0), np.maximum(-change, 0)])
+    period_list = _period_list(periods)
+    result = np.empty((symbols, len(period_list), length))
+    total = np.empty((symbols, max(256, CHUNK_BYTES // (8 * 2 * symbols))))
+    for i, period in enumerate(period_list):
+        out = result[:, i]
+        out[:, :min(period, length)] = np.nan
+        if period >= length:
+            continue
+        seed = moves[:, 1:period + 1].sum(axis=1)
+        _gain_ratio(seed[:symbols, None], seed[symbols:, None], total[:, :1], out[:, period:period + 1])
+        for first, sums in _recurrence_chunks(moves, 1 - 1 / period, seed, start=period + 1):
+            n = sums.shape[1]
+            _gain_ratio(sums[:symbols], sums[symbols:], total[:, :n], out[:, first:first + n])
+    if np.isscalar(periods):
+        result = result[:, 0]
+    if np.ndim(close) == 1:
+        result = result[0]
+    return result
+
+
+def true_range(high: np.ndarray, low: np.ndarray, close: np.ndarray) -> np.ndarray:
+    h, l, c = _as_batch(high), _as_batch(low), _as_batch(close)
+    previous_close = np.concatenate([c[:, :1], c[:, :-1]], axis=1)
+    tr = np.maximum(h - l, np.maximum(np.abs(h - previous_close), np.abs(l - previous_close)))
+    tr[:, 0] = h[:, 0] - l[:, 0]
+    return tr if np.ndim(high) > 1 else tr[0]
+
+
+def atr(high: np.ndarray, low: np.ndarray, close: np.ndarray, periods: Periods) -> np.ndarray:
+    """Average true range with Wilder's smoothing. First value is defined at index period - 1."""
+    tr = _as_batch(true_range(high, low, close))
+    results = [_wilder(tr, period, 0) for period in _period_list(periods)]
+    return _shape_result(results, close, periods)
+
+
+def rolling_min(values: np.ndarray, period: int) -> np.ndarray:
+    x = _as_batch(values)
+    out = np.full(x.shape, np.nan)
+    if period <= x.shape[1]:
+        out[:, period - 1:] = sliding_window_view(x, period, axis=1).min(axis=2)
+    return out
+
+
+def rolling_max(values: np.ndarray, period: int) -> np.ndarray:
+    x = _as_batch(values)
+    out = np.full(x.shape, np.nan)
+    if period <= x.shape[1]:
+        out[:, period - 1:] = sliding_window_view(x, period, axis=1).max(axis=2)
+    return out
+
+
+def kdj(high: np.ndarray, low: np.ndarray, close: np.ndarray,
+        periods: Periods) -> typing.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    KDJ stochastic oscillator. RSV over `period` candles, K and D are smoothed with 1/3 weight starting from 50,
+    J = 3K - 2D. First values are defined at index period - 1.
+    :return: (K, D, J)
+    """
+    h, l, c = _as_batch(high), _as_batch(low), _as_batch(close)
+    k_results, d_results = list(), list()
+    for period in _period_list(periods):
+        k = np.full(c.shape, np.nan)
+        d = np.full(c.shape, np.nan)
+        if period <= c.shape[1]:
+            lowest = rolling_min(l, period)[:, period - 1:]
+            highest = rolling_max(h, period)[:, period - 1:]
+            spread = highest - lowest
+            with np.errstate(invalid="ignore", divide="ignore"):
+                rsv = np.where(spread > 0, (c[:, period - 1:] - lowest) / spread * 100, 50.0)
+            start = np.full(c.shape[0], 50.0)
+            k[:, period - 1:] = linear_recurrence(rsv / 3, 2 / 3, start)
+            d[:, period - 1:] = linear_recurrence(k[:, period - 1:] / 3, 2 / 3, start)
+        k_results.append(k)
+        d_results.append(d)
+    k = _shape_result(k_results, close, periods)
+    d = _shape_result(d_results, close, periods)
+    return k, d, 3 * k - 2 * d
+
+
+def stack_series(series_list: list, field="close") -> np.ndarray:
+    """
+    Builds a (symbols, time) batch from CandleSeries of different symbols.
+    Series must cover the same candles, i.e. the same between() range of the same interval.
+    """
+    lengths = {len(series) for series in series_list}
+    if len(lengths) > 1:
+        raise ValueError(f"Series lengths differ: {sorted(lengths)}")
+    return np.stack([np.asarray(getattr(series, field), dtype=np.float64) for series in series_list])
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# Streaming versions
+# ---------------------------------------------------------------------------------------------------------------------
+# Incremental indicators fed one candle at a time (anything with high/low/close attributes, i.e. models.Candle).
+# update(candle, closed=True) commits the candle and returns the new value; closed=False computes the value for the
+# candle that is still forming without changing the state, so a live candle can be updated as often as needed.
+# Each update is O(1) and gives the same numbers as the batch functions above.
+
+
+class StreamingIndicator:
+    def __init__(self, period: int):
+        self.period = int(period)
+        self.count = 0      # closed candles seen
+        self.value = math.nan
+
+    def update(self, candle, closed=True):
+        raise NotImplementedError
+
+    def warm_up(self, candles: typing.Iterable):
+        """Feeds closed historical candles (i.e. a CandleSeries) before live updates start."""
+        for candle in candles:
+            self.update(candle, closed=True)
+        return self.value
+
+    def snapshot(self) -> dict:
+        return {key: (value.copy() if isinstance(value, deque) else value) for key, value in self.__dict__.items()}
+
+    def restore(self, snapshot: dict):
+        self.__dict__.update({key: (value.copy() if isinstance(value, deque) else value)
+                              for key, value in snapshot.items()})
+
+
+class StreamingEMA(StreamingIndicator):
+    def __init__(self, period: int):
+        super().__init__(period)
+        self.alpha = 2 / (self.period + 1)
+        self.ema = math.nan
+
+    def update(self, candle, closed=True):
+        price = candle.close
+        ema = price if self.count == 0 else self.ema + self.alpha * (price - self.ema)
+        if not closed:
+            return ema
+        self.ema = ema
+        self.count += 1
+        self.value = ema
+        return ema
+
+
+class StreamingSMA(StreamingIndicator):
+    def __init__(self, period: int):
+        super().__init__(period)
+        self.window = deque()
+        self.total = 0.0
+
+    def update(self, candle, closed=True):
+        price = candle.close
+        full = len(self.window) == self.period
+        total = self.total + price - (self.window[0] if full else 0.0)
+        sma = total / self.period if full or len(self.window) == self.period - 1 else math.nan
+        if not closed:
+            return sma
+        self.window.append(price)
+        if full:
+            self.window.popleft()
+        self.count += 1
+        # the running sum is rebuilt once per period so float drift can't accumulate, still O(1) amortized
+        self.total = total if self.count % self.period else math.fsum(self.window)
+        if len(self.window) == self.period:
+            sma = self.total / self.period
+        self.value = sma
+        return sma
+
+
+class _Wilder:
+    """Wilder's smoothing state: simple average of the first `period` values, then alpha = 1 / period."""
+    __slots__ = ("period", "count", "average")
+
+    def __init__(self, period: int):
+        self.period = period
+        self.count = 0
+        self.average = 0.0
+
+    def peek(self, value: float) -> float:
+        if self.count < self.period - 1:
+            return math.nan
+        if self.count == self.period - 1:
+            return (self.average * self.count + value) / self.period
+        return self.average + (value - self.average) / self.period
+
+    def push(self, value: float) -> float:
+        if self.count < self.period:
+            self.average += (value - self.average) / (self.count + 1)    # running mean while seeding
+        else:
+            self.average += (value - self.average) / self.period
+        self.count += 1
+        return self.average if self.count >= self.period else math.nan
+
+    def copy(self):
+        new = _Wilder(self.period)
+        new.count, new.average = self.count, self.average
+        return new
+
+
+class StreamingRSI(StreamingIndicator):
+    def __init__(self, period: int):
+        super().__init__(period)
+        self.previous_close = math.nan
+        self.gains = _Wilder(self.period)
+        self.losses = _Wilder(self.period)
+
+    @staticmethod
+    def _rsi(gain: float, loss: float) -> float:
+        if math.isnan(gain):
+            return math.nan
+        return 50.0 if gain + loss == 0 else 100 * gain / (gain + loss)
+
+    def update(self, candle, closed=True):
+        price = candle.close
+        if self.count == 0:
+            if closed:
+                self.previous_close = price
+                self.count = 1
+            return math.nan
+        change = price - self.previous_close
+        gain, loss = max(change, 0.0), max(-change, 0.0)
+        if not closed:
+            return self._rsi(self.gains.peek(gain), self.losses.peek(loss))
+        rsi_value = self._rsi(self.gains.push(gain), self.losses.push(loss))
+        self.previous_close = price
+        self.count += 1
+        self.value = rsi_value
+        return rsi_value
+
+    def snapshot(self) -> dict:
+        snapshot = super().snapshot()
+        snapshot["gains"], snapshot["losses"] = self.gains.copy(), self.losses.copy()
+        return snapshot
+
+    def restore(self, snapshot: dict):
+        super().restore(snapshot)
+        self.gains, self.losses = snapshot["gains"].copy(), snapshot["losses"].copy()
+
+
+class StreamingATR(StreamingIndicator):
+    def __init__(self, period: int):
+        super().__init__(period)
+        self.previous_close = math.nan
+        self.true_ranges = _Wilder(self.period)
+
+    def update(self, candle, closed=True):
+        if self.count == 0:
+            tr = candle.high - candle.low
+        else:
+            tr = max(candle.high - candle.low, abs(candle.high - self.previous_close),
+                     abs(candle.low - self.previous_close))
+        if not closed:
+            return self.true_ranges.peek(tr)
+        atr_value = self.true_ranges.push(tr)
+        self.previous_close = candle.close
+        self.count += 1
+        self.value = atr_value
+        return atr_value
+
+    def snapshot(self) -> dict:
+        snapshot = super().snapshot()
+        snapshot["true_ranges"] = self.true_ranges.copy()
+        return snapshot
+
+    def restore(self, snapshot: dict):
+        super().restore(snapshot)
+        self.true_ranges = snapshot["true_ranges"].copy()
+
+
+class StreamingKDJ(StreamingIndicator):
+    """Values are (K, D, J) tuples."""
+    def __init__(self, period: int):
+        super().__init__(period)
+        # monotonic deques of (index, price): lows increasing, highs decreasing, front is the window extreme
+        self.lows = deque()
+        self.highs = deque()
+        self.k = 50.0
+        self.d = 50.0
+        self.value = (math.nan, math.nan, math.nan)
+
+    def _extreme(self, queue: deque, price: float, lowest: bool) -> float:
+        """Extreme of the window ending at the current candle; the committed deque may still hold the one leaving."""
+        oldest_allowed = self.count - self.period + 1
+        for index, queued in queue:
+            if index >= oldest_allowed:
+                return min(queued, price) if lowest else max(queued, price)
+        return price
+
+    def update(self, candle, closed=True):
+        lowest = self._extreme(self.lows, candle.low, True)
+        highest = self._extreme(self.highs, candle.high, False)
+        if self.count < self.period - 1:
+            kdj_value = (math.nan, math.nan, math.nan)
+            k, d = self.k, self.d
+        else:
+            spread = highest - lowest
+            rsv = (candle.close - lowest) / spread * 100 if spread > 0 else 50.0
+            k = self.k + (rsv - self.k) / 3
+            d = self.d + (k - self.d) / 3
+            kdj_value = (k, d, 3 * k - 2 * d)
+        if not closed:
+            return kdj_value
+
+        index = self.count
+        while self.lows and self.lows[-1][1] >= candle.low:
+            self.lows.pop()
+        self.lows.append((index, candle.low))
+        while self.highs and self.highs[-1][1] <= candle.high:
+            self.highs.pop()
+        self.highs.append((index, candle.high))
+        for queue in (self.lows, self.highs):
+            if queue[0][0] <= index - self.period:
+                queue.popleft()
+        self.k, self.d = k, d
+        self.count += 1
+        self.value = kdj_value
+        return kdj_value
+
+
+if __name__ == '__main__':
+    # Parameter scan: 100 EMA and 100 RSI look-backs on a year of 1m candles for 20 symbols, ~1e9 values each.
+    # Both are bound by the recurrence, a few passes over every value; an RSI period is one recurrence over gains
+    # and losses of every symbol (twice the rows of an EMA) plus the ratio, so it costs a bit over two EMAs.
+    import time
+
+    rng = np.random.default_rng(7)
+    symbols, minutes = 20, 365 * 24 * 60
+    close = 100 * np.exp(np.cumsum(rng.normal(0, 1e-3, (symbols, minutes)), axis=1))
+    values = 100 * symbols * minutes
+
+    ts = time.perf_counter()
+    last_ema = [ema(close, period)[:, -1].copy() for period in range(5, 205, 2)]
+    elapsed = time.perf_counter() - ts
+    print(f"EMA: 100 periods x {symbols} symbols x {minutes} candles in {elapsed:.2f}s"
+          f" ({elapsed / values * 1e9:.1f} ns per value)")
+
+    ts = time.perf_counter()
+    last_rsi = [rsi(close, list(range(first, first + 10)))[:, :, -1].copy() for first in range(5, 105, 10)]
+    elapsed = time.perf_counter() - ts
+    print(f"RSI: 100 periods x {symbols} symbols x {minutes} candles in {elapsed:.2f}s"
+          f" ({elapsed / values * 1e9:.1f} ns per value)")
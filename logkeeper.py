@@ -1,5 +1,23 @@
+import atexit
+import json
 import logging
-import datetime as dt
+import logging.handlers
+import os
+import queue
+import threading
+import typing
+
+LOG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logfiles")
+LOG_MAX_BYTES = 10 * 1024 * 1024   # a log file is rotated at this size
+LOG_BACKUPS = 5                    # rotated files kept, file.log.1 ... file.log.5
+LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+# Attributes every LogRecord has; anything else on a record came from `extra=` and is written as a field.
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+# One queue and listener thread per log file, shared by every logger writing to it.
+_listeners: typing.Dict[str, typing.Tuple[logging.handlers.QueueHandler, logging.handlers.QueueListener]] = dict()
+_lock = threading.Lock()
 
 
 def log_examples(extra_words):
@@ -9,31 +27,193 @@ def log_examples(extra_words):
     logger.warning("Hell is here!")
     logger.error("something's not right")
     logger.critical("OMG critical error!")
-    # TODO: read https://docs.python.org/3/library/logging.html for effective logging
 
 
-def log_keeper(file_path=None, name=None):
+class StructuredFormatter(logging.Formatter):
+    """
+    One JSON object per line: time, level, logger, thread, message, the exception if any, and every field passed
+    with extra=, i.e. logger.info("Order placed", extra={'symbol': "BTCUSDT", 'order_id': 123}).
+    """
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {"time": self.formatTime(record), "ts": int(record.created * 1000), "level": record.levelname,
+                 "logger": record.name, "thread": record.threadName, "message": record.getMessage()}
+        entry.update({key: value for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES})
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """
+    Keeps the caller's work to a message format and a queue put. The stdlib version also copies the record and
+    runs it through a Formatter on the calling thread.
+    """
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            # tracebacks hold frames alive and may change once the caller moves on, they are formatted here
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def _listener(path: str, structured: bool) -> logging.handlers.QueueHandler:
+    with _lock:
+        if path in _listeners:
+            return _listeners[path][0]
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        stream_handler.setLevel(logging.INFO)
+
+        file_handler = logging.handlers.RotatingFileHandler(path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS,
+                                                            encoding="utf-8")
+        file_handler.setFormatter(StructuredFormatter() if structured else logging.Formatter(LOG_FORMAT))
+        file_handler.setLevel(logging.INFO)
+
+        log_queue: "queue.SimpleQueue" = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(log_queue, stream_handler, file_handler,
+                                                  respect_handler_level=True)
+        listener.start()
+        handler = _QueueHandler(log_queue)
+        handler.log_path = path
+        _listeners[path] = (handler, listener)
+        return handler
+
+
+def stop_listeners():
+    """Writes out every queued record and stops the listener threads (also done at exit)."""
+    with _lock:
+        for handler, listener in _listeners.values():
+            listener.stop()
+            for target in listener.handlers:
+                target.close()
+        _listeners.clear()
+
+
+def redirect_loggers(file_path: str):
+    """
+    Moves every logger set up with log_keeper() to file_path and closes the files they wrote to. For a child
+    process: two processes rotating the same file lose each other's records.
+    :param file_path: file name inside LOG_DIR (or an absolute path).
+    """
+    stop_listeners()
+    for logger in list(logging.Logger.manager.loggerDict.values()):
+        if not isinstance(logger, logging.Logger):
+            continue
+        handlers = [handler for handler in logger.handlers if hasattr(handler, "log_path")]
+        if handlers:
+            for handler in handlers:
+                logger.removeHandler(handler)
+            log_keeper(file_path, logger.name)
+
+
+def _restart_after_fork():
+    """
+    Listener threads don't survive a fork. The child gets its own, after dropping the records it inherited
+    queued (the parent writes those).
+    """
+    for handler, listener in _listeners.values():
+        while True:
+            try:
+                handler.queue.get_nowait()
+            except queue.Empty:
+                break
+        listener._thread = None
+        listener.start()
+
+
+atexit.register(stop_listeners)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_restart_after_fork)
+
+
+def log_keeper(file_path=None, name=None, structured=True):
+    """
+    Sends the records of logger `name` to the console and to a rotating file through a queue; the files are
+    written by a listener thread, so logging never waits for disk on the websocket or order threads.
+    Calling it again for the same logger and file does nothing.
+    :param file_path: file name inside LOG_DIR (or an absolute path).
+    :param structured: JSON lines in the file (see StructuredFormatter), the console stays plain text.
+    """
     if file_path is None:
         file_path = "info.log"
     if name is None:
         name = __name__
+    path = os.path.join(LOG_DIR, file_path)
     logger = logging.getLogger(name)
     logger.setLevel(logging.INFO)
-
-    stream_handler = logging.StreamHandler()
-    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-    stream_handler.setFormatter(formatter)
-    stream_handler.setLevel(logging.INFO)
-
-    file_handler = logging.FileHandler(f"logfiles\\{file_path}")
-    file_handler.setFormatter(formatter)
-    file_handler.setLevel(logging.INFO)
-
-    logger.addHandler(stream_handler)
-    logger.addHandler(file_handler)
-# logger.info("im actually a logkeeper file.")
+    if any(getattr(handler, "log_path", None) == path for handler in logger.handlers):
+        return logger
+    logger.addHandler(_listener(path, structured))
+    return logger
 
 
 if __name__ == '__main__':
+    # Time spent in logger.info() by the calling thread: the old inline handlers vs the queue, with the console
+    # sent to /dev/null so only the logging machinery and file writes are measured.
+    import contextlib
+    import statistics
+    import tempfile
+    import time
+
     log_keeper()
     log_examples("helloo")
+
+    def latencies(logger: logging.Logger, calls: int, pause_us=0) -> typing.List[int]:
+        """pause_us > 0 spaces the calls like a live session; 0 is a burst that keeps the listener busy."""
+        timings = list()
+        for i in range(calls):
+            ts = time.perf_counter_ns()
+            logger.info("Binance Futures Client | Order %s placed for %s at %s.", i, "BTCUSDT", 20000.1)
+            done = time.perf_counter_ns()
+            timings.append(done - ts)
+            while time.perf_counter_ns() - done < pause_us * 1000:
+                pass
+        return sorted(timings)
+
+    def report(label: str, timings: typing.List[int]):
+        print(f"{label:<34} mean {statistics.fmean(timings) / 1000:6.2f} us   p50 {timings[len(timings) // 2] / 1000:6.2f}"
+              f" us   p99 {timings[int(len(timings) * 0.99)] / 1000:7.2f} us   max {timings[-1] / 1000:8.1f} us")
+
+    def test_logger(name: str, *handlers: logging.Handler) -> logging.Logger:
+        logger = logging.getLogger(name)
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        for handler in handlers:
+            handler.setFormatter(logging.Formatter(LOG_FORMAT))
+            logger.addHandler(handler)
+        return logger
+
+    folder = tempfile.mkdtemp()
+    calls = 50000
+    results = dict()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stderr(devnull):
+        baseline = test_logger("benchmark.null", logging.NullHandler())
+        results["no output (logging itself)"] = latencies(baseline, calls)
+        inline = test_logger("benchmark.inline", logging.StreamHandler(),
+                             logging.FileHandler(os.path.join(folder, "inline.log")))
+        results["inline stream + file, burst"] = latencies(inline, calls)
+        results["inline stream + file, paced"] = latencies(inline, calls // 5, pause_us=200)
+
+        queued = log_keeper(os.path.join(folder, "queued.log"), "benchmark.queued")
+        log_keeper(os.path.join(folder, "queued.log"), "benchmark.queued")
+        queued.propagate = False
+        results["queue + listener, burst"] = latencies(queued, calls)
+        results["queue + listener, paced"] = latencies(queued, calls // 5, pause_us=200)
+        ts = time.perf_counter()
+        stop_listeners()
+        drain = time.perf_counter() - ts
+
+    for label, timings in results.items():
+        report(label, timings)
+    print(f"handlers after two log_keeper calls: {len(queued.handlers)}, listener drained the tail in"
+          f" {drain * 1000:.0f} ms")
+    names = sorted(name for name in os.listdir(folder) if name.startswith("queued.log"))
+    records = sum(sum(1 for _ in open(os.path.join(folder, name))) for name in names)
+    with open(os.path.join(folder, "queued.log")) as file:
+        last = file.readlines()[-1].strip()
+    print(f"{records} structured records in {len(names)} rotated files, last: {last}")
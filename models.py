@@ -1,14 +1,30 @@
 import datetime
 import typing
 import datetime as dt
+import numpy as np
 import pandas as pd
 import pprint
 
+import indicators
+
 TIME_ENUM_CONVERSION = {"1m": 1, "3m": 3, "5m": 5, "15m": 15, "30m": 30, "1h": 60, "2h": 120, "4h": 240, "6h": 360,
                         "8h": 480, "12h": 720, "1d": 1440, "3d": 4320, "1w": 10080, "1M": 40320}
 
+# (column name, index in the raw kline list, dtype)
+KLINE_COLUMNS = [("open_time", 0, np.int64), ("open", 1, np.float64), ("high", 2, np.float64),
+                 ("low", 3, np.float64), ("close", 4, np.float64), ("volume_base", 5, np.float64),
+                 ("close_time", 6, np.int64), ("volume_quote", 7, np.float64), ("num_of_trades", 8, np.int64)]
+
+
+def ts_to_str(timestamp_ms: int) -> str:
+    return dt.datetime.fromtimestamp(int(timestamp_ms / 1000)).strftime('%Y/%m/%d %H:%M:%S')
+
 
 class Contract:
+    __slots__ = ("platform", "symbol", "base_asset", "quote_asset", "margin_asset", "margin_percent",
+                 "price_precision", "quantity_precision", "tick_size", "lot_size", "max_order_limit", "order_types",
+                 "time_in_forces", "max_leverage")
+
     def __init__(self, platform, contract_data):
         self.platform = platform
         self.symbol = str()
@@ -45,8 +61,12 @@ class Contract:
 
 
 class Position:
+    __slots__ = ("platform", "symbol", "is_open", "entry_price", "margin_type", "leverage", "liq_price",
+                 "current_price", "amount", "side", "pnl", "update_time_ts")
+
     def __init__(self, platform: str, position_data):
         self.platform = platform
+        self.symbol = str()
         self.is_open = False
         self.entry_price = float()
         self.margin_type = str()
@@ -57,31 +77,36 @@ class Position:
         self.side = str()
         self.pnl = float()
         self.update_time_ts = int()
-        self.update_time = None
         if self.platform == "binance_futures":
             self.get_binance_futures_position(position_data)
 
     def get_binance_futures_position(self, data):
         # TODO: not finished "GET /fapi/v2/positionRisk (HMAC SHA256)"
+        self.symbol = data['symbol']
         self.entry_price = float(data['entryPrice'])
         self.margin_type = str(data['marginType'])
         self.leverage = int(data['leverage'])
         self.liq_price = float(data['liquidationPrice'])
         self.current_price = float(data['markPrice'])
         self.amount = float(data['positionAmt'])
+        self.is_open = self.amount != 0
         self.side = str(data['positionSide'])
         self.pnl = float(data['unRealizedProfit'])
         self.update_time_ts = int(data['updateTime'])    # beware of /1000
-        self.update_time = dt.datetime.fromtimestamp(int(self.update_time_ts / 1000)).strftime('%Y/%m/%d %H:%M:%S')
+
+    @property
+    def update_time(self) -> typing.Optional[str]:
+        return ts_to_str(self.update_time_ts) if self.update_time_ts else None
 
 
 class Candle:
+    __slots__ = ("platform", "start_timestamp", "end_timestamp", "time_frame", "open", "high", "low", "close",
+                 "volume_base", "volume_quote", "num_of_trades")
+
     def __init__(self, platform: str, candle_list: list, time_frame: str):
         self.platform = platform
         self.start_timestamp = int()
         self.end_timestamp = int()
-        self.start_date_time = datetime.date
-        self.end_date_time = datetime.date
         self.time_frame = TIME_ENUM_CONVERSION[time_frame]  # timeframe in terms of minutes (i.e 60 for 1h timeframe)
         self.open = float()
         self.high = float()
@@ -94,23 +119,108 @@ class Candle:
             self.get_binance_futures_klines(candle_list)
 
     def get_binance_futures_klines(self, candle_list):
-        self.start_timestamp = candle_list[0]
-        self.start_date_time = dt.datetime.fromtimestamp(int(self.start_timestamp / 1000)).strftime('%Y/%m/%d %H:%M:%S')
-        self.end_timestamp = candle_list[6]
-        self.end_date_time = dt.datetime.fromtimestamp(int(self.end_timestamp / 1000)).strftime('%Y/%m/%d %H:%M:%S')
-        self.open = candle_list[1]
-        self.high = candle_list[2]
-        self.low = candle_list[3]
-        self.close = candle_list[4]
-        self.volume_base = candle_list[5]
-        self.volume_quote = candle_list[7]
-        self.num_of_trades = candle_list[8]
+        self.start_timestamp = int(candle_list[0])
+        self.end_timestamp = int(candle_list[6])
+        self.open = float(candle_list[1])
+        self.high = float(candle_list[2])
+        self.low = float(candle_list[3])
+        self.close = float(candle_list[4])
+        self.volume_base = float(candle_list[5])
+        self.volume_quote = float(candle_list[7])
+        self.num_of_trades = int(candle_list[8])
+
+    @property
+    def start_date_time(self) -> str:
+        return ts_to_str(self.start_timestamp)
+
+    @property
+    def end_date_time(self) -> str:
+        return ts_to_str(self.end_timestamp)
+
+
+class CandleSeries:
+    """
+    Column-oriented candles: one contiguous numpy array per field instead of one Candle object per kline.
+    Slicing returns views (no copy), integer indexing builds a single Candle on demand.
+    """
+    def __init__(self, columns: typing.Dict[str, np.ndarray], time_frame: str, symbol=""):
+        """
+        :param columns: one array per name in KLINE_COLUMNS, all of the same length and sorted by open_time.
+        :param time_frame: key of TIME_ENUM_CONVERSION, i.e 1h
+        :param symbol: contract symbol, informative only.
+        """
+        self.time_frame = time_frame
+        self.symbol = symbol
+        self.open_time = columns["open_time"]
+        self.open = columns["open"]
+        self.high = columns["high"]
+        self.low = columns["low"]
+        self.close = columns["close"]
+        self.volume_base = columns["volume_base"]
+        self.close_time = columns["close_time"]
+        self.volume_quote = columns["volume_quote"]
+        self.num_of_trades = columns["num_of_trades"]
+
+    @classmethod
+    def from_klines(cls, klines: typing.List[list], time_frame: str, symbol="") -> "CandleSeries":
+        """Builds the series straight from the raw kline lists of the exchange in one vectorized pass."""
+        if len(klines) == 0:
+            return cls({name: np.empty(0, dtype=dtype) for name, _, dtype in KLINE_COLUMNS}, time_frame, symbol)
+        fields = list(zip(*klines))     # transposed once, then each column is parsed by numpy in C
+        columns = {name: np.array(fields[index], dtype=dtype) for name, index, dtype in KLINE_COLUMNS}
+        return cls(columns, time_frame, symbol)
+
+    @classmethod
+    def from_candles(cls, candles: typing.List[Candle], symbol="") -> "CandleSeries":
+        minutes = candles[0].time_frame if candles else 1
+        time_frame = next(key for key, value in TIME_ENUM_CONVERSION.items() if value == minutes)
+        fields = {"open_time": "start_timestamp", "close_time": "end_timestamp"}
+        columns = {name: np.array([getattr(candle, fields.get(name, name)) for candle in candles], dtype=dtype)
+                   for name, _, dtype in KLINE_COLUMNS}
+        return cls(columns, time_frame, symbol)
+
+    @property
+    def columns(self) -> typing.Dict[str, np.ndarray]:
+        return {name: getattr(self, name) for name, _, _ in KLINE_COLUMNS}
+
+    def __len__(self):
+        return len(self.open_time)
+
+    def __getitem__(self, item) -> typing.Union[Candle, "CandleSeries"]:
+        if isinstance(item, slice):
+            return CandleSeries({name: column[item] for name, column in self.columns.items()}, self.time_frame,
+                                self.symbol)
+        row = [None] * len(KLINE_COLUMNS)
+        for name, index, _ in KLINE_COLUMNS:
+            row[index] = getattr(self, name)[item].item()
+        return Candle("binance_futures", row, self.time_frame)
+
+    def __iter__(self) -> typing.Iterator[Candle]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def index_of(self, timestamp: int) -> int:
+        """Position of the candle that is open at timestamp (ms), found by binary search. -1 if before the series."""
+        return int(np.searchsorted(self.open_time, timestamp, side="right")) - 1
+
+    def between(self, start_time=None, end_time=None) -> "CandleSeries":
+        """Candles whose open time is in [start_time, end_time] (ms), as a view."""
+        first = 0 if start_time is None else int(np.searchsorted(self.open_time, start_time, side="left"))
+        last = len(self) if end_time is None else int(np.searchsorted(self.open_time, end_time, side="right"))
+        return self[first:last]
+
+    def to_dataframe(self) -> pd.DataFrame:
+        df = pd.DataFrame(self.columns, copy=False)
+        df.index = pd.to_datetime(self.open_time, unit="ms")
+        return df
 
 
 class Order:
+    __slots__ = ("platform", "avg_price", "order_id", "executed_quantity", "original_quantity", "original_type",
+                 "price", "side", "status", "stop_price", "symbol", "order_time_ts", "tif")
+
     def __init__(self, platform, order_data):
         self.platform = platform
-        self.order_data = order_data
         self.avg_price = float()
         self.order_id = None
         self.executed_quantity = float()
@@ -122,34 +232,39 @@ class Order:
         self.stop_price = None
         self.symbol = str()
         self.order_time_ts = int()
-        self.order_time = None
         self.tif = str()
         if self.platform == "binance_futures":
             self.get_binance_futures_order(order_data)
 
     def get_binance_futures_order(self, order_data):
-        self.avg_price = order_data['avgPrice']
-        self.order_id = order_data['orderId']
-        self.executed_quantity = order_data['executedQty']
-        self.original_quantity = order_data['origQty']
+        self.avg_price = float(order_data['avgPrice'])
+        self.order_id = int(order_data['orderId'])
+        self.executed_quantity = float(order_data['executedQty'])
+        self.original_quantity = float(order_data['origQty'])
         self.original_type = order_data['origType']
-        self.price = order_data['price']
+        self.price = float(order_data['price'])
         self.side = order_data['side']
         self.status = order_data['status']
-        self.stop_price = order_data['stopPrice']
+        self.stop_price = float(order_data['stopPrice'])
         self.symbol = order_data['symbol']
         try:
-            self.order_time_ts = order_data['time']
+            self.order_time_ts = int(order_data['time'])
         except KeyError:
-            self.order_time_ts = order_data['updateTime']
-        self.order_time = dt.datetime.fromtimestamp(int(self.order_time_ts / 1000)).strftime('%Y/%m/%d %H:%M:%S')
+            self.order_time_ts = int(order_data['updateTime'])
         self.tif = order_data['timeInForce']
 
+    @property
+    def order_time(self) -> typing.Optional[str]:
+        return ts_to_str(self.order_time_ts) if self.order_time_ts else None
+
 
 class Wallet:
+    __slots__ = ("platform", "last_updated_ts", "fee_tier", "asset_info", "position_info", "can_deposit", "can_trade",
+                 "can_withdraw", "available_balance", "total_balance", "total_required_margin",
+                 "total_unrealised_pnl")
+
     def __init__(self, platform: str, wallet_data: dict):
         self.platform = platform
-        self.last_updated = dt.datetime.utcnow().strftime('%Y/%m/%d %H:%M:%S')
         self.last_updated_ts = int(dt.datetime.timestamp(dt.datetime.utcnow()))
         self.fee_tier = int()
         self.asset_info = dict()
@@ -201,35 +316,52 @@ class Wallet:
             print("Some areas are not found while retrieving wallet info")
 
     def update_wallet_time(self):
-        self.last_updated = dt.datetime.utcnow().strftime('%Y/%m/%d %H:%M:%S')
         self.last_updated_ts = int(dt.datetime.timestamp(dt.datetime.utcnow()))
 
+    @property
+    def last_updated(self) -> str:
+        # last_updated_ts is the utc wall clock read as local time, fromtimestamp() undoes that.
+        return dt.datetime.fromtimestamp(self.last_updated_ts).strftime('%Y/%m/%d %H:%M:%S')
+
 
 class TechnicalAnalysis:
-    def __init__(self, contract: Contract, candle_list: typing.List[Candle]):
+    """
+    Indicators over the candles of one contract. Every calculate_* accepts one look-back or a list of them, a list
+    adds a period axis in front of time (see indicators.py). Use the indicators module directly for 2-D batches
+    of many symbols.
+    """
+    def __init__(self, contract: Contract, candle_list: typing.Union[CandleSeries, typing.List[Candle]]):
         self.contract = contract
+        if not isinstance(candle_list, CandleSeries):
+            candle_list = CandleSeries.from_candles(candle_list)
+        self.candles = candle_list
 
     def calculate_ema(self, look_back):
-        pass
+        return indicators.ema(self.candles.close, look_back)
 
     def calculate_sma(self, look_back):
-        pass
+        return indicators.sma(self.candles.close, look_back)
 
     def calculate_rsi(self, look_back):
-        pass
+        return indicators.rsi(self.candles.close, look_back)
 
     def calculate_kdj(self, look_back):
-        pass
+        """:return: (K, D, J)"""
+        return indicators.kdj(self.candles.high, self.candles.low, self.candles.close, look_back)
 
     def calculate_atr(self, look_back):
-        pass
+        return indicators.atr(self.candles.high, self.candles.low, self.candles.close, look_back)
 
 
 class GraphCandles:
     # maybe it is better to pass dataframe as it would be easier to store them in sqlite3.
-    def __init__(self, candle_list: typing.List[Candle]):
-        self.df_candles = pd.DataFrame(candle_list,  # index??
-                                       columns=["timestamp", "datetime", "timeframe", "open", "high", "low", "close"])
+    def __init__(self, candle_list: typing.Union[CandleSeries, typing.List[Candle]]):
+        if isinstance(candle_list, CandleSeries):
+            self.df_candles = candle_list.to_dataframe()
+        else:
+            self.df_candles = pd.DataFrame(candle_list,  # index??
+                                           columns=["timestamp", "datetime", "timeframe", "open", "high", "low",
+                                                    "close"])
 
     def draw_graph(self, interval):
         pass
@@ -245,3 +377,37 @@ class GraphCandles:
 
     def remove_from_graph(self, parameter):
         pass
+
+
+if __name__ == '__main__':
+    # Per-instance memory and construction time of the models.
+    import time
+    import tracemalloc
+
+    kline = [1658000000000, "21450.10", "21460.00", "21440.50", "21455.30", "12.345", 1658000059999, "264850.12", 321,
+             "6.1", "130000.5", "0"]
+    order = {"avgPrice": "0.00000", "orderId": 3082145712, "executedQty": "0", "origQty": "0.010",
+             "origType": "LIMIT", "price": "21000.00", "side": "BUY", "status": "NEW", "stopPrice": "0",
+             "symbol": "BTCUSDT", "time": 1658000000000, "timeInForce": "GTC", "clientOrderId": "web_abc",
+             "cumQuote": "0", "reduceOnly": False, "closePosition": False, "positionSide": "BOTH",
+             "workingType": "CONTRACT_PRICE", "priceProtect": False, "type": "LIMIT", "updateTime": 1658000000000}
+    position = {"symbol": "BTCUSDT", "entryPrice": "21000.0", "marginType": "cross", "leverage": "20",
+                "liquidationPrice": "0", "markPrice": "21455.3", "positionAmt": "0.010", "positionSide": "BOTH",
+                "unRealizedProfit": "4.55", "updateTime": 1658000000000}
+    samples = {Candle: lambda: (list(kline), "1m"),
+               Order: lambda: (dict(order),),
+               Position: lambda: (dict(position),)}
+
+    n = 100000
+    for model, payload in samples.items():
+        # raw payloads are built up front so only the model objects are measured
+        payloads = [payload() for _ in range(n)]
+        ts = time.perf_counter()
+        objects = [model("binance_futures", *args) for args in payloads]
+        elapsed = time.perf_counter() - ts
+        del objects
+        tracemalloc.start()
+        objects = [model("binance_futures", *args) for args in payloads]
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{model.__name__:<9} {elapsed / n * 1e6:6.2f} us/instance   {size / n:7.1f} bytes/instance")
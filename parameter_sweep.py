@@ -0,0 +1,207 @@
+import bisect
+import itertools
+import logging
+import multiprocessing
+import os
+import time
+import typing
+
+import numpy as np
+
+import logkeeper
+from backtester import Backtester
+from candle_store import CandleStore, STORE_DIR
+from models import Contract
+
+logger = logging.getLogger("parameter_sweep.py")
+logkeeper.log_keeper("connectors.log", "parameter_sweep.py")
+
+# Keys of a parameter set that go to Backtester.run_orders, the others go to the strategy.
+ORDER_PARAMS = ("stop_loss", "take_profit", "entry_offset", "entry_valid_bars")
+
+Strategy = typing.Callable[..., np.ndarray]
+Job = typing.Tuple[str, dict]
+
+# Worker process state, set once by _init_worker. Candles are memory-mapped from the CandleStore, so every
+# process reads the same page cache and a job only pickles its symbol and parameters.
+_worker: typing.Dict[str, typing.Any] = dict()
+
+
+def grid(**ranges: typing.Iterable) -> typing.List[dict]:
+    """Every combination of the given values, i.e grid(fast=[10, 20], slow=[100, 200]) gives 4 parameter sets."""
+    names = list(ranges)
+    return [dict(zip(names, values)) for values in itertools.product(*ranges.values())]
+
+
+def _init_worker(root: str, interval: str, strategy: Strategy, contracts: typing.Dict[str, Contract],
+                 backtest_kwargs: dict):
+    _worker.update(store=CandleStore(root=root), interval=interval, strategy=strategy, contracts=contracts,
+                   backtest_kwargs=backtest_kwargs, backtesters=dict())
+
+
+def _backtester(symbol: str) -> typing.Optional[Backtester]:
+    backtesters = _worker["backtesters"]
+    if symbol not in backtesters:
+        series = _worker["store"].load(symbol, _worker["interval"], mmap=True)
+        backtesters[symbol] = Backtester(series, _worker["contracts"].get(symbol), **_worker["backtest_kwargs"]) \
+            if series is not None else None
+    return backtesters[symbol]
+
+
+def _run_job(job: Job) -> dict:
+    symbol, params = job
+    row = {"symbol": symbol, "params": params}
+    try:
+        backtester = _backtester(symbol)
+        if backtester is None:
+            row["error"] = f"no {_worker['interval']} candles stored"
+            return row
+        order_params = {key: value for key, value in params.items() if key in ORDER_PARAMS}
+        signal = _worker["strategy"](backtester.series, **{key: value for key, value in params.items()
+                                                            if key not in ORDER_PARAMS})
+        if order_params:
+            result = backtester.run_orders(signal, **order_params)
+        else:
+            result = backtester.run(signal)
+        row.update(result.summary())
+    except Exception as e:
+        row["error"] = f"{type(e).__name__}: {e}"
+    return row
+
+
+class SweepSummary:
+    """Results ranked as they arrive, best first. Failed jobs are kept apart."""
+    def __init__(self, rank_by="sharpe"):
+        self.rank_by = rank_by
+        self.rows: typing.List[dict] = list()
+        self.failed: typing.List[dict] = list()
+        self._keys: typing.List[float] = list()
+
+    def add(self, row: dict):
+        if "error" in row:
+            self.failed.append(row)
+            return
+        key = -row[self.rank_by]
+        position = bisect.bisect_right(self._keys, key)
+        self._keys.insert(position, key)
+        self.rows.insert(position, row)
+
+    def best(self, n=10) -> typing.List[dict]:
+        return self.rows[:n]
+
+    def table(self, n=20) -> str:
+        lines = [f"{'#':>3} {'symbol':<14} {'trades':>6} {'return':>9} {'drawdown':>9} {'sharpe':>7} "
+                 f"{'win rate':>8}  params"]
+        for rank, row in enumerate(self.best(n), start=1):
+            lines.append(f"{rank:>3} {row['symbol']:<14} {row['trades']:>6} {row['total_return']:>9.2%} "
+                         f"{row['max_drawdown']:>9.2%} {row['sharpe']:>7.2f} {row['win_rate']:>8.1%}  {row['params']}")
+        if self.failed:
+            lines.append(f"{len(self.failed)} jobs failed, first: {self.failed[0]['symbol']} {self.failed[0]['error']}")
+        return "\n".join(lines)
+
+
+class ParameterSweep:
+    """
+    Backtests (symbol, parameter set) jobs on a process pool. Candles come from a CandleStore and are
+    memory-mapped by each worker instead of being pickled to it; jobs are grouped by symbol so a worker keeps
+    touching the same files.
+    """
+    def __init__(self, strategy: Strategy, interval: str, store_root=STORE_DIR,
+                 contracts: typing.Optional[typing.Dict[str, Contract]] = None, processes: typing.Optional[int] = None,
+                 rank_by="sharpe", **backtest_kwargs):
+        """
+        :param strategy: module level function (it is pickled by name) strategy(series, **params) -> signal.
+        :param interval: key of TIME_ENUM_CONVERSION, the candles must already be in the store.
+        :param store_root: root of the CandleStore.
+        :param contracts: symbol -> Contract for tick and lot sizes, symbols without one are not rounded.
+        :param processes: pool size, os.cpu_count() if None.
+        :param rank_by: BacktestResult.summary() key the results are ranked on, highest first.
+        :param backtest_kwargs: passed to every Backtester, i.e maker_commission=..., initial_balance=...
+        """
+        self.strategy = strategy
+        self.interval = interval
+        self.store_root = store_root
+        self.contracts = contracts or dict()
+        self.processes = processes or os.cpu_count() or 1
+        self.rank_by = rank_by
+        self.backtest_kwargs = backtest_kwargs
+
+    @staticmethod
+    def jobs(symbols: typing.Iterable[str], param_sets: typing.Iterable[dict]) -> typing.List[Job]:
+        param_sets = list(param_sets)
+        return [(symbol, params) for symbol in symbols for params in param_sets]
+
+    def iter_results(self, jobs: typing.List[Job]) -> typing.Iterator[dict]:
+        """Yields one result row per job as soon as it is done (not in job order)."""
+        jobs = sorted(jobs, key=lambda job: job[0])
+        init_args = (self.store_root, self.interval, self.strategy, self.contracts, self.backtest_kwargs)
+        if self.processes == 1:
+            _init_worker(*init_args)
+            for job in jobs:
+                yield _run_job(job)
+            return
+        # a few chunks per process: small enough to balance the load, large enough to keep symbols together
+        chunk_size = max(1, len(jobs) // (self.processes * 4))
+        with multiprocessing.Pool(self.processes, initializer=_init_worker, initargs=init_args) as pool:
+            yield from pool.imap_unordered(_run_job, jobs, chunksize=chunk_size)
+
+    def run(self, jobs: typing.List[Job],
+            on_result: typing.Optional[typing.Callable[[dict, SweepSummary], None]] = None) -> SweepSummary:
+        """
+        :param on_result: called in this process after every finished job with the row and the summary so far.
+        :return: the ranked summary of every job.
+        """
+        summary = SweepSummary(self.rank_by)
+        ts = time.time()
+        for row in self.iter_results(jobs):
+            summary.add(row)
+            if on_result is not None:
+                on_result(row, summary)
+        logger.info("Parameter Sweep | %s jobs in %.1fs on %s processes, %s failed.", len(jobs), time.time() - ts,
+                    self.processes, len(summary.failed))
+        return summary
+
+
+def ema_crossover(series, fast: int, slow: int) -> np.ndarray:
+    from backtester import crossover_signal
+    return crossover_signal(series.close, fast, slow)
+
+
+if __name__ == '__main__':
+    # A quarter of synthetic 1m candles for the 20 symbols of request_lvl2_id, 12 parameter sets each,
+    # run with growing pool sizes to show the scaling.
+    import tempfile
+    from models import CandleSeries
+
+    symbols = ["BTCUSDT", "ADAUSDT", "LINKUSDT", "MANAUSDT", "ETHUSDT", "LTCUSDT", "1000SHIBUSDT", "SOLUSDT",
+               "AVAXUSDT", "DYDXUSDT", "BCHUSDT", "XRPUSDT", "EOSUSDT", "TRXUSDT", "ETCUSDT", "BNBUSDT", "DOGEUSDT",
+               "MKRUSDT", "BATUSDT", "ANKRUSDT"]
+    minutes = 90 * 24 * 60
+    rng = np.random.default_rng(7)
+    store = CandleStore(root=tempfile.mkdtemp())
+    open_time = 1640995200000 + 60000 * np.arange(minutes, dtype=np.int64)
+    for symbol in symbols:
+        close = 100 * np.exp(np.cumsum(rng.normal(0, 8e-4, minutes)))
+        open_ = np.append(close[0], close[:-1])
+        wick = np.abs(rng.normal(0, 5e-4, minutes)) * close
+        store.write_series(symbol, "1m", CandleSeries(
+            {"open_time": open_time, "open": open_, "high": np.maximum(open_, close) + wick,
+             "low": np.minimum(open_, close) - wick, "close": close, "volume_base": np.ones(minutes),
+             "close_time": open_time + 59999, "volume_quote": close,
+             "num_of_trades": np.ones(minutes, dtype=np.int64)}, "1m", symbol))
+
+    param_sets = grid(fast=[20, 60, 120], slow=[240, 480]) + grid(fast=[60], slow=[240], stop_loss=[0.005, 0.01],
+                                                                    take_profit=[0.01, 0.02, None])
+    jobs = ParameterSweep.jobs(symbols, param_sets)
+    print(f"{len(jobs)} jobs of {minutes} candles, {os.cpu_count()} cores")
+    pool_sizes = sorted({1, 2, os.cpu_count() or 1})
+    single = None
+    for processes in pool_sizes:
+        sweep = ParameterSweep(ema_crossover, "1m", store.root, processes=processes, initial_balance=1000)
+        ts = time.perf_counter()
+        summary = sweep.run(jobs)
+        elapsed = time.perf_counter() - ts
+        single = single or elapsed
+        print(f"{processes:>2} processes: {elapsed:6.2f}s, {len(jobs) / elapsed:6.1f} jobs/s,"
+              f" speed-up {single / elapsed:.2f}x")
+    print(summary.table(10))